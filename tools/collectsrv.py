@@ -0,0 +1,163 @@
+#!/usr/bin/env python2.7
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import hashlib
+import logging
+import urlparse
+import threading
+import SocketServer
+import BaseHTTPServer
+
+
+LOG_FILENAME = "collectsrv_%s.log" % time.strftime("%Y%m%d_%H%M%S")
+
+# uploads in progress are kept in <dir>/partial, completed ones in <dir>/<group>
+DEFAULT_DIR = "collected"
+DEFAULT_PORT = 8472
+
+UPLOAD_PATH = re.compile(r"^.*/uploads/(?P<sha>[0-9a-f]{64})$")
+SAFE_NAME = re.compile(r"^[\w.-]+$")
+
+
+def get_option(name, default=None):
+    """
+    return the value of a '--name=value' command line option
+    """
+    prefix = "--%s=" % name
+    for arg in sys.argv[1:]:
+        if arg.startswith(prefix):
+            return arg[len(prefix):]
+    return default
+
+
+class CollectHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    stand-in collection server for the uploads of experimentcontroller/uploader.py
+    """
+
+    lock = threading.Lock()
+    directory = DEFAULT_DIR
+
+    def parse(self):
+        url = urlparse.urlsplit(self.path)
+        m = UPLOAD_PATH.match(url.path)
+        if not m:
+            self.reply(404, {"error": "not found"})
+            return (None, None)
+        query = dict(urlparse.parse_qsl(url.query))
+        return (m.group("sha"), query)
+
+    def reply(self, status, data):
+        body = json.dumps(data) + "\n"
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def partial(self, sha):
+        return os.path.join(self.directory, "partial", sha)
+
+    def complete_marker(self, sha):
+        return os.path.join(self.directory, "complete", sha)
+
+    def do_GET(self):
+        sha, query = self.parse()
+        if sha == None:
+            return
+        if os.path.isfile(self.complete_marker(sha)):
+            self.reply(200, {"offset": None, "complete": True})
+        elif os.path.isfile(self.partial(sha)):
+            self.reply(200, {"offset": os.path.getsize(self.partial(sha)),
+                "complete": False})
+        else:
+            self.reply(404, {"offset": 0, "complete": False})
+
+    def do_PUT(self):
+        sha, query = self.parse()
+        if sha == None:
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        chunk = self.rfile.read(length)
+        if hashlib.sha256(chunk).hexdigest() != self.headers.get("X-Chunk-Sha256"):
+            self.reply(400, {"error": "chunk hash mismatch"})
+            return
+        with self.lock:
+            path = self.partial(sha)
+            size = os.path.getsize(path) if os.path.isfile(path) else 0
+            offset = int(query.get("offset", 0))
+            # a repeated chunk (lost reply) is acknowledged, gaps are refused
+            if offset == size:
+                with open(path, "ab") as f:
+                    f.write(chunk)
+                size += len(chunk)
+            elif offset > size:
+                self.reply(409, {"error": "expected offset %d" % size, "offset": size})
+                return
+        self.reply(200, {"offset": size})
+
+    def do_POST(self):
+        sha, query = self.parse()
+        if sha == None:
+            return
+        name = query.get("name", sha)
+        group = query.get("group", "unknown")
+        if not SAFE_NAME.match(name) or not SAFE_NAME.match(group):
+            self.reply(400, {"error": "invalid name"})
+            return
+        with self.lock:
+            if os.path.isfile(self.complete_marker(sha)):
+                self.reply(200, {"complete": True})
+                return
+            path = self.partial(sha)
+            h = hashlib.sha256()
+            with open(path, "rb") as f:
+                for data in iter(lambda: f.read(1 << 20), ""):
+                    h.update(data)
+            if h.hexdigest() != sha:
+                # start over
+                os.unlink(path)
+                self.reply(409, {"error": "hash mismatch"})
+                return
+            target_dir = os.path.join(self.directory, group)
+            if not os.path.isdir(target_dir):
+                os.makedirs(target_dir)
+            shutil.move(path, os.path.join(target_dir, name))
+            with open(self.complete_marker(sha), "w") as f:
+                json.dump(query, f)
+        logging.info("received %s/%s (%s)", group, name, sha)
+        self.reply(200, {"complete": True})
+
+    def log_message(self, format, *args):
+        logging.debug("%s " + format, self.address_string(), *args)
+
+
+class ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+if __name__ == "__main__":
+    logging.basicConfig(filename=LOG_FILENAME,
+                    format='%(asctime)s:%(levelname)s:%(message)s',
+                    level=logging.DEBUG,
+                    )
+
+    port = int(get_option("port", DEFAULT_PORT))
+    CollectHandler.directory = get_option("dir", DEFAULT_DIR)
+    for d in ["partial", "complete"]:
+        if not os.path.isdir(os.path.join(CollectHandler.directory, d)):
+            os.makedirs(os.path.join(CollectHandler.directory, d))
+
+    server = ThreadedHTTPServer(("", port), CollectHandler)
+    print "collection server listening on port %d, storing to %s" % (port,
+            CollectHandler.directory)
+    print "logging to %s" % LOG_FILENAME
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info("collection server stopped")
@@ -0,0 +1,53 @@
+#!/usr/bin/env python2.7
+
+import os
+import logging
+import sys
+import time
+
+sys.path.append(os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "experimentcontroller/")
+    ))
+
+import coordinator
+
+
+LOG_FILENAME = "agent_%s.log" % time.strftime("%Y%m%d_%H%M%S")
+
+
+def get_option(name, default=None):
+    """
+    return the value of a '--name=value' command line option
+    """
+    prefix = "--%s=" % name
+    for arg in sys.argv[1:]:
+        if arg.startswith(prefix):
+            return arg[len(prefix):]
+    return default
+
+
+if __name__ == "__main__":
+    logging.basicConfig(filename=LOG_FILENAME,
+                    format='%(asctime)s:%(levelname)s:%(message)s',
+                    level=logging.DEBUG,
+                    )
+
+    secret = coordinator.load_secret(get_option("secret-file"))
+    if secret == None:
+        print "Error: no shared secret, use --secret-file=<file> or set %s" % (
+                coordinator.AGENT_SECRET_ENV)
+        sys.exit(1)
+
+    host = get_option("bind", coordinator.AGENT_BIND)
+    port = int(get_option("port", coordinator.AGENT_PORT))
+    service = coordinator.AgentService(
+            docker_host=get_option("docker-host"),
+            display=get_option("display"))
+
+    print "experiment agent listening on %s:%d" % (host, port)
+    print "docker host for interactive containers: %s" % service.docker_host
+    print "logging to %s" % LOG_FILENAME
+    try:
+        coordinator.serve(service, secret, host=host, port=port)
+    except KeyboardInterrupt:
+        logging.info("agent stopped")
@@ -12,6 +12,25 @@ sys.path.append(os.path.abspath(
 import commandline
 import manager
 import basic_commands
+import regrade
+import results_store
+import chunkstore
+import scheduler
+import resources
+import image_bundle
+import coordinator
+import metrics
+import profiling
+import cleanup
+import editor_pool
+import storage
+import uploader
+import probes
+import selftest
+import eventloop
+import display
+import checkpoint
+import image_scheduler
 from task import Task
 from task import QuestionTask
 
@@ -20,6 +39,16 @@ VERSION = "v1.4"
 LOG_FILENAME = "experiments_%s.log" % time.strftime("%Y%m%d_%H%M%S")
 
 
+def get_option(name, default=None):
+    """
+    return the value of a '--name=value' command line option
+    """
+    prefix = "--%s=" % name
+    for arg in sys.argv[1:]:
+        if arg.startswith(prefix):
+            return arg[len(prefix):]
+    return default
+
 
 
 if __name__ == "__main__":
@@ -31,20 +60,66 @@ if __name__ == "__main__":
     logging.info("starting experiment controller version %s", VERSION)
     print "Experiment controller version %s" % VERSION
 
-    if 'DISPLAY' not in os.environ or len(os.environ['DISPLAY']) == 0:
+    display_probe = probes.probe_display(None)
+    if not display_probe.ok and get_option("display", display.DEFAULT_BACKEND) == "x11":
         logging.error("no display variable set")
         print "Error: no DISPLAY variable set. A graphical interface is required"
         sys.exit(1)
     else:
-        logging.debug("display: '%s'", os.environ['DISPLAY'])
+        logging.debug("display: '%s'", display_probe.value)
 
 
     mgr = manager.Manager()
+    if '--async' in sys.argv:
+        # non-blocking prompt, background commands and timers on one loop
+        logging.info("async command line enabled")
+        mgr.use_event_loop(eventloop.EventLoop())
     if '--dev' in sys.argv:
         logging.info("dev mode enabled")
         mgr.devmode = True
         print "devmode enabled"
         print "logging to %s" % LOG_FILENAME
+    if '--admission' in sys.argv:
+        # docker operations of all seats on this host are queued
+        logging.info("admission control enabled")
+        mgr.admission = scheduler.AdmissionControl(enabled=True)
+
+    profile = get_option("resources", resources.DEFAULT_PROFILE)
+    if not profile in resources.RESOURCE_PROFILES:
+        print "Error: unknown resource profile '%s', available: %s" % (
+                profile, ", ".join(sorted(resources.RESOURCE_PROFILES.keys())))
+        sys.exit(1)
+    logging.info("using resource profile %s", profile)
+    mgr.set_resource_profile(profile)
+
+    agents = get_option("agents")
+    if agents:
+        # coordinator mode: --agents=[name=]host[:port],...
+        secret = coordinator.load_secret(get_option("agent-secret-file"))
+        if secret == None:
+            print "Error: the agents need a shared secret, use --agent-secret-file=<file>"
+            print "or set %s" % coordinator.AGENT_SECRET_ENV
+            sys.exit(1)
+        mgr.coordinator = coordinator.Coordinator()
+        for a in agents.split(","):
+            if "=" in a:
+                name, url = a.split("=", 1)
+            else:
+                name, url = a.split(":")[0], a
+            mgr.coordinator.add_agent(coordinator.RemoteAgent(name, url, secret))
+        print "coordinator mode, agents: %s" % ", ".join(
+                sorted(mgr.coordinator.agents.keys()))
+
+    if '--profile' in sys.argv:
+        logging.info("profiling enabled")
+        mgr.cmdline.profiler = profiling.CommandProfiler()
+        print "profiling enabled, profiles are written to %s/" % profiling.PROFILE_DIR
+
+    metrics_address = get_option("metrics")
+    if metrics_address:
+        # --metrics=<local port> or --metrics=unix:<socket path>
+        metrics.start_server(metrics_address)
+        print "metrics available at %s (/metrics, /status)" % metrics_address
 
     mgr.register_command(basic_commands.QuitControler(mgr))
     mgr.register_command(basic_commands.NewExperiment(mgr))
@@ -53,6 +128,61 @@ if __name__ == "__main__":
     mgr.register_command(basic_commands.FinishExperiment(mgr))
     mgr.register_command(basic_commands.Start(mgr))
     mgr.register_command(basic_commands.PullImages(mgr))
+    mgr.register_command(image_bundle.ExportImages(mgr))
+    mgr.register_command(image_bundle.LoadImages(mgr))
+    mgr.register_command(regrade.Regrade(mgr))
+    mgr.register_command(results_store.Ingest(mgr))
+    mgr.register_command(results_store.QueryResults(mgr))
+    mgr.register_command(chunkstore.ExportArchive(mgr))
+    mgr.register_command(chunkstore.RestoreArchive(mgr))
+    mgr.register_command(scheduler.SchedulerStatus(mgr))
+    mgr.register_command(resources.SeatUsage(mgr))
+    mgr.register_command(coordinator.ListAgents(mgr))
+    mgr.register_command(cleanup.GarbageCollect(mgr))
+
+    upload_url = get_option("upload-url")
+    mgr.register_command(uploader.UploadStatus(mgr))
+    mgr.register_command(probes.Doctor(mgr))
+    mgr.register_command(selftest.SelfTest(mgr))
+    if upload_url:
+        # results are pushed to the collection server in the background
+        mgr.uploader = uploader.Uploader(upload_url)
+        mgr.uploader.start()
+        print "uploading results to %s" % upload_url
+
+    backend = get_option("display", display.DEFAULT_BACKEND)
+    if not backend in display.DISPLAY_BACKENDS:
+        print "Error: unknown display backend '%s', available: %s" % (
+                backend, ", ".join(display.DISPLAY_BACKENDS))
+        sys.exit(1)
+    mgr.display = display.BACKENDS[backend](mgr)
+    mgr.register_command(display.Display(mgr))
+    logging.info("using display backend %s", backend)
+
+    storage_mode = get_option("storage", storage.DEFAULT_STORAGE)
+    if not storage_mode in storage.STORAGE_MODES:
+        print "Error: unknown storage mode '%s', available: %s" % (
+                storage_mode, ", ".join(storage.STORAGE_MODES))
+        sys.exit(1)
+    if storage_mode == "overlay" and mgr.coordinator == None:
+        # one shared read-only skeleton, a writable overlay per seat
+        mgr.storage = storage.OverlayStorage(mgr)
+        mgr.register_command(mgr.storage)
+
+    mgr.register_command(checkpoint.Checkpoints(mgr))
+    interval = int(get_option("checkpoints", checkpoint.CHECKPOINT_INTERVAL))
+    if interval > 0 and mgr.coordinator == None:
+        # --checkpoints=<seconds> between background checkpoints, 0 disables
+        mgr.checkpointer = checkpoint.Checkpointer(mgr, interval)
+        mgr.checkpointer.start()
+
+    pool_size = int(get_option("pool", editor_pool.DEFAULT_POOL_SIZE))
+    if pool_size > 0 and not mgr.devmode and mgr.coordinator == None and \
+            mgr.display.name == "x11":
+        # --pool=<n> editor containers are kept started (off by default)
+        mgr.editor_pool = editor_pool.EditorPool(mgr, pool_size)
+        mgr.register_command(mgr.editor_pool)
+        mgr.editor_pool.refill()
 
     mgr.add_task(Task(
         id = "task1a",
@@ -454,4 +584,15 @@ if __name__ == "__main__":
         ])
 
 
+    # all tasks are known now, probe for their images too
+    mgr.probes.start()
+
+    if '--fetch-images' in sys.argv and mgr.coordinator == None:
+        # missing images are pulled in the background in plan order,
+        # experiments start once the editor image is there
+        prefix = get_option("image-prefix", basic_commands.DEFAULT_IMAGE_PREFIX)
+        mgr.image_scheduler = image_scheduler.ImageScheduler(mgr, prefix)
+        mgr.cmdline.status_hooks.append(mgr.image_scheduler.status)
+        mgr.image_scheduler.start()
+
     mgr.start()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python2.7
+
+import os
+import time
+import shlex
+import hashlib
+import tarfile
+import logging
+import StringIO
+import subprocess
+
+from pgzip import ParallelGzipWriter
+
+
+SRC_DIR = "/home/user/src"
+
+# the checksum manifest is written next to the archive, in sha256sum format
+MANIFEST_SUFFIX = ".sha256"
+
+
+class HashingReader(object):
+    """
+    file like object passing reads through and hashing the data
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.sha256.update(data)
+        return data
+
+
+def manifest_path(archive):
+    return archive + MANIFEST_SUFFIX
+
+
+def write_manifest(archive, digests):
+    with open(manifest_path(archive) + ".tmp", "w") as f:
+        for name in sorted(digests):
+            f.write("%s  %s\n" % (digests[name], name))
+    os.rename(manifest_path(archive) + ".tmp", manifest_path(archive))
+
+
+def verify(archive):
+    """
+    compare the files of archive with its checksum manifest, returns the
+    list of problems
+    """
+    expected = {}
+    with open(manifest_path(archive)) as f:
+        for line in f:
+            digest, name = line.rstrip("\n").split("  ", 1)
+            expected[name] = digest
+
+    problems = []
+    tar = tarfile.open(archive, "r|gz")
+    try:
+        for info in tar:
+            if not info.isreg():
+                continue
+            h = hashlib.sha256()
+            f = tar.extractfile(info)
+            for data in iter(lambda: f.read(1 << 20), b""):
+                h.update(data)
+            digest = expected.pop(info.name, None)
+            if digest != h.hexdigest():
+                problems.append("%s: checksum mismatch" % info.name)
+    finally:
+        tar.close()
+    for name in sorted(expected):
+        problems.append("%s: missing" % name)
+    return problems
+
+
+def stream_archive(mgr, cnt_id, archive, extra_files={}, threads=None):
+    """
+    stream /home/user/src of the container as tar ('docker cp ... -') into
+    a gzip archive compressed by several threads, writing the checksum
+    manifest on the way. extra_files maps member names to contents.
+    Returns (files, bytes in, bytes out).
+    """
+    cmd = "docker cp %s:%s -" % (cnt_id, SRC_DIR)
+    logging.debug("streaming %s to %s", cmd, archive)
+    digests = {}
+    tmp = archive + ".tmp"
+    with mgr.admission.admit(cmd):
+        p = subprocess.Popen(shlex.split(cmd), stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE, bufsize=1 << 20)
+        try:
+            try:
+                with open(tmp, "wb") as f:
+                    gz = ParallelGzipWriter(f, threads)
+                    try:
+                        src = tarfile.open(fileobj=p.stdout, mode="r|")
+                        dst = tarfile.open(fileobj=gz, mode="w|", format=tarfile.PAX_FORMAT)
+                        for info in src:
+                            if info.isreg():
+                                reader = HashingReader(src.extractfile(info))
+                                dst.addfile(info, reader)
+                                digests[info.name] = reader.sha256.hexdigest()
+                            else:
+                                dst.addfile(info)
+                        for name in sorted(extra_files):
+                            info = tarfile.TarInfo(name)
+                            info.size = len(extra_files[name])
+                            info.mtime = time.time()
+                            dst.addfile(info, StringIO.StringIO(extra_files[name]))
+                            digests[name] = hashlib.sha256(extra_files[name]).hexdigest()
+                        dst.close()
+                        src.close()
+                    finally:
+                        gz.close()
+            finally:
+                # docker cp may still be writing if the tar stream was broken
+                p.stdout.close()
+                err = p.stderr.read()
+                p.wait()
+        except:
+            if os.path.isfile(tmp):
+                os.unlink(tmp)
+            raise
+
+    if p.returncode != 0:
+        os.unlink(tmp)
+        raise IOError("%s failed: %s" % (cmd, err.strip()))
+
+    os.rename(tmp, archive)
+    write_manifest(archive, digests)
+    return (len(digests), gz.bytes_in, gz.bytes_out)
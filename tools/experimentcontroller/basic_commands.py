@@ -6,29 +6,106 @@ import shlex
 import time
 import re
 import tempfile
+import json
 import logging
 import time
+import tarfile
+import socket
+import xmlrpclib
+import glob
+import threading
 
 from commandline import Command
-from experiment import Experiment
+from experiment import Experiment, SLOT_DONE
+from chunkstore import ChunkStore, CHUNK_STORE_DIR
+import resources
+import metrics
+import recording
+import archiver
+import checkpoint
+import eventloop
 
 
 EDITOR_CNT_IMAGE = "experiment-editor:xenial"
 
+DEFAULT_IMAGE_PREFIX = "bernhard97"
+
+# digests the images are pinned to once they have been pulled
+IMAGE_PINS = "image_pins.json"
+# pull_images and the image scheduler update the pins concurrently
+PINS_LOCK = threading.Lock()
+
+# environment variable with the default registry mirror for pull_images
+REGISTRY_MIRROR_ENV = "EXPCTR_REGISTRY_MIRROR"
+
+
+def get_required_images(mgr):
+    """
+    return the editor image and all task images (without repo prefix)
+    """
+    images = []
+    images.append(EDITOR_CNT_IMAGE)
+    images.extend(mgr.display.images())
+    for task in mgr.get_tasks().values():
+        if hasattr(task, 'cnt_image') and not task.cnt_image in images:
+            images.append(task.cnt_image)
+    return images
+
+
+def editor_create_cmd(name, display_opts, resource_opts, devmode=False,
+        src_volume=None):
+    """
+    return the 'docker create' command line of an editor container, the
+    sources are taken from src_volume if given (overlay storage).
+    display_opts come from the display backend (display.py)
+    """
+    # start container as root, we will switch witin the init script
+    #docker_cmd = "docker run -d"
+    docker_cmd = "docker create"
+    docker_cmd += " --name %s" % name
+    docker_cmd += display_opts
+    docker_cmd += resource_opts
+
+    if devmode:
+        docker_cmd += " -v %s:/home/user/src" % os.path.abspath(
+                os.path.join(os.path.dirname(__file__), "../../experiments")
+                )
+    elif src_volume:
+        # the overlay already shows the skeleton, don't copy the image's files
+        docker_cmd += " -v %s:/home/user/src:nocopy" % src_volume
+    else:
+        docker_cmd += " -v /home/user/src"
+
+    docker_cmd += " " + EDITOR_CNT_IMAGE
+    return docker_cmd
+
+
 class ExecCommand(Command):
     def __init__(self, mgr):
         self.set_mgr(mgr)
 
-    def exec_cmd(self, command, silent=False):
+    def exec_cmd(self, command, silent=False, agent=None, priority=None):
+        """
+        run command, on the agent host of the current experiment in
+        coordinator mode (or on the given agent)
+        """
         logging.debug("running command: %s", command)
         if self.mgr.devmode:
             print "running command: %s" % command
 
+        if agent == None:
+            agent = self.mgr.get_agent()
+        if agent != None:
+            return self.exec_agent_cmd(agent, command, silent)
+
         cmd = shlex.split(command)
 
         try:
-            p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            out, err = p.communicate()
+            start = time.time()
+            with self.mgr.admission.admit(cmd, priority):
+                p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                out, err = p.communicate()
+            self.observe_op(cmd, time.time() - start)
             logging.debug("command exited: returncode: %s, stdout: '%s', stderr: '%s'",
                     p.returncode, out, err)
 
@@ -47,6 +124,81 @@ class ExecCommand(Command):
 
         return (None, -1)
 
+    def exec_cmd_async(self, command, silent=False, agent=None, priority=None):
+        """
+        coroutine version of exec_cmd, results in (stdout, returncode)
+        """
+        logging.debug("running command: %s", command)
+        if self.mgr.devmode:
+            print "running command: %s" % command
+
+        loop = eventloop.get_loop()
+        if agent == None:
+            agent = self.mgr.get_agent()
+        if agent != None:
+            # xmlrpc blocks, the call gets a thread
+            result = yield loop.run_in_thread(self.exec_agent_cmd, agent, command, silent)
+            raise eventloop.Return(result)
+
+        cmd = shlex.split(command)
+
+        try:
+            start = time.time()
+            adm = yield self.admit_async(cmd, priority)
+            try:
+                out, err, ret = yield eventloop.run_process(loop, cmd)
+            finally:
+                adm.release()
+            self.observe_op(cmd, time.time() - start)
+            logging.debug("command exited: returncode: %s, stdout: '%s', stderr: '%s'",
+                    ret, out, err)
+
+            if ret != 0:
+                logging.error("error running command: %s", command)
+                if not silent:
+                    self.mgr.cmdline.notify("error running command:\n%s" % err)
+
+            raise eventloop.Return((out, ret))
+        except (OSError, ValueError), err:
+            logging.error("error running command: %s", err)
+            if not silent:
+                self.mgr.cmdline.notify("error running command:\n%s" % err)
+
+        raise eventloop.Return((None, -1))
+
+    def admit_async(self, cmd, priority=None):
+        """
+        wait for the admission of cmd on the event loop instead of sleeping,
+        yield it to get the Admission
+        """
+        return self.mgr.admission.admit_async(cmd, priority)
+
+    def observe_op(self, cmd, seconds):
+        op = self.mgr.admission.classify(cmd)
+        if op != None:
+            metrics.CONTAINER_OPS.observe(seconds, op=op)
+
+    def exec_agent_cmd(self, agent, command, silent):
+        try:
+            start = time.time()
+            out, err, ret = agent.exec_cmd(command)
+            self.observe_op(command, time.time() - start)
+        except (socket.error, xmlrpclib.Error), err:
+            logging.error("error running command on agent %s: %s", agent.name, err)
+            if not silent:
+                print "error running command on agent %s:" % agent.name
+                print err
+            return (None, -1)
+
+        logging.debug("command exited on agent %s: returncode: %s, stdout: '%s', stderr: '%s'",
+                agent.name, ret, out, err)
+        if ret != 0:
+            logging.error("error running command: %s", command)
+            if not silent:
+                print "error running command:"
+                print err
+        return (out, ret)
+
 class QuitControler(Command):
     def __init__(self, mgr):
         self.set_mgr(mgr)
@@ -103,75 +255,176 @@ class NewExperiment(ExecCommand):
             return
 
         ## raises exception if group is invalid
-        tasks = self.mgr.get_tasks_for_group(group)
-        experiment = Experiment(group, user_name, tasks)
+        plan = self.mgr.get_plan(group)
+        tasks = plan.tasks
+        experiment = Experiment(group, user_name, plan)
 
         logging.info("starting new experiment for %s, group: %s", user_name, group)
         print "starting new experiment for user: {}, group: {}".format(user_name, group)
-        # ensure we have access to the local display
-        self.exec_cmd("xhost +local:", silent=True)
+
+        xauth_file = self.mgr.probes.value("xauth")
+        display = os.environ.get('DISPLAY')
+
+        agent = None
+        if self.mgr.coordinator != None:
+            agent = self.mgr.coordinator.place(
+                    resources.seat_name(group, user_name),
+                    [EDITOR_CNT_IMAGE] + [t.cnt_image for t in tasks
+                        if hasattr(t, 'cnt_image')])
+            if agent == None:
+                print "error: no agent host available"
+                return False
+            print "placing experiment on agent host {}".format(agent.name)
+            xauth_file = agent.info["xauth"]
+            display = agent.info["display"]
+            experiment.agent = agent
+
+        if agent == None:
+            probe_names = ["images", "selinux"]
+            if self.mgr.image_scheduler != None:
+                # missing images are being fetched, only the editor is needed now
+                probe_names = ["selinux"]
+                for image in [EDITOR_CNT_IMAGE] + self.mgr.display.images():
+                    if not self.mgr.image_scheduler.wait_for(image):
+                        self.release_seat(group, user_name)
+                        return False
+            for name in probe_names:
+                r = self.mgr.probes.get(name)
+                if not r.ok:
+                    print "warning: %s" % r.detail
 
         print 
         print "starting new editor container..."
 
-        # start container as root, we will switch witin the init script
-        #docker_cmd = "docker run -d"
-        docker_cmd = "docker create"
-        docker_cmd += " --name exp_%s_%s" % (group, user_name)
-        # volume mount for X11 socket, if local X-display is used
-        docker_cmd += " -v /tmp/.X11-unix:/tmp/.X11-unix"
-
-        # ssh forwarded connection require the xauth mechanism
-        xauth_file = "%s/.Xauthority" % os.environ['HOME']
-        if os.path.isfile(xauth_file):
-            docker_cmd += " -v %s:/tmp/.xauth" % xauth_file
-
-        docker_cmd += " -e DISPLAY=%s" % os.environ['DISPLAY']
-        # if we use a X11 display over network (ssh)
-        docker_cmd += " --net=\"host\""
+        seat = resources.seat_name(group, user_name)
+        backend = self.mgr.display
+        if not backend.prepare(seat, agent):
+            print "could not set up the %s display" % backend.name
+            self.release_seat(group, user_name, agent)
+            return False
+        resumed = False
+        cnt_id = None
+        if agent == None:
+            cnt_id, resumed = self.resume_container(seat)
+            if cnt_id == False:
+                print "could not start editor container"
+                self.release_seat(group, user_name)
+                return False
+            if cnt_id == None and self.mgr.editor_pool != None:
+                cnt_id = self.mgr.editor_pool.claim(seat, display)
+                if cnt_id != None:
+                    print "using pre-started editor container"
+                    backend.setup(cnt_id, xauth_file, None)
+                    experiment.cnt_id = cnt_id
+                    self.mgr.start_experiment(experiment)
+                    return True
+
+        if resumed:
+            print "resuming the existing editor container"
+            experiment.cnt_id = cnt_id
+            self.mgr.start_experiment(experiment)
+            self.show_address(seat, agent)
+            return True
 
-        if self.mgr.devmode:
-            docker_cmd += " -v %s:/home/user/src" % os.path.abspath(
-                    os.path.join(os.path.dirname(__file__), "../../experiments")
-                    )
-        else:
-            docker_cmd += " -v /home/user/src"
+        src_volume = None
+        if self.mgr.storage != None and agent == None and not self.mgr.devmode:
+            src_volume = self.mgr.storage.create_volume(seat)
+            if src_volume == None:
+                print "could not create the source overlay, using a full copy"
 
-        docker_cmd += " " + EDITOR_CNT_IMAGE
+        docker_cmd = editor_create_cmd("exp_%s" % seat,
+                backend.create_opts(seat, display, xauth_file),
+                resources.docker_opts(self.mgr.resource_profile, seat),
+                self.mgr.devmode, src_volume)
 
         # run the docker_cmd command
-        out, ret = self.exec_cmd(docker_cmd)
-        cnt_id = out.strip()
+        out, ret = self.exec_cmd(docker_cmd, agent=agent)
+        cnt_id = (out or "").strip()
         if ret == 0:
             logging.debug("got editor container id: %s", cnt_id)
             if self.mgr.devmode:
                 print "id: %s" % cnt_id
 
-            # on CentOS, the xauth file has selinux label attached, thus the 
-            # container is not able to read it, therefore, try to copy it into
-            # the container directly
-            # Note: this work only for docker > 1.8
-            if os.path.isfile(xauth_file):
-                out, ret = self.exec_cmd("docker cp %s %s:/home/user/.Xauthority" % (xauth_file, cnt_id), silent=True)
+            backend.setup(cnt_id, xauth_file, agent)
 
-            out, ret = self.exec_cmd("docker start %s" % cnt_id)
+            out, ret = self.exec_cmd("docker start %s" % cnt_id, agent=agent)
             if ret != 0:
                 logging.error("error starting editor container")
+                self.release_seat(group, user_name, agent)
                 return False
 
             # everything worked as expected, set container id and experiment
             experiment.cnt_id = cnt_id
             logging.debug("about to start experiment")
             self.mgr.start_experiment(experiment)
+            self.show_address(seat, agent)
 
             return True
         else:
             logging.error("could not start experiment editor container")
             print "could not start editor container"
             print "maybe you have to choose a different 'user name'"
+            self.release_seat(group, user_name, agent)
 
         return False
 
+    def is_finished(self, seat):
+        """
+        finished commits the editor container as image exp_<seat> and
+        leaves a result tarball
+        """
+        out, ret = self.exec_cmd("docker image inspect --format '{{.Id}}' exp_%s" % seat,
+                silent=True)
+        if ret == 0:
+            return True
+        tarball = re.compile(r"^exp_%s_\d{8}_\d{6}\.tar\.gz$" % re.escape(seat))
+        return any([tarball.match(f) for f in glob.glob("exp_%s_*.tar.gz" % seat)])
+
+    def resume_container(self, seat):
+        """
+        start the stopped editor container of an unfinished seat again if
+        the operator agrees. Returns (container id, True) if resumed,
+        (None, False) if there is no such container and (False, False) if
+        it can't be used
+        """
+        out, ret = self.exec_cmd("docker inspect --format '{{.Id}} {{.State.Running}}' exp_%s" % seat,
+                silent=True)
+        if ret != 0 or not out:
+            return (None, False)
+        cnt_id, running = out.split()
+        if running == "true":
+            logging.info("editor container of %s already running", seat)
+            print "an editor container for this user is already running"
+            print "maybe you have to choose a different 'user name'"
+            return (False, False)
+
+        if self.is_finished(seat):
+            logging.info("experiment of %s finished already, not resuming", seat)
+            print "the experiment of this user is finished already"
+            print "maybe you have to choose a different 'user name'"
+            return (False, False)
+
+        if not self.yes_no_question("a stopped editor container of this user exists, resume it"):
+            logging.info("resuming editor container of %s declined", seat)
+            print "choose a different 'user name' or remove the container exp_%s" % seat
+            return (False, False)
+
+        logging.info("resuming stopped editor container of %s", seat)
+        out, ret = self.exec_cmd("docker start %s" % cnt_id)
+        if ret != 0:
+            return (False, False)
+        return (cnt_id, True)
+
+    def show_address(self, seat, agent):
+        address = self.mgr.display.address(seat, agent)
+        if address != None:
+            print "open the editor at %s" % address
+
+    def release_seat(self, group, user_name, agent=None):
+        self.mgr.display.stop(resources.seat_name(group, user_name), agent)
+        if self.mgr.coordinator != None:
+            self.mgr.coordinator.release(resources.seat_name(group, user_name))
+
 
 class AbortExperiment(ExecCommand):
     def __init__(self, mgr):
@@ -188,9 +441,17 @@ class AbortExperiment(ExecCommand):
         if not self.yes_no_question("Do you really want to quit the running experiment?"):
             return
 
+        exp = self.mgr.get_experiment()
+        if self.mgr.checkpointer != None:
+            # the session can be restored with 'checkpoints <seat> restore'
+            print "saving a last checkpoint..."
+            self.mgr.checkpointer.flush(exp)
+
         logging.debug("killing editor container")
         print "stopping editor container..."
         out, ret = self.exec_cmd("docker kill %s" % self.mgr.get_editor_container_id())
+        self.mgr.display.stop(resources.seat_name(exp.group_name, exp.user_name),
+                self.mgr.get_agent())
         #self.mgr.set_editor_container_id(None)
         self.mgr.stop_experiment()
 
@@ -213,10 +474,13 @@ class Start(Command):
 
         exp = self.mgr.get_experiment()
         task = None
-        if exp.get_current_task():
+        if exp.get_current_task() and exp.get_current_task_status() != SLOT_DONE:
             logging.info("experiment already running, continuing with last task")
             print "experiment already started, continuing with current task..."
-            task = exp.get_current_task()
+            task = exp.redo()
+        elif exp.get_current_task():
+            logging.info("continuing after task %s", exp.get_current_task().id)
+            task = exp.next_task()
         else:
             logging.info("starting with first task")
             task = exp.next_task()
@@ -260,15 +524,26 @@ class FinishExperiment(ExecCommand):
         if not self.yes_no_question("Are you sure you have done all your tasks?"):
             return
 
+        agent = self.mgr.get_agent()
+
         print "saving logs..."
         cnt_logs = tempfile.NamedTemporaryFile()
         try:
             out, ret = self.exec_cmd("docker logs -t %s" % self.mgr.get_editor_container_id())
-            cnt_logs.write(out)
+            logs = out or ""
+            cnt_logs.write(logs)
             cnt_logs.flush()
 
-            self.exec_cmd("docker cp {} {}:/var/log/experiment_container.log".format(cnt_logs.name, 
+            logs_file = cnt_logs.name
+            if agent != None:
+                logs_file = agent.temp_file(".log")
+                agent.put_file(logs_file, cnt_logs.name)
+
+            self.exec_cmd("docker cp {} {}:/var/log/experiment_container.log".format(logs_file,
                 self.mgr.get_editor_container_id()))
+
+            if agent != None:
+                agent.remove_file(logs_file)
         finally:
             cnt_logs.close()
 
@@ -277,15 +552,89 @@ class FinishExperiment(ExecCommand):
                 time.strftime("%Y%m%d_%H%M%S")
                 )
         print "saving sources to {} ...".format(src_tarball)
-        out, err = self.exec_cmd(
-                "docker exec -ti {} /bin/build_src_tarball.sh '/root/{}'".format(
-                    self.mgr.get_editor_container_id(), src_tarball)
-                )
+        archive_start = time.time()
+        exported = False
+        if self.mgr.checkpointer != None and agent == None:
+            # most of the sources are checkpointed already, only the last
+            # changes are read from the container
+            path = self.mgr.checkpointer.flush(exp, seal=True)
+            if path != None:
+                try:
+                    files = checkpoint.write_tarball(path, src_tarball,
+                            {"experiment_container.log": logs})
+                    print "{} files from the checkpoints in {}".format(files, path)
+                    exported = True
+                except (IOError, OSError, tarfile.TarError), err:
+                    logging.error("building %s from %s failed: %s", src_tarball,
+                            path, err)
+
+        if not exported and self.mgr.storage != None and agent == None:
+            # read from the overlay's layers on the host
+            try:
+                exported = self.mgr.storage.export(self.mgr.get_editor_container_id(),
+                        src_tarball, {"experiment_container.log": logs})
+            except (IOError, OSError, tarfile.TarError), err:
+                logging.error("exporting the overlay failed: %s", err)
+
+        if not exported and agent == None:
+            # tar stream straight out of the container, compressed here
+            try:
+                files, size, compressed = archiver.stream_archive(self.mgr,
+                        self.mgr.get_editor_container_id(), src_tarball,
+                        {"experiment_container.log": logs})
+                problems = archiver.verify(src_tarball)
+                for p in problems:
+                    logging.error("archive %s: %s", src_tarball, p)
+                if problems:
+                    print "error: {} does not match its checksums".format(src_tarball)
+                else:
+                    print "{} files, {:.1f} MiB compressed to {:.1f} MiB, checksums in {}".format(
+                            files, size / 1048576.0, compressed / 1048576.0,
+                            archiver.manifest_path(src_tarball))
+                exported = True
+            except (IOError, OSError, tarfile.TarError), err:
+                logging.error("streaming the sources failed: %s", err)
+                print "streaming the sources failed, building the tarball in the container"
+
+        if not exported:
+            out, err = self.exec_cmd(
+                    "docker exec -ti {} /bin/build_src_tarball.sh '/root/{}'".format(
+                        self.mgr.get_editor_container_id(), src_tarball)
+                    )
 
-        out, err = self.exec_cmd(
-                "docker cp {}:/root/{} {}".format(
-                    self.mgr.get_editor_container_id(), src_tarball, src_tarball)
-                )
+            if agent == None:
+                out, err = self.exec_cmd(
+                        "docker cp {}:/root/{} {}".format(
+                            self.mgr.get_editor_container_id(), src_tarball, src_tarball)
+                        )
+            else:
+                remote_tarball = agent.temp_file(".tar.gz")
+                out, err = self.exec_cmd(
+                        "docker cp {}:/root/{} {}".format(
+                            self.mgr.get_editor_container_id(), src_tarball, remote_tarball)
+                        )
+                agent.get_file(remote_tarball, src_tarball)
+                agent.remove_file(remote_tarball)
+
+        if os.path.isfile(src_tarball):
+            metrics.observe_transfer("archive", os.path.getsize(src_tarball),
+                    time.time() - archive_start)
+            print "adding sources to the archive store..."
+            try:
+                manifest, new_bytes = ChunkStore().store_archive(src_tarball)
+                print "{} new bytes stored in {}".format(new_bytes, CHUNK_STORE_DIR)
+            except (IOError, OSError, tarfile.TarError), err:
+                logging.error("error adding %s to the archive store: %s",
+                        src_tarball, err)
+                print "could not add sources to the archive store: {}".format(err)
+
+            if self.mgr.uploader != None:
+                meta = {"group": exp.group_name, "user": exp.user_name}
+                self.mgr.uploader.enqueue(src_tarball, meta)
+                for path in sorted(glob.glob(os.path.join(recording.RECORDING_DIR,
+                        resources.seat_name(exp.group_name, exp.user_name), "*.cast.gz"))):
+                    self.mgr.uploader.enqueue(path, meta)
+                print "results queued for upload, see 'uploads'"
 
         print "stopping editor container..."
         out, ret = self.exec_cmd("docker kill %s" % self.mgr.get_editor_container_id())
@@ -296,6 +645,8 @@ class FinishExperiment(ExecCommand):
             exp.group_name,
             exp.user_name))
         print out
+        self.mgr.display.stop(resources.seat_name(exp.group_name, exp.user_name),
+                agent)
         self.mgr.stop_experiment()
 
 
@@ -306,6 +657,10 @@ class StartTask(Command):
     def get_keyword(self):
         return "start_task"
 
+    def help_msg(self):
+        return "%s: [task]   task ids repeated in the plan are selected by <id>@<n>" % (
+                self.get_keyword())
+
     def complete_cmd(self, args):
         # only complete first argument
         if len(args) == 1 and self.mgr.is_started():
@@ -329,79 +684,264 @@ class StartTask(Command):
         # without arguments task first task
         if not args:
             logging.debug("starting with first task")
-            task_id = task_ids[0]
+            pos = 0
         else:
-            if not args[0] in task_ids:
+            try:
+                pos = exp.resolve(args[0])
+            except NameError:
                 logging.error("task %s not defined for group %s", args[0], exp.group_name)
                 print "task '%s' not defined for group %s" % (args[0],
                         exp.group_name)
                 return
-            task_id = args[0]
-            logging.debug("about to start task %s", task_id)
+            logging.debug("about to start task %s (slot %d)", args[0], pos)
 
-        exp.set_current_task_id(task_id)
-        task = exp.get_current_task()
+        task = exp.seek(pos)
 
         task.start(self.mgr.get_editor_container_id())
+        exp.finish_current()
 
 
 class PullImages(ExecCommand):
-    def __init__(self, mgr):
+    def __init__(self, mgr, quiet=False, background=False):
         self.set_mgr(mgr)
+        # background pulls (image scheduler) only log
+        self.quiet = quiet
+        # pulls in a background job of the async command line notify
+        self.background = background
 
     def get_keyword(self):
         return "pull_images"
 
     def help_msg(self):
-        return "%s: [image repo/prefix]\n" \
-               "    default prefix: 'bernhard97'" % self.get_keyword()
+        return "%s: [image repo/prefix] [--mirror=<registry>] [--update]\n" \
+               "    default prefix: '%s'\n" \
+               "    --mirror: try this registry (mirror) first, default: $%s\n" \
+               "    --update: resolve the pinned image digests again" % (
+                       self.get_keyword(), DEFAULT_IMAGE_PREFIX, REGISTRY_MIRROR_ENV)
+
+    def get_tag_flags(self):
+        return self.mgr.probes.value("tag_force")
+
+    def load_pins(self):
+        if os.path.isfile(IMAGE_PINS):
+            try:
+                with open(IMAGE_PINS) as f:
+                    return json.load(f)
+            except ValueError, err:
+                logging.error("ignoring invalid %s: %s", IMAGE_PINS, err)
+        return {}
+
+    def save_pins(self, pins):
+        with open(IMAGE_PINS + ".tmp", "w") as f:
+            json.dump(pins, f, indent=1, sort_keys=True)
+        os.rename(IMAGE_PINS + ".tmp", IMAGE_PINS)
+
+    def update_pins(self, pins, loaded):
+        """
+        save the pins that changed since loaded was read, merged into the
+        saved ones: other pulls may have pinned their images meanwhile
+        """
+        with PINS_LOCK:
+            saved = self.load_pins()
+            for image, pin in pins.items():
+                if loaded.get(image) != pin:
+                    saved[image] = pin
+            self.save_pins(saved)
+
+    def resolve_digest_async(self, repo_image):
+        """
+        coroutine resulting in the registry digest of a locally available image
+        """
+        out, ret = yield self.exec_cmd_async(
+                "docker inspect --format '{{json .RepoDigests}}' %s" % repo_image,
+                silent=True)
+        if ret != 0:
+            raise eventloop.Return(None)
+        try:
+            # null for locally built or retagged images
+            digests = json.loads(out) or []
+        except ValueError:
+            logging.error("unexpected RepoDigests of %s: %s", repo_image, out)
+            raise eventloop.Return(None)
+        repo = repo_image.rsplit(":", 1)[0]
+        for d in digests:
+            if d.split("@")[0] == repo:
+                raise eventloop.Return(d.split("@")[1])
+        raise eventloop.Return(None)
+
+    def say(self, msg):
+        if self.background:
+            self.mgr.cmdline.notify(msg)
+        elif not self.quiet:
+            print msg
+
+    def pull_async(self, ref):
+        docker_cmd = "docker pull {}".format(ref)
+        self.say("pulling image %s ..." % ref)
+        logging.debug("running command: %s", docker_cmd)
+        if self.quiet or self.background:
+            out, ret = yield self.exec_cmd_async(docker_cmd, silent=True)
+            raise eventloop.Return(ret == 0)
+        # docker's progress output needs the terminal, only blocking callers
+        # get here (on a private loop)
+        with self.mgr.admission.admit(docker_cmd):
+            ret = os.system(docker_cmd)
+        raise eventloop.Return(ret == 0)
+
+    def pull_image_async(self, image, prefix, mirror, pins):
+        """
+        coroutine making image available locally, pins is updated with the
+        image's digest. Results in True on success
+        """
+        loop = eventloop.get_loop()
+        # the probe may run docker, not on the loop
+        tag_flags = yield loop.run_in_thread(self.get_tag_flags)
+        repo_image = "{}/{}".format(prefix, image)
+        repo = repo_image.rsplit(":", 1)[0]
+        pin = pins.get(image)
+        if pin != None and pin.get("repo") != repo:
+            pin = None
+
+        if pin != None:
+            ref = "{}@{}".format(repo, pin["digest"])
+            # the pinned digest is already here, no registry access at all
+            out, ret = yield self.exec_cmd_async("docker inspect --format '{{.Id}}' %s" % ref,
+                    silent=True)
+            if ret == 0:
+                logging.debug("image %s already present as %s", image, ref)
+                self.say("image %s is up to date (%s)" % (image, pin["digest"][:19]))
+                yield self.exec_cmd_async("docker tag {} {} {}".format(
+                    tag_flags, ref, image), silent=self.quiet)
+                raise eventloop.Return(True)
+        else:
+            ref = repo_image
+
+        start = time.time()
+        pulled = None
+        if mirror:
+            mirror_ref = "{}/{}".format(mirror, ref)
+            ok = yield self.pull_async(mirror_ref)
+            if ok:
+                pulled = mirror_ref
+            else:
+                logging.info("image %s not available on mirror %s", ref, mirror)
+                self.say("mirror failed, falling back to %s" % prefix)
+        if pulled == None:
+            ok = yield self.pull_async(ref)
+            if ok:
+                pulled = ref
+
+        if pulled == None:
+            logging.error("failed pulling image %s", ref)
+            self.say("error pulling image {}".format(ref))
+            raise eventloop.Return(False)
+
+        logging.debug("successfully pulled image %s", pulled)
+        out, ret = yield self.exec_cmd_async("docker inspect --format '{{.Size}}' %s" % pulled,
+                silent=True)
+        if ret == 0:
+            metrics.observe_transfer("pull", int(out.strip()), time.time() - start)
+        # tag the image, so do not have to take care of the repo prefix
+        yield self.exec_cmd_async("docker tag {} {} {}".format(tag_flags, pulled, image),
+                silent=self.quiet)
+
+        if pin == None:
+            digest = yield self.resolve_digest_async(pulled)
+            if digest != None:
+                pins[image] = {"repo": repo, "digest": digest}
+                logging.info("pinned image %s to %s", image, digest)
+        raise eventloop.Return(True)
+
+    def pull_image(self, image, prefix, mirror, pins):
+        """
+        blocking pull_image_async() for callers without an event loop
+        """
+        return eventloop.run(self.pull_image_async(image, prefix, mirror, pins))
+
+    def parse_args(self, args):
+        """
+        (prefix, mirror, update) of the command's arguments, None if invalid
+        """
+        prefix = DEFAULT_IMAGE_PREFIX
+        mirror = os.environ.get(REGISTRY_MIRROR_ENV)
+        update = False
+
+        positional = []
+        for a in args:
+            if a.startswith("--mirror="):
+                mirror = a[len("--mirror="):]
+            elif a == "--update":
+                update = True
+            else:
+                positional.append(a)
+
+        if len(positional) > 1:
+            return None
+        elif len(positional) == 1:
+            prefix = positional[0]
+        return (prefix, mirror, update)
+
+    def run_async(self, args):
+        parsed = self.parse_args(args)
+        if parsed == None:
+            # run() prints the usage
+            return None
+        return PullImages(self.mgr, background=True).pull_all(*parsed)
+
+    def pull_all(self, prefix, mirror, update):
+        """
+        coroutine pulling all images concurrently, admission control limits
+        how many pulls run at the same time
+        """
+        loop = eventloop.get_loop()
+        images = get_required_images(self.mgr)
+
+        logging.debug("pulling the following images with prefix %s (mirror %s): %s" % (
+            prefix, mirror, images))
+
+        loaded = {} if update else self.load_pins()
+        pins = dict(loaded)
+        jobs = [loop.spawn(self.pull_image_async(image, prefix, mirror, pins), "pull")
+                for image in images]
+        success = True
+        for job in jobs:
+            ok = yield job
+            if not ok:
+                success = False
 
-    def run(self, args):
-        prefix = "bernhard97"
+        self.update_pins(pins, loaded)
+        self.mgr.probes.invalidate("images")
+
+        if success != True:
+            self.say("one or more images couldn't be pulled, please try again")
+        else:
+            self.say("%d image(s) pulled" % len(images))
+        raise eventloop.Return(success)
 
-        if len(args) > 1:
+    def run(self, args):
+        parsed = self.parse_args(args)
+        if parsed == None:
             print self.help_msg()
             return False
-        elif len(args) == 1:
-            prefix = args[0]
+        prefix, mirror, update = parsed
 
-        images = []
-        images.append(EDITOR_CNT_IMAGE)
-        for task in self.mgr.get_tasks().values():
-            if hasattr(task, 'cnt_image') and not task.cnt_image in images:
-                images.append(task.cnt_image)
+        images = get_required_images(self.mgr)
 
-        logging.debug("pulling the following images with prefix %s: %s" % (prefix, images))
+        logging.debug("pulling the following images with prefix %s (mirror %s): %s" % (
+            prefix, mirror, images))
 
-        tag_flags = ""
-        out, ret = self.exec_cmd("docker help tag")
-        if ret == 0:
-            if "--force" in out:
-                tag_flags = "--force"
-        else:
-            logging.error("error running docker help tag, using 'tag' without '--force' flag")
+        loaded = {} if update else self.load_pins()
+        pins = dict(loaded)
 
         success = True
         for image in images:
-            repo_image = "{}/{}".format(prefix, image)
-            docker_cmd = "docker pull {}".format(repo_image)
-
-            print "pulling image %s ..." % repo_image
-            logging.debug("running command: %s", docker_cmd)
-            ret = os.system(docker_cmd)
-            if ret != 0:
+            if not self.pull_image(image, prefix, mirror, pins):
                 success = False
-                logging.error("failed pulling image %s", repo_image)
-                print "error pulling image {}".format(repo_image)
-            else:
-                logging.debug("successfully pulled image %s", repo_image)
-                # tag the image, so do not have to take care of the repo prefix
-                self.exec_cmd("docker tag {} {} {}".format(tag_flags, repo_image, image))
             print
 
+        self.update_pins(pins, loaded)
+        self.mgr.probes.invalidate("images")
+
         if success != True:
             print "one or more images couldn't be pulled, please try again"
-
-
-
-
+        return success
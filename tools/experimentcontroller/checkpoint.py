@@ -0,0 +1,388 @@
+#!/usr/bin/env python2.7
+
+import os
+import json
+import time
+import shlex
+import hashlib
+import tarfile
+import logging
+import StringIO
+import threading
+import subprocess
+
+from commandline import Command
+import resources
+import archiver
+import scheduler
+
+
+# checkpoints/<seat>/ holds the versioned checkpoints of a seat
+CHECKPOINT_DIR = "checkpoints"
+
+# seconds between two checkpoints of the running seat, 0 disables them
+# (opt-in with --checkpoints=<seconds>)
+CHECKPOINT_INTERVAL = 0
+
+# a checkpoint may use at most this share of the wall clock time, the next
+# one is delayed accordingly if a capture was slow
+CHECKPOINT_DUTY = 0.1
+
+# bytes per second read from the editor container
+CHECKPOINT_RATE = 2 << 20
+
+# files changed this many seconds before the last capture are captured
+# again, files saved during a capture may be older than its start. The
+# ctime is compared, renamed and copied files (cp -p, mv) keep their mtime
+CTIME_SLACK = 2
+
+SRC_DIR = "/home/user/src"
+INDEX = "index.json"
+
+
+class RateLimitedReader(object):
+    """
+    file like object reading at most rate bytes per second
+    """
+
+    def __init__(self, fileobj, rate):
+        self.fileobj = fileobj
+        self.rate = rate
+        self.start = time.time()
+        self.bytes = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.bytes += len(data)
+        ahead = self.bytes / float(self.rate) - (time.time() - self.start)
+        if ahead > 0:
+            time.sleep(ahead)
+        return data
+
+
+def seat_dir(seat):
+    return os.path.join(CHECKPOINT_DIR, seat)
+
+
+def load_index(path):
+    with open(os.path.join(path, INDEX)) as f:
+        return json.load(f)
+
+
+def save_index(path, index):
+    tmp = os.path.join(path, INDEX + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+    os.rename(tmp, os.path.join(path, INDEX))
+
+
+def delta_path(path, n):
+    return os.path.join(path, "%06d.tar.gz" % n)
+
+
+def latest_files(path):
+    """
+    {member name: delta number} of the newest version of every source file
+    of a seat, files deleted since are left out. Raises IOError if a file of
+    the last listing is in none of the deltas.
+    """
+    index = load_index(path)
+    newest = {}
+    listing = None
+    for entry in index["checkpoints"]:
+        tar = tarfile.open(delta_path(path, entry["n"]), "r:gz")
+        try:
+            for info in tar:
+                if info.name.startswith("src/") and info.isreg():
+                    newest[info.name] = entry["n"]
+                elif info.name == "meta/files.txt":
+                    listing = tar.extractfile(info).read().splitlines()
+        finally:
+            tar.close()
+    if listing == None:
+        raise IOError("no file listing in the checkpoints of %s" % path)
+    present = set(["src/" + os.path.normpath(f) for f in listing if f])
+    missing = present.difference(newest)
+    if missing:
+        raise IOError("%d file(s) of %s are not in the checkpoints, e.g. %s" % (
+            len(missing), path, sorted(missing)[0]))
+    return dict([(k, v) for k, v in newest.items() if k in present])
+
+
+def write_tarball(path, tarball, extra_files={}):
+    """
+    build the source tarball of a seat from its checkpoints, with a checksum
+    manifest like archiver.stream_archive. Returns the number of files,
+    raises IOError if the checkpoints are incomplete.
+    """
+    newest = latest_files(path)
+    by_delta = {}
+    for name, n in newest.items():
+        by_delta.setdefault(n, set()).add(name)
+
+    digests = {}
+    tmp = tarball + ".tmp"
+    out = tarfile.open(tmp, "w:gz", format=tarfile.PAX_FORMAT)
+    try:
+        for n in sorted(by_delta):
+            tar = tarfile.open(delta_path(path, n), "r:gz")
+            try:
+                for info in tar:
+                    if not info.name in by_delta[n]:
+                        continue
+                    reader = archiver.HashingReader(tar.extractfile(info))
+                    out.addfile(info, reader)
+                    digests[info.name] = reader.sha256.hexdigest()
+            finally:
+                tar.close()
+        for name in sorted(extra_files):
+            info = tarfile.TarInfo(name)
+            info.size = len(extra_files[name])
+            info.mtime = time.time()
+            out.addfile(info, StringIO.StringIO(extra_files[name]))
+            digests[name] = hashlib.sha256(extra_files[name]).hexdigest()
+    except:
+        out.close()
+        os.unlink(tmp)
+        raise
+    out.close()
+    os.rename(tmp, tarball)
+    archiver.write_manifest(tarball, digests)
+    return len(newest)
+
+
+class Checkpointer(object):
+    """
+    Captures the running seat in the background: the source files changed
+    since the last checkpoint, the new lines of the container log and the
+    experiment's timing state. Every checkpoint is a small delta archive in
+    checkpoints/<seat>/, numbered and listed in index.json. Captures run
+    niced, with background priority and at most CHECKPOINT_RATE bytes/s.
+    """
+
+    def __init__(self, mgr, interval, rate=CHECKPOINT_RATE):
+        self.mgr = mgr
+        self.interval = interval
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.thread = None
+        self.running = False
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.work, name="checkpointer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def work(self):
+        wait = self.interval
+        while self.running:
+            time.sleep(wait)
+            exp = self.mgr.get_experiment()
+            if exp == None or exp.cnt_id == None:
+                wait = self.interval
+                continue
+            start = time.time()
+            try:
+                self.checkpoint(exp)
+            except (IOError, OSError, ValueError, tarfile.TarError), err:
+                logging.error("checkpoint of %s_%s failed: %s", exp.group_name,
+                        exp.user_name, err)
+            # never more than CHECKPOINT_DUTY of the time
+            wait = max(self.interval, (time.time() - start) / CHECKPOINT_DUTY)
+
+    def open_seat(self, exp):
+        path = seat_dir(resources.seat_name(exp.group_name, exp.user_name))
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        if not os.path.isfile(os.path.join(path, INDEX)):
+            save_index(path, {"group": exp.group_name, "user": exp.user_name,
+                "container": exp.cnt_id, "sealed": None, "since": 0,
+                "checkpoints": []})
+        index = load_index(path)
+        if index["container"] != exp.cnt_id:
+            # a new editor container, its files are not in the deltas yet
+            index["container"] = exp.cnt_id
+            index["since"] = 0
+            index["sealed"] = None
+        return (path, index)
+
+    def state(self, exp):
+        task = exp.get_current_task()
+        index = exp.get_current_task_index()
+        return {
+            "time": time.time(),
+            "status": list(exp.status),
+            "current": exp.plan.labels[index] if index != None else None,
+            "task": task.id if task != None else None,
+            "attempt": getattr(task, "attempt", None),
+            "task_started": self.mgr.task_start_time,
+            }
+
+    def run(self, cmd, reader=None):
+        """
+        run a docker command at background priority, returns its stdout
+        (or "" if the callback reader consumes the output stream)
+        """
+        with self.mgr.admission.admit(cmd, scheduler.PRIO_BACKGROUND):
+            p = subprocess.Popen(shlex.split(cmd), stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE)
+            if reader != None:
+                try:
+                    reader(p.stdout)
+                finally:
+                    p.stdout.close()
+                    err = p.stderr.read()
+                    p.wait()
+                out = ""
+            else:
+                out, err = p.communicate()
+        if p.returncode != 0:
+            raise IOError("%s failed: %s" % (cmd, err.strip()))
+        return out
+
+    def checkpoint(self, exp, seal=False):
+        """
+        capture a delta of the seat of exp, returns the new checkpoint's
+        index entry or None if nothing changed
+        """
+        with self.lock:
+            path, index = self.open_seat(exp)
+            if index["sealed"] != None:
+                return None
+            start = time.time()
+            since = index["since"]
+            cnt = exp.cnt_id
+
+            listing = self.run("docker exec %s find %s -type f -printf '%%P\\n'" % (
+                cnt, SRC_DIR))
+            log = self.run("docker logs -t --since %d %s" % (since, cnt)) if since else \
+                    self.run("docker logs -t %s" % cnt)
+            state = self.state(exp)
+
+            n = len(index["checkpoints"]) + 1
+            tmp = delta_path(path, n) + ".tmp"
+            out = tarfile.open(tmp, "w:gz", format=tarfile.PAX_FORMAT)
+            counts = {"files": 0}
+            try:
+                def copy(stream):
+                    src = tarfile.open(fileobj=RateLimitedReader(stream, self.rate), mode="r|")
+                    for info in src:
+                        name = os.path.normpath(info.name)
+                        if not info.isreg() or name == ".":
+                            continue
+                        info.name = "src/" + name
+                        out.addfile(info, src.extractfile(info))
+                        counts["files"] += 1
+                    src.close()
+
+                # niced inside the container too, the participant's editor
+                # shares its CPU and disk
+                newer = "-newerct @%d" % (since - CTIME_SLACK) if since else ""
+                self.run("docker exec %s sh -c \"cd %s && find . -type f %s -print0 | "
+                        "nice -n 19 tar --null -T - -cf -\"" % (cnt, SRC_DIR, newer), copy)
+                for name, data in [("meta/files.txt", listing), ("meta/log.txt", log),
+                        ("meta/state.json", json.dumps(state, indent=1, sort_keys=True))]:
+                    info = tarfile.TarInfo(name)
+                    info.size = len(data)
+                    info.mtime = start
+                    out.addfile(info, StringIO.StringIO(data))
+            except:
+                out.close()
+                os.unlink(tmp)
+                raise
+            out.close()
+
+            if counts["files"] == 0 and not log and not seal and index["checkpoints"] and \
+                    index["checkpoints"][-1].get("status") == state["status"]:
+                os.unlink(tmp)
+                logging.debug("checkpoint of %s: nothing changed", path)
+                return None
+
+            os.rename(tmp, delta_path(path, n))
+            entry = {"n": n, "time": start, "since": since, "files": counts["files"],
+                    "bytes": os.path.getsize(delta_path(path, n)),
+                    "status": state["status"], "seconds": round(time.time() - start, 3)}
+            index["checkpoints"].append(entry)
+            index["since"] = int(start)
+            if seal:
+                index["sealed"] = time.time()
+            save_index(path, index)
+            logging.info("checkpoint %d of %s: %d file(s), %d bytes in %.2fs", n, path,
+                    entry["files"], entry["bytes"], entry["seconds"])
+            return entry
+
+    def flush(self, exp, seal=False):
+        """
+        capture the last delta right now (and seal the record), returns the
+        seat's checkpoint directory or None on errors
+        """
+        try:
+            self.checkpoint(exp, seal)
+            return seat_dir(resources.seat_name(exp.group_name, exp.user_name))
+        except (IOError, OSError, ValueError, tarfile.TarError), err:
+            logging.error("checkpoint of %s_%s failed: %s", exp.group_name,
+                    exp.user_name, err)
+            return None
+
+
+class Checkpoints(Command):
+    def __init__(self, mgr):
+        self.set_mgr(mgr)
+
+    def get_keyword(self):
+        return "checkpoints"
+
+    def desctiption(self):
+        return "list the background checkpoints of the seats, restore sources from them"
+
+    def help_msg(self):
+        return "%s: [seat [restore <tarball>]]" % self.get_keyword()
+
+    def complete_cmd(self, args):
+        if len(args) == 1 and os.path.isdir(CHECKPOINT_DIR):
+            return sorted(os.listdir(CHECKPOINT_DIR))
+        if len(args) == 2:
+            return ["restore"]
+        return []
+
+    def run(self, args):
+        if not args:
+            if not os.path.isdir(CHECKPOINT_DIR):
+                print "no checkpoints"
+                return
+            print "%-24s %5s %19s %s" % ("seat", "count", "last", "")
+            for seat in sorted(os.listdir(CHECKPOINT_DIR)):
+                try:
+                    index = load_index(seat_dir(seat))
+                except (IOError, ValueError):
+                    continue
+                cps = index["checkpoints"]
+                last = time.strftime("%Y-%m-%d %H:%M:%S",
+                        time.localtime(cps[-1]["time"])) if cps else "-"
+                print "%-24s %5d %19s %s" % (seat, len(cps), last,
+                        "sealed" if index["sealed"] else "")
+            return
+
+        path = seat_dir(args[0])
+        if not os.path.isfile(os.path.join(path, INDEX)):
+            print "no checkpoints of %s" % args[0]
+            return False
+
+        if len(args) == 3 and args[1] == "restore":
+            try:
+                files = write_tarball(path, args[2])
+            except (IOError, OSError, tarfile.TarError), err:
+                print "could not restore the sources: %s" % err
+                return False
+            print "%d files written to %s" % (files, args[2])
+            return True
+        elif len(args) != 1:
+            print self.help_msg()
+            return False
+
+        index = load_index(path)
+        for e in index["checkpoints"]:
+            print "%6d %s %5d file(s) %10d bytes %6.2fs" % (e["n"],
+                    time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(e["time"])),
+                    e["files"], e["bytes"], e["seconds"])
@@ -0,0 +1,399 @@
+#!/usr/bin/env python2.7
+
+import os
+import gzip
+import errno
+import json
+import time
+import zlib
+import base64
+import struct
+import hashlib
+import tarfile
+import logging
+import tempfile
+
+from commandline import Command
+from pgzip import ParallelGzipWriter, BLOCK_SIZE
+
+
+# content addressed store shared by all controllers on this host
+CHUNK_STORE_DIR = os.environ.get("EXPCTR_STORE", "/var/tmp/expctr-store")
+
+# the store is shared between the users running controllers: they have to be
+# members of the store directory's group (e.g. "chgrp expctr <store>" before
+# the first use), the setgid bit passes the group on to everything below,
+# whatever the creator's umask
+STORE_DIR_MODE = 02775
+STORE_FILE_MODE = 0664
+
+# file data is split into chunks of at most this size
+CHUNK_SIZE = 1 << 20
+
+# compression level used when (re)writing result tarballs
+GZIP_LEVEL = 6
+
+MANIFEST_VERSION = 1
+
+# archives copied to another store (export_archive), a JSON object per line
+EXPORT_LOG = "exports.jsonl"
+
+
+def gzip_header_mtime(path):
+    """
+    return the mtime field of a gzip header
+    """
+    with open(path, "rb") as f:
+        header = f.read(8)
+    if len(header) < 8 or header[:2] != b"\x1f\x8b":
+        raise IOError("%s is not a gzip file" % path)
+    return struct.unpack("<I", header[4:8])[0]
+
+
+class ChunkStore(object):
+    """
+    Stores result tarballs as a manifest per archive plus content addressed
+    chunks of the files' data. Identical file contents (e.g. the unchanged task
+    skeletons) are stored only once per host. Directories and files are group
+    writable, see STORE_DIR_MODE.
+
+    The tar stream is reproduced byte-for-byte from the manifest, the gzip
+    container is rewritten deterministically (see write_tarball()), so a
+    tarball written by the store can be restored byte-for-byte too.
+    """
+
+    def __init__(self, path=CHUNK_STORE_DIR):
+        self.path = path
+        self.chunk_dir = os.path.join(path, "chunks")
+        self.manifest_dir = os.path.join(path, "manifests")
+        for d in [self.chunk_dir, self.manifest_dir]:
+            self.make_dirs(d)
+
+    def make_dirs(self, path):
+        """
+        create path and its missing parents up to the store directory with
+        STORE_DIR_MODE
+        """
+        if os.path.isdir(path):
+            return
+        parent = os.path.dirname(path)
+        if os.path.abspath(path) != os.path.abspath(self.path):
+            self.make_dirs(parent)
+        elif not os.path.isdir(parent):
+            os.makedirs(parent)
+        try:
+            os.mkdir(path)
+        except OSError, err:
+            if err.errno != errno.EEXIST:
+                raise
+            # created concurrently by another controller
+            return
+        os.chmod(path, STORE_DIR_MODE)
+
+    def chunk_path(self, key):
+        return os.path.join(self.chunk_dir, key[:2], key)
+
+    def has_chunk(self, key):
+        return os.path.isfile(self.chunk_path(key))
+
+    def manifest_path(self, name):
+        if name.endswith(".json"):
+            name = name[:-5]
+        return os.path.join(self.manifest_dir, "%s.json" % name)
+
+    def list_manifests(self):
+        return sorted([m[:-5] for m in os.listdir(self.manifest_dir)
+            if m.endswith(".json")])
+
+    def atomic_write(self, path, data):
+        d = os.path.dirname(path)
+        self.make_dirs(d)
+        fd, tmp = tempfile.mkstemp(dir=d, prefix=".tmp")
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+        os.chmod(tmp, STORE_FILE_MODE)
+        os.rename(tmp, path)
+
+    def put_chunk(self, data):
+        """
+        store data, returns (key, True if the chunk was new)
+        """
+        key = hashlib.sha1(data).hexdigest()
+        if self.has_chunk(key):
+            return (key, False)
+        self.atomic_write(self.chunk_path(key), zlib.compress(data))
+        return (key, True)
+
+    def get_chunk(self, key):
+        with open(self.chunk_path(key), "rb") as f:
+            data = zlib.decompress(f.read())
+        if hashlib.sha1(data).hexdigest() != key:
+            raise IOError("chunk %s is corrupted" % key)
+        return data
+
+    def add_tar(self, tar_path):
+        """
+        split an uncompressed tar file into inline header segments and
+        content addressed data chunks, returns (segments, new bytes)
+        """
+        segments = []
+        new_bytes = 0
+        pending = []
+
+        def inline(data):
+            if data:
+                pending.append(data)
+
+        def flush_inline():
+            if pending:
+                segments.append(["i", base64.b64encode(b"".join(pending))])
+                del pending[:]
+
+        tar = tarfile.open(tar_path, "r:")
+        raw = open(tar_path, "rb")
+        try:
+            pos = 0
+            for info in tar:
+                if not info.isreg() or info.issparse():
+                    continue
+                raw.seek(pos)
+                inline(raw.read(info.offset_data - pos))
+
+                remaining = info.size
+                while remaining > 0:
+                    data = raw.read(min(CHUNK_SIZE, remaining))
+                    remaining -= len(data)
+                    flush_inline()
+                    key, new = self.put_chunk(data)
+                    if new:
+                        new_bytes += len(data)
+                    segments.append(["c", key, len(data)])
+                pos = info.offset_data + info.size
+
+            # padding, end of archive marker and record padding
+            raw.seek(pos)
+            inline(raw.read())
+            flush_inline()
+        finally:
+            raw.close()
+            tar.close()
+
+        return (segments, new_bytes)
+
+    def add_archive(self, path):
+        """
+        add a .tar.gz archive to the store, returns the manifest
+        """
+        name = os.path.basename(path)
+        tmp = tempfile.NamedTemporaryFile(suffix=".tar")
+        try:
+            tar_sha1 = hashlib.sha1()
+            src = gzip.open(path, "rb")
+            try:
+                for block in iter(lambda: src.read(CHUNK_SIZE), b""):
+                    tar_sha1.update(block)
+                    tmp.write(block)
+            finally:
+                src.close()
+            tmp.flush()
+
+            segments, new_bytes = self.add_tar(tmp.name)
+            manifest = {
+                "version": MANIFEST_VERSION,
+                "archive": name,
+                "tar_sha1": tar_sha1.hexdigest(),
+                "tar_size": os.path.getsize(tmp.name),
+                "gzip_mtime": gzip_header_mtime(path),
+                "gzip_level": GZIP_LEVEL,
+                "gzip_block_size": BLOCK_SIZE,
+                "segments": segments,
+                }
+        finally:
+            tmp.close()
+
+        self.atomic_write(self.manifest_path(name), json.dumps(manifest))
+        logging.info("added %s to chunk store %s (%d new bytes)",
+                name, self.path, new_bytes)
+        return manifest, new_bytes
+
+    def load_manifest(self, name):
+        with open(self.manifest_path(name)) as f:
+            return json.load(f)
+
+    def iter_tar(self, manifest):
+        for seg in manifest["segments"]:
+            if seg[0] == "i":
+                yield base64.b64decode(seg[1])
+            else:
+                yield self.get_chunk(seg[1])
+
+    def write_tarball(self, manifest, out_path):
+        """
+        rebuild the archive of manifest to out_path. The gzip header carries the
+        original mtime and name and a fixed compression level (older archives)
+        or the blocks have a fixed size, so the output only depends on the
+        manifest.
+        """
+        tar_sha1 = hashlib.sha1()
+        with open(out_path, "wb") as f:
+            if "gzip_block_size" in manifest:
+                # independently compressed blocks (pgzip), as the archiver
+                # writes them
+                gz = ParallelGzipWriter(f, level=manifest["gzip_level"],
+                        block_size=manifest["gzip_block_size"])
+            else:
+                gz = gzip.GzipFile(filename=manifest["archive"], mode="wb",
+                        compresslevel=manifest["gzip_level"], fileobj=f,
+                        mtime=manifest["gzip_mtime"])
+            try:
+                for data in self.iter_tar(manifest):
+                    tar_sha1.update(data)
+                    gz.write(data)
+            finally:
+                gz.close()
+
+        if tar_sha1.hexdigest() != manifest["tar_sha1"]:
+            raise IOError("restored archive %s does not match its manifest"
+                    % manifest["archive"])
+
+    def store_archive(self, path):
+        """
+        add the archive at path to the store and replace it with the
+        deterministic rewrite, so it can be restored byte-for-byte later on
+        """
+        manifest, new_bytes = self.add_archive(path)
+        tmp = path + ".tmp"
+        self.write_tarball(manifest, tmp)
+        os.rename(tmp, path)
+        return manifest, new_bytes
+
+    def export(self, name, target):
+        """
+        copy a manifest and all chunks the target store does not have yet
+        returns (number of copied chunks, copied bytes)
+        """
+        manifest = self.load_manifest(name)
+        copied = 0
+        copied_bytes = 0
+        for seg in manifest["segments"]:
+            if seg[0] != "c" or target.has_chunk(seg[1]):
+                continue
+            dst = target.chunk_path(seg[1])
+            with open(self.chunk_path(seg[1]), "rb") as f:
+                target.atomic_write(dst, f.read())
+            copied += 1
+            copied_bytes += os.path.getsize(dst)
+
+        with open(self.manifest_path(name)) as f:
+            target.atomic_write(target.manifest_path(name), f.read())
+        log = os.path.join(self.path, EXPORT_LOG)
+        fd = os.open(log, os.O_WRONLY | os.O_APPEND | os.O_CREAT, STORE_FILE_MODE)
+        with os.fdopen(fd, "a") as f:
+            if os.fstat(fd).st_uid == os.getuid():
+                # the umask may have dropped the group's write permission
+                os.fchmod(fd, STORE_FILE_MODE)
+            f.write(json.dumps({"archive": name, "target": os.path.abspath(target.path),
+                "time": time.time()}) + "\n")
+        return (copied, copied_bytes)
+
+    def exported_archives(self):
+        """
+        names of the archives which have been exported to another store
+        """
+        names = set()
+        try:
+            with open(os.path.join(self.path, EXPORT_LOG)) as f:
+                for line in f:
+                    try:
+                        names.add(json.loads(line)["archive"])
+                    except (ValueError, KeyError):
+                        continue
+        except IOError:
+            pass
+        return names
+
+
+class ExportArchive(Command):
+    def __init__(self, mgr):
+        self.set_mgr(mgr)
+
+    def get_keyword(self):
+        return "export_archive"
+
+    def desctiption(self):
+        return "copy stored result archives with their new chunks to another store"
+
+    def help_msg(self):
+        return "%s: <target store dir> [archive name ...]\n" \
+               "    default: all archives" % self.get_keyword()
+
+    def complete_cmd(self, args):
+        if len(args) >= 2:
+            return ChunkStore().list_manifests()
+        return []
+
+    def run(self, args):
+        if len(args) < 1:
+            print self.help_msg()
+            return False
+
+        store = ChunkStore()
+        target = ChunkStore(args[0])
+        names = args[1:] or store.list_manifests()
+        for name in names:
+            try:
+                chunks, size = store.export(name, target)
+            except (IOError, OSError), err:
+                logging.error("error exporting %s: %s", name, err)
+                print "error exporting %s: %s" % (name, err)
+                continue
+            print "exported %s: %d new chunk(s), %d bytes" % (name, chunks, size)
+        return True
+
+
+class RestoreArchive(Command):
+    def __init__(self, mgr):
+        self.set_mgr(mgr)
+
+    def get_keyword(self):
+        return "restore_archive"
+
+    def desctiption(self):
+        return "rebuild a result tarball from the chunk store"
+
+    def help_msg(self):
+        return "%s: <archive name> [output file] [store dir]" % self.get_keyword()
+
+    def complete_cmd(self, args):
+        if len(args) == 1:
+            return ChunkStore().list_manifests()
+        return []
+
+    def run(self, args):
+        if len(args) < 1 or len(args) > 3:
+            print self.help_msg()
+            return False
+
+        store = ChunkStore(args[2]) if len(args) > 2 else ChunkStore()
+        try:
+            manifest = store.load_manifest(args[0])
+        except (IOError, OSError, ValueError), err:
+            print "unknown archive '%s': %s" % (args[0], err)
+            return False
+
+        out = args[1] if len(args) > 1 else manifest["archive"]
+        if os.path.exists(out):
+            print "%s already exists" % out
+            return False
+
+        try:
+            store.write_tarball(manifest, out)
+        except (IOError, OSError), err:
+            logging.error("error restoring %s: %s", args[0], err)
+            print "error restoring %s: %s" % (args[0], err)
+            return False
+
+        print "restored %s" % out
+        return True
@@ -0,0 +1,324 @@
+#!/usr/bin/env python2.7
+
+import os
+import re
+import glob
+import time
+import shutil
+import calendar
+import logging
+from multiprocessing.pool import ThreadPool
+
+from basic_commands import ExecCommand
+from chunkstore import ChunkStore
+import uploader
+import recording
+import checkpoint
+
+
+# default retention: artifacts of seats older than this are removed
+DEFAULT_MAX_AGE_DAYS = 7
+
+# docker operations running in parallel and ids per docker call
+GC_WORKERS = 4
+GC_BATCH = 10
+
+TARBALL_NAME = re.compile(r"^exp_(?P<seat>.+)_\d{8}_\d{6}\.tar\.gz$")
+
+
+def dir_size(path):
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                size += os.lstat(os.path.join(dirpath, name)).st_size
+            except OSError:
+                pass
+    return size
+
+
+def parse_docker_time(value):
+    """
+    parse the RFC 3339 timestamps of docker inspect (UTC)
+    """
+    return calendar.timegm(time.strptime(value[:19], "%Y-%m-%dT%H:%M:%S"))
+
+
+class Seat(object):
+    """
+    all artifacts of one exp_<group>_<user> seat
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.containers = []
+        self.images = []
+        self.tarballs = []
+        # recordings/<seat> and checkpoints/<seat>
+        self.dirs = []
+        self.created = 0
+        self.size = 0
+        self.running = False
+
+    def add(self, kind, ident, created, size):
+        getattr(self, kind).append(ident)
+        self.created = max(self.created, created)
+        self.size += size
+
+
+class GarbageCollect(ExecCommand):
+    def __init__(self, mgr):
+        self.set_mgr(mgr)
+
+    def get_keyword(self):
+        return "gc"
+
+    def desctiption(self):
+        return "remove old experiment containers, images, recordings, checkpoints and exported tarballs"
+
+    def help_msg(self):
+        return "%s: [--max-age=<days>] [--keep=<seats>] [--max-size=<GB>] [--dry-run] [--force]\n" \
+               "    --max-age:  remove seats older than this (default %d days)\n" \
+               "    --keep:     always keep the newest seats\n" \
+               "    --max-size: remove the oldest seats until all seats use less\n" \
+               "    --force:    remove seats without exported results too\n" \
+               "    results count as exported once uploaded or exported to another\n" \
+               "    archive store (export_archive), tarballs, recordings and\n" \
+               "    checkpoints are only removed then" % (
+                       self.get_keyword(), DEFAULT_MAX_AGE_DAYS)
+
+    def inspect(self, ids, fmt, image=False):
+        """
+        inspect all ids with a single docker call, returns the output lines
+        """
+        if not ids:
+            return []
+        cmd = "docker %s --format '%s' %s" % (
+                "image inspect" if image else "inspect --size", fmt, " ".join(ids))
+        out, ret = self.exec_cmd(cmd, silent=True)
+        return (out or "").splitlines()
+
+    def collect(self):
+        seats = {}
+
+        def seat(name):
+            return seats.setdefault(name, Seat(name))
+
+        out, ret = self.exec_cmd(
+                "docker ps -a --no-trunc --filter name=^/exp_ --format '{{.ID}}'")
+        ids = (out or "").split()
+        for line in self.inspect(ids,
+                "{{.Id}} {{.Name}} {{.Created}} {{.State.Running}} {{.SizeRw}}"):
+            cnt_id, name, created, running, size = line.split()
+            s = seat(name.lstrip("/")[len("exp_"):])
+            s.add("containers", cnt_id, parse_docker_time(created),
+                    int(size) if size.isdigit() else 0)
+            s.running = s.running or running == "true"
+
+        out, ret = self.exec_cmd(
+                "docker images --no-trunc --filter reference='exp_*' --format '{{.ID}}'")
+        ids = sorted(set((out or "").split()))
+        for line in self.inspect(ids,
+                "{{.Id}} {{.Created}} {{.Size}} {{range .RepoTags}}{{.}} {{end}}",
+                image=True):
+            fields = line.split()
+            img_id, created, size = fields[:3]
+            for tag in fields[3:]:
+                repo = tag.split(":")[0]
+                if repo.startswith("exp_"):
+                    seat(repo[len("exp_"):]).add("images", tag,
+                            parse_docker_time(created), int(size))
+
+        for path in glob.glob("exp_*.tar.gz"):
+            m = TARBALL_NAME.match(os.path.basename(path))
+            if m:
+                seat(m.group("seat")).add("tarballs", path,
+                        int(os.path.getmtime(path)), os.path.getsize(path))
+
+        for base in [recording.RECORDING_DIR, checkpoint.CHECKPOINT_DIR]:
+            if not os.path.isdir(base):
+                continue
+            for name in os.listdir(base):
+                path = os.path.join(base, name)
+                if os.path.isdir(path):
+                    seat(name).add("dirs", path, int(os.path.getmtime(path)),
+                            dir_size(path))
+
+        return seats
+
+    def exported_archives(self):
+        """
+        names of the result tarballs with a copy off this host: uploaded to
+        the collection server or exported to another archive store
+        """
+        names = uploader.uploaded_archives()
+        names.update(ChunkStore().exported_archives())
+        return names
+
+    def is_exported(self, seat, exported, pending=()):
+        """
+        results count as exported if an archive of exactly this seat has a
+        copy off this host (exported, see exported_archives()) and none of
+        the seat's uploads is pending
+        """
+        if seat.name in pending:
+            return False
+        for name in exported:
+            m = TARBALL_NAME.match(name)
+            if m and m.group("seat") == seat.name:
+                return True
+        return False
+
+    def tarball_exported(self, path, exported):
+        """
+        a tarball may only be removed if it has a copy off this host
+        """
+        return os.path.basename(path) in exported
+
+    def select(self, seats, max_age, keep, max_size):
+        """
+        return the seats to remove according to the retention policy, the
+        keep newest seats are never selected
+        """
+        ordered = sorted(seats.values(), key=lambda s: s.created, reverse=True)
+        now = time.time()
+        selected = []
+        total = sum([s.size for s in ordered])
+        for s in ordered[keep:]:
+            if max_age != None and now - s.created > max_age * 86400:
+                selected.append(s)
+                total -= s.size
+
+        # oldest first until the size limit is met
+        if max_size != None:
+            for s in reversed(ordered[keep:]):
+                if total <= max_size:
+                    break
+                if not s in selected:
+                    selected.append(s)
+                    total -= s.size
+        return selected
+
+    def remove_batch(self, job):
+        cmd, ids = job
+        out, ret = self.exec_cmd("%s %s" % (cmd, " ".join(ids)), silent=True)
+        return (cmd, ids, ret)
+
+    def docker_free_space(self):
+        out, ret = self.exec_cmd("docker info --format '{{.DockerRootDir}}'", silent=True)
+        if ret != 0:
+            return None
+        try:
+            st = os.statvfs(out.strip())
+        except OSError:
+            return None
+        return st.f_bavail * st.f_frsize
+
+    def run(self, args):
+        max_age = DEFAULT_MAX_AGE_DAYS
+        keep = 0
+        max_size = None
+        dry_run = False
+        force = False
+        try:
+            for a in args:
+                if a.startswith("--max-age="):
+                    max_age = float(a.split("=", 1)[1])
+                elif a.startswith("--keep="):
+                    keep = int(a.split("=", 1)[1])
+                elif a.startswith("--max-size="):
+                    max_size = float(a.split("=", 1)[1]) * (1 << 30)
+                elif a == "--dry-run":
+                    dry_run = True
+                elif a == "--force":
+                    force = True
+                else:
+                    raise ValueError(a)
+        except ValueError:
+            print self.help_msg()
+            return False
+
+        seats = self.collect()
+        current = self.mgr.get_experiment()
+        if current != None:
+            seats.pop("%s_%s" % (current.group_name, current.user_name), None)
+
+        exported = self.exported_archives()
+        pending = uploader.pending_seats()
+        rm_jobs = []
+        rmi_jobs = []
+        removed = []
+        for s in self.select(seats, max_age, keep, max_size):
+            if s.running:
+                print "skipping %s: container still running" % s.name
+                continue
+            if not force and not self.is_exported(s, exported, pending):
+                print "skipping %s: results not exported (use --force)" % s.name
+                continue
+            removed.append(s)
+            # -v removes the anonymous /home/user/src volume too
+            for i in range(0, len(s.containers), GC_BATCH):
+                rm_jobs.append(("docker rm -f -v", s.containers[i:i + GC_BATCH]))
+            for i in range(0, len(s.images), GC_BATCH):
+                rmi_jobs.append(("docker rmi", s.images[i:i + GC_BATCH]))
+
+        print "%d of %d seat(s) selected, %.1f MiB" % (len(removed), len(seats),
+                sum([s.size for s in removed]) / 1048576.0)
+        for s in removed:
+            print "  %-30s %s  %d container(s) %d image(s) %d tarball(s) %d dir(s)" % (
+                    s.name, time.strftime("%Y-%m-%d %H:%M", time.localtime(s.created)),
+                    len(s.containers), len(s.images), len(s.tarballs), len(s.dirs))
+        if dry_run or not removed:
+            return True
+
+        free_before = self.docker_free_space()
+        start = time.time()
+
+        # containers first, images can't be removed while used by a container
+        failed = 0
+        for batch in [rm_jobs, rmi_jobs]:
+            if not batch:
+                continue
+            pool = ThreadPool(GC_WORKERS)
+            try:
+                for cmd, ids, ret in pool.map(self.remove_batch, batch):
+                    if ret != 0:
+                        failed += 1
+                        logging.error("gc: '%s' failed for %s", cmd, ids)
+            finally:
+                pool.close()
+                pool.join()
+
+        # the seats' source overlays are named volumes, not removed by rm -v
+        if self.mgr.storage != None:
+            self.mgr.storage.prune()
+
+        # the local archive store is on the same disk, only tarballs with a
+        # copy elsewhere are removed, the others are the only copy
+        file_bytes = 0
+        for s in removed:
+            for path in s.tarballs:
+                if not self.tarball_exported(path, exported):
+                    print "keeping %s: not uploaded or exported" % path
+                    continue
+                file_bytes += os.path.getsize(path)
+                os.unlink(path)
+            if s.dirs and not self.is_exported(s, exported, pending):
+                print "keeping the recordings and checkpoints of %s: not uploaded or exported" % s.name
+                continue
+            for path in s.dirs:
+                file_bytes += dir_size(path)
+                shutil.rmtree(path, True)
+
+        # image sizes include shared layers, so prefer the measured space
+        reclaimed = sum([s.size for s in removed])
+        free_after = self.docker_free_space()
+        if free_before != None and free_after != None:
+            reclaimed = max(0, free_after - free_before) + file_bytes
+        logging.info("gc: removed %d seats in %.1fs, reclaimed %d bytes",
+                len(removed), time.time() - start, reclaimed)
+        print "removed %d seat(s) in %.1fs, reclaimed %.1f MiB" % (len(removed),
+                time.time() - start, reclaimed / 1048576.0)
+        if failed:
+            print "%d docker call(s) failed, see log" % failed
+        return failed == 0
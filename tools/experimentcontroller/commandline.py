@@ -4,6 +4,12 @@ import os
 import readline
 import logging
 import sys
+import ctypes
+import threading
+import traceback
+
+import profiling
+import eventloop
 
 
 class CommandLine(object):
@@ -12,10 +18,17 @@ class CommandLine(object):
         self.keywords = {}
         readline.parse_and_bind('tab: complete')
         readline.set_completer(self.tab_complete)
+        # '@' is part of repeated task labels (<id>@<n>), not a word boundary
+        readline.set_completer_delims(readline.get_completer_delims().replace("@", ""))
         self.running = True
         self.preprompt = "Exp sh"
         self.prompt = ""
         self.postprompt = ":> "
+        # callables returning a short status for the prompt or None
+        self.status_hooks = []
+        # set to a profiling.CommandProfiler to profile every command
+        self.profiler = None
+        self.profile_results = profiling.CommandProfiler()
 
 
     def shutdown(self):
@@ -48,6 +61,13 @@ class CommandLine(object):
                     if begin == 0:
                         # first word
                         candidates = self.keywords.keys()
+                    elif words[0] == "profile":
+                        # complete the profiled command line
+                        if len(completed_words) == 1:
+                            candidates = self.keywords.keys()
+                        else:
+                            cmd = self.keywords[words[1]]
+                            candidates = cmd.complete_cmd(completed_words[1:])
                     else:
                         # later word
                         first = words[0]
@@ -71,14 +91,24 @@ class CommandLine(object):
 
         return response
 
+    def notify(self, msg):
+        """
+        print a message of a background operation
+        """
+        print msg
+
     def set_prompt(self, msg):
         logging.debug("changing prompt to '%s'", msg)
         self.prompt = msg
 
     def get_full_prompt(self):
+        preprompt = self.preprompt
+        status = [s for s in [hook() for hook in self.status_hooks] if s]
+        if status:
+            preprompt += " [%s]" % ", ".join(status)
         if self.prompt:
-            return "%s %s %s" % (self.preprompt, self.prompt, self.postprompt)
-        return "%s %s" % (self.preprompt, self.postprompt)
+            return "%s %s %s" % (preprompt, self.prompt, self.postprompt)
+        return "%s %s" % (preprompt, self.postprompt)
 
     def start(self):
         logging.debug("starting command line")
@@ -98,11 +128,18 @@ class CommandLine(object):
                     logging.debug("help command")
                     self.show_help(args)
 
+                elif cmd == "profile":
+                    logging.debug("profile command")
+                    self.profile_command(args)
+
                 elif cmd in self.keywords:
                     klass = self.keywords[cmd]
                     logging.debug("running command '%s' with args: %s", cmd,
                             args)
-                    klass.run(args)
+                    if self.profiler == None:
+                        klass.run(args)
+                    else:
+                        self.profiler.run(cmd, klass, args)
                     logging.debug("command '%s' ended", cmd)
 
                 else:
@@ -129,10 +166,279 @@ class CommandLine(object):
         print "availible commands:"
         for i in self.keywords.keys():
             print " %s: %s" % (i, self.keywords[i].desctiption())
+        print " profile: [command [args]] run a command with profiling, " \
+              "without arguments show all profiled commands"
+
+    def profile_command(self, args):
+        profiler = self.profiler or self.profile_results
+        if not args:
+            profiler.print_summary()
+        elif not args[0] in self.keywords:
+            print "unknown command '%s'" % args[0]
+        else:
+            profiler.run(args[0], self.keywords[args[0]], args[1:])
+
+
 
 
+# readline's line handler: void (*)(char *line)
+LINE_HANDLER = ctypes.CFUNCTYPE(None, ctypes.c_void_p)
 
 
+class CallbackReadline(object):
+    """
+    readline's alternate (callback) interface, which the readline module of
+    python 2 does not wrap: the event loop feeds the characters, finished
+    lines go to on_line (None on end of file). Line editing, history and
+    the completer of the readline module work like with raw_input().
+    """
+
+    def __init__(self, on_line):
+        # libreadline is linked into the readline module
+        self.lib = ctypes.CDLL(readline.__file__)
+        self.lib.rl_callback_handler_install.argtypes = [ctypes.c_char_p, LINE_HANDLER]
+        self.libc = ctypes.CDLL(None)
+        self.on_line = on_line
+        # ctypes must keep the callback alive
+        self.handler = LINE_HANDLER(self.line_ready)
+        self.installed = False
+
+    def install(self, prompt):
+        """
+        start reading a new line, shows the prompt
+        """
+        self.lib.rl_callback_handler_install(prompt, self.handler)
+        self.installed = True
+
+    def remove(self):
+        """
+        stop reading lines, restores the terminal
+        """
+        if self.installed:
+            self.lib.rl_callback_handler_remove()
+            self.installed = False
+
+    def read_char(self):
+        self.lib.rl_callback_read_char()
+
+    def line_ready(self, ptr):
+        if ptr == None:
+            line = None
+        else:
+            line = ctypes.string_at(ptr)
+            self.libc.free(ctypes.c_void_p(ptr))
+        # exceptions would be lost in the ctypes callback
+        try:
+            self.on_line(line)
+        except:
+            logging.error("error handling input line:\n%s", traceback.format_exc())
+
+
+class AsyncCommandLine(CommandLine):
+    """
+    Command line driven by an eventloop.EventLoop, the prompt never blocks
+    the loop: timers, container operations and notifications keep running
+    while the participant types.
+
+    Commands with a run_async() coroutine run in the background and the
+    prompt returns at once. All other commands run in the foreground like
+    a shell job: their run() gets the main thread (signal handlers can only
+    be installed there) and the terminal. Meanwhile the loop keeps running
+    the background jobs in a helper thread, it stops reading stdin until
+    run() returns.
+
+    On a terminal, readline's callback interface reads the input, so line
+    editing, history and tab completion work as with the blocking prompt.
+    """
+
+    def __init__(self, loop):
+        CommandLine.__init__(self)
+        self.loop = loop
+        self.stdin = sys.stdin.fileno()
+        self.buf = ""
+        self.foreground = None
+        self.jobs = []
+        self.rl = None
+        if os.isatty(self.stdin):
+            try:
+                self.rl = CallbackReadline(self.line_ready)
+            except (OSError, AttributeError), err:
+                # e.g. python built against libedit
+                logging.warning("no readline callback interface, line editing "
+                        "disabled: %s", err)
+
+    def shutdown(self):
+        CommandLine.shutdown(self)
+        if self.jobs:
+            logging.info("quitting with %d background command(s) running",
+                    len(self.jobs))
+        self.loop.call_soon(self.loop.stop)
+
+    def start(self):
+        logging.debug("starting async command line")
+        self.show_prompt()
+        self.loop.add_reader(self.stdin, self.read_input)
+        while self.running:
+            try:
+                # lines typed ahead may start a command outside of the loop
+                if self.foreground != None:
+                    self.run_foreground_job()
+                else:
+                    self.loop.run_forever()
+            except KeyboardInterrupt:
+                print
+                print "use 'quit' to exit"
+                self.show_prompt()
+
+    def show_prompt(self):
+        if self.rl != None:
+            self.rl.install(self.get_full_prompt())
+            return
+        sys.stdout.write(self.get_full_prompt())
+        sys.stdout.flush()
+
+    def notify(self, msg):
+        """
+        print a message without losing the prompt
+        """
+        if self.foreground != None:
+            print msg
+            return
+        if self.rl != None and self.rl.installed:
+            # a new prompt with the line typed so far
+            typed = readline.get_line_buffer()
+            self.rl.remove()
+            sys.stdout.write("\r\x1b[K%s\n" % msg)
+            self.show_prompt()
+            readline.insert_text(typed)
+            readline.redisplay()
+            return
+        sys.stdout.write("\r%s\n" % msg)
+        self.show_prompt()
+        if self.buf:
+            sys.stdout.write(self.buf)
+            sys.stdout.flush()
+
+    def read_input(self):
+        if self.rl != None:
+            self.rl.read_char()
+            return
+        data = os.read(self.stdin, 4096)
+        if not data:
+            print
+            print "use 'quit' to exit"
+            if not os.isatty(self.stdin):
+                self.shutdown()
+                return
+            self.show_prompt()
+            return
+        self.buf += data
+        while "\n" in self.buf and self.foreground == None:
+            line, self.buf = self.buf.split("\n", 1)
+            self.handle_line(line)
+
+    def line_ready(self, line):
+        """
+        a line read by readline, None on end of file
+        """
+        self.rl.remove()
+        if line == None:
+            print
+            print "use 'quit' to exit"
+            self.show_prompt()
+            return
+        if line.strip():
+            readline.add_history(line)
+        self.handle_line(line)
+
+    def handle_line(self, raw_line):
+        line = raw_line.strip()
+        if len(line) != 0:
+            try:
+                self.dispatch(line)
+            except:
+                print "unexpected error: (%s) %s" % (
+                        sys.exc_info()[0], sys.exc_info()[1])
+        if self.foreground == None and self.running:
+            self.show_prompt()
+
+    def dispatch(self, line):
+        token = line.split()
+        cmd = token[0]
+        args = token[1:]
+
+        if cmd == "help":
+            self.show_help(args)
+        elif cmd == "profile":
+            self.run_foreground(cmd, self.profile_command, args)
+        elif cmd in self.keywords:
+            klass = self.keywords[cmd]
+            gen = klass.run_async(args) if self.profiler == None else None
+            if gen != None:
+                logging.debug("running command '%s' in the background with args: %s",
+                        cmd, args)
+                job = self.loop.spawn(gen, cmd)
+                self.jobs.append(job)
+                job.add_done_callback(self.job_done)
+            elif self.profiler == None:
+                self.run_foreground(cmd, klass.run, args)
+            else:
+                self.run_foreground(cmd, self.profiler.run, cmd, klass, args)
+        else:
+            print "unknown command '%s'" % cmd
+
+    def run_foreground(self, cmd, func, *args):
+        logging.debug("running command '%s' in the foreground", cmd)
+        self.loop.remove_reader(self.stdin)
+        self.foreground = (cmd, func, args)
+        # start() runs the command once the loop left the main thread
+        self.loop.stop()
+
+    def run_foreground_job(self):
+        cmd, func, args = self.foreground
+        helper = threading.Thread(target=self.loop.run_forever, name="loop")
+        helper.daemon = True
+        helper.start()
+        result = eventloop.Future(self.loop)
+        try:
+            result.set_result(func(*args))
+        except KeyboardInterrupt:
+            print
+            print "use 'quit' to exit"
+            result.set_result(None)
+        except:
+            result.set_exception(sys.exc_info())
+        finally:
+            # a callback, stop() before the helper entered the loop is lost
+            self.loop.call_soon(self.loop.stop)
+            helper.join()
+        self.foreground_done(result)
+
+    def foreground_done(self, future):
+        self.foreground = None
+        try:
+            future.result()
+        except:
+            print "unexpected error: (%s) %s" % (
+                    sys.exc_info()[0], sys.exc_info()[1])
+        if not self.running:
+            return
+        self.loop.add_reader(self.stdin, self.read_input)
+        self.show_prompt()
+        # lines typed ahead while the command ran
+        while "\n" in self.buf and self.foreground == None:
+            line, self.buf = self.buf.split("\n", 1)
+            self.handle_line(line)
+
+    def job_done(self, job):
+        self.jobs.remove(job)
+        try:
+            job.result()
+            logging.debug("command '%s' ended", job.name)
+        except:
+            self.notify("%s: unexpected error: (%s) %s" % (job.name,
+                sys.exc_info()[0], sys.exc_info()[1]))
+
 
 class Command(object):
 
@@ -185,6 +491,13 @@ class Command(object):
 
         return (line.lower() == 'y')
 
+    def run_async(self, args):
+        """
+        return a generator to run the command as coroutine in the background
+        (async command line only), None runs run() in the foreground
+        """
+        return None
+
     def run(self, args):
         """
         called if user entered the keyword for this command.
@@ -0,0 +1,393 @@
+#!/usr/bin/env python2.7
+
+import os
+import hmac
+import base64
+import shlex
+import socket
+import urllib
+import logging
+import tempfile
+import xmlrpclib
+import subprocess
+import SocketServer
+import multiprocessing
+from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+
+from commandline import Command
+import scheduler
+
+
+AGENT_PORT = 8471
+
+# address the agent listens on, set EXPCTR_AGENT_BIND (or --bind=) to the
+# interface of the lab network
+AGENT_BIND = os.environ.get("EXPCTR_AGENT_BIND", "127.0.0.1")
+
+# shared secret of the coordinator and its agents, sent as password of
+# HTTP basic authentication. Read from a file or EXPCTR_AGENT_SECRET.
+AGENT_SECRET_ENV = "EXPCTR_AGENT_SECRET"
+AGENT_USER = "expctr"
+
+# the only program agents run for the coordinator
+AGENT_COMMANDS = ["docker"]
+
+# size of the pieces files are transferred in
+TRANSFER_CHUNK = 4 << 20
+
+# weights of the placement score
+WEIGHT_CPU = 0.4
+WEIGHT_MEM = 0.3
+WEIGHT_IMAGES = 0.3
+
+
+class AgentService(object):
+    """
+    RPC interface of an agent, runs on the host the containers are
+    started on. docker_host is the address the coordinator's docker client
+    uses for interactive containers (e.g. 'ssh://lab3' or 'tcp://lab3:2376').
+    """
+
+    def __init__(self, docker_host=None, display=None):
+        if docker_host == None:
+            docker_host = "ssh://%s" % socket.getfqdn()
+        if display == None:
+            display = os.environ.get("DISPLAY", ":0")
+        self.docker_host = docker_host
+        self.display = display
+        self.admission = scheduler.AdmissionControl()
+        # files are transferred only from and to this directory
+        self.tmp_dir = os.path.realpath(tempfile.mkdtemp(prefix="expagent_"))
+
+    def host_info(self):
+        info = {
+            "hostname": socket.gethostname(),
+            "docker_host": self.docker_host,
+            "display": self.display,
+            "xauth": None,
+            "cpus": multiprocessing.cpu_count(),
+            "load": os.getloadavg()[0],
+            "mem_total": 0,
+            "mem_available": 0,
+            "images": [],
+            }
+
+        xauth_file = "%s/.Xauthority" % os.environ.get("HOME", "/")
+        if os.path.isfile(xauth_file):
+            info["xauth"] = xauth_file
+
+        try:
+            with open("/proc/meminfo") as f:
+                for line in f:
+                    key, value = line.split(":", 1)
+                    # in MiB, XML-RPC integers are limited to 32 bit
+                    if key == "MemTotal":
+                        info["mem_total"] = int(value.split()[0]) // 1024
+                    elif key == "MemAvailable":
+                        info["mem_available"] = int(value.split()[0]) // 1024
+        except (IOError, ValueError), err:
+            logging.error("agent: could not read /proc/meminfo: %s", err)
+
+        out, err, ret = self.exec_cmd(
+                "docker images --format '{{.Repository}}:{{.Tag}}'")
+        if ret == 0:
+            info["images"] = out.data.split()
+        return info
+
+    def exec_cmd(self, command):
+        logging.debug("agent: running command: %s", command)
+        try:
+            cmd = shlex.split(command)
+        except ValueError, err:
+            return (xmlrpclib.Binary(""), xmlrpclib.Binary(str(err)), -1)
+        if not cmd or not cmd[0] in AGENT_COMMANDS:
+            logging.warning("agent: refused command: %s", command)
+            return (xmlrpclib.Binary(""), xmlrpclib.Binary(
+                "command not allowed on the agent: %s" % command), -1)
+        try:
+            with self.admission.admit(cmd):
+                p = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                        stderr=subprocess.PIPE)
+                out, err = p.communicate()
+        except (OSError, ValueError), err:
+            logging.error("agent: error running command: %s", err)
+            return (xmlrpclib.Binary(""), xmlrpclib.Binary(str(err)), -1)
+        # command output is not necessarily valid XML text
+        return (xmlrpclib.Binary(out), xmlrpclib.Binary(err), p.returncode)
+
+    def allow_local_display(self):
+        """
+        allow local containers to connect to the agent's X display
+        """
+        try:
+            ret = subprocess.call(["xhost", "+local:"], stdout=open(os.devnull, "w"),
+                    stderr=subprocess.STDOUT)
+        except OSError, err:
+            logging.error("agent: error running xhost: %s", err)
+            return False
+        return ret == 0
+
+    def check_path(self, path):
+        """
+        the real path of a transferred file, which has to be a temp file of
+        this agent
+        """
+        real = os.path.realpath(path)
+        if os.path.dirname(real) != self.tmp_dir:
+            logging.warning("agent: refused access to %s", path)
+            raise ValueError("%s is not a temp file of the agent" % path)
+        return real
+
+    def put_file(self, path, data, append):
+        with open(self.check_path(path), "ab" if append else "wb") as f:
+            f.write(data.data)
+        return True
+
+    def get_file(self, path, offset):
+        with open(self.check_path(path), "rb") as f:
+            f.seek(offset)
+            return xmlrpclib.Binary(f.read(TRANSFER_CHUNK))
+
+    def temp_file(self, suffix):
+        if os.sep in suffix:
+            raise ValueError("invalid suffix %s" % suffix)
+        fd, path = tempfile.mkstemp(suffix=suffix, dir=self.tmp_dir)
+        os.close(fd)
+        return path
+
+    def remove_file(self, path):
+        os.unlink(self.check_path(path))
+        return True
+
+
+def load_secret(path=None):
+    """
+    the shared agent secret from path or the environment, None if unset
+    """
+    if path:
+        with open(path) as f:
+            secret = f.read().strip()
+    else:
+        secret = os.environ.get(AGENT_SECRET_ENV, "").strip()
+    return secret or None
+
+
+def authorized(header, secret):
+    """
+    check an HTTP basic authorization header against the shared secret
+    """
+    if not header or not header.startswith("Basic "):
+        return False
+    try:
+        user, password = base64.b64decode(header[len("Basic "):]).split(":", 1)
+    except (TypeError, ValueError):
+        return False
+    return user == AGENT_USER and hmac.compare_digest(password, secret)
+
+
+class AuthRequestHandler(SimpleXMLRPCRequestHandler):
+    """
+    rejects requests without the shared secret
+    """
+
+    def parse_request(self):
+        if not SimpleXMLRPCRequestHandler.parse_request(self):
+            return False
+        if authorized(self.headers.get("Authorization"), self.server.secret):
+            return True
+        logging.warning("agent: unauthorized request from %s", self.client_address[0])
+        self.send_error(401, "unauthorized")
+        return False
+
+
+class ThreadedXMLRPCServer(SocketServer.ThreadingMixIn, SimpleXMLRPCServer):
+    daemon_threads = True
+
+
+def serve(service, secret, host=AGENT_BIND, port=AGENT_PORT):
+    server = ThreadedXMLRPCServer((host, port), requestHandler=AuthRequestHandler,
+            allow_none=True, logRequests=False)
+    server.secret = secret
+    server.register_instance(service)
+    logging.info("agent listening on %s:%d", host, port)
+    server.serve_forever()
+
+
+class Agent(object):
+    """
+    client side of an agent, calls are forwarded to self.service which is
+    either an RPC proxy or an in-process AgentService
+    """
+
+    def __init__(self, name, service):
+        self.name = name
+        self.service = service
+        self.info = None
+
+    def host_info(self):
+        self.info = self.service.host_info()
+        return self.info
+
+    def exec_cmd(self, command):
+        out, err, ret = self.service.exec_cmd(command)
+        return (out.data, err.data, ret)
+
+    def put_file(self, path, local_path):
+        append = False
+        with open(local_path, "rb") as f:
+            for data in iter(lambda: f.read(TRANSFER_CHUNK), b""):
+                self.service.put_file(path, xmlrpclib.Binary(data), append)
+                append = True
+        if not append:
+            self.service.put_file(path, xmlrpclib.Binary(b""), False)
+
+    def get_file(self, path, local_path):
+        offset = 0
+        with open(local_path, "wb") as f:
+            while True:
+                data = self.service.get_file(path, offset).data
+                if not data:
+                    break
+                f.write(data)
+                offset += len(data)
+        return offset
+
+    def temp_file(self, suffix=""):
+        return self.service.temp_file(suffix)
+
+    def allow_local_display(self):
+        return self.service.allow_local_display()
+
+    def remove_file(self, path):
+        return self.service.remove_file(path)
+
+    def docker_cli(self):
+        """
+        docker client command line talking to the agent's daemon
+        """
+        if self.info == None:
+            self.host_info()
+        return "docker -H %s" % self.info["docker_host"]
+
+
+class RemoteAgent(Agent):
+    def __init__(self, name, url, secret):
+        if not "://" in url:
+            url = "http://%s" % url
+        if url.count(":") < 2:
+            url = "%s:%d" % (url, AGENT_PORT)
+        # xmlrpclib sends the user info of the url as basic authorization
+        scheme, rest = url.split("://", 1)
+        auth_url = "%s://%s:%s@%s" % (scheme, AGENT_USER,
+                urllib.quote(secret, safe=""), rest)
+        Agent.__init__(self, name, xmlrpclib.ServerProxy(auth_url, allow_none=True))
+        self.url = url
+
+
+class LocalAgent(Agent):
+    """
+    in-process stand-in for an agent, e.g. for tests. service defaults to an
+    AgentService working on the local docker daemon
+    """
+
+    def __init__(self, name, service=None):
+        if service == None:
+            service = AgentService(docker_host="unix:///var/run/docker.sock")
+        Agent.__init__(self, name, service)
+        self.url = "local"
+
+
+class Coordinator(object):
+    """
+    places seats on agents by free CPU, free memory and cached images
+    """
+
+    def __init__(self):
+        self.agents = {}
+        self.seats = {}
+
+    def add_agent(self, agent):
+        if agent.name in self.agents:
+            raise NameError("agent %s already defined" % agent.name)
+        logging.info("add agent %s (%s)", agent.name, agent.url)
+        self.agents[agent.name] = agent
+
+    def get_seats(self, agent):
+        return [s for s, a in self.seats.items() if a == agent.name]
+
+    def score(self, agent, info, images):
+        cpus = max(1, info["cpus"])
+        cpu_free = max(0.0, cpus - info["load"]) / cpus
+        mem_free = 0.0
+        if info["mem_total"]:
+            mem_free = float(info["mem_available"]) / info["mem_total"]
+        cached = 1.0
+        if images:
+            cached = float(len(set(images) & set(info["images"]))) / len(images)
+        # seats placed recently may not show up in the load yet
+        penalty = len(self.get_seats(agent)) / float(cpus)
+        return (WEIGHT_CPU * cpu_free + WEIGHT_MEM * mem_free
+                + WEIGHT_IMAGES * cached - penalty)
+
+    def place(self, seat, images):
+        """
+        return the agent with the best score for a new seat, None if no
+        agent is reachable
+        """
+        best = None
+        best_score = None
+        for name in sorted(self.agents):
+            agent = self.agents[name]
+            try:
+                info = agent.host_info()
+            except (socket.error, xmlrpclib.Error), err:
+                logging.error("agent %s not reachable: %s", name, err)
+                continue
+            s = self.score(agent, info, images)
+            logging.debug("placement score of agent %s for %s: %.3f", name, seat, s)
+            if best_score == None or s > best_score:
+                best, best_score = agent, s
+
+        if best != None:
+            logging.info("placing seat %s on agent %s", seat, best.name)
+            self.seats[seat] = best.name
+        return best
+
+    def release(self, seat):
+        if seat in self.seats:
+            logging.info("releasing seat %s from agent %s", seat, self.seats[seat])
+            del self.seats[seat]
+
+
+class ListAgents(Command):
+    def __init__(self, mgr):
+        self.set_mgr(mgr)
+
+    def get_keyword(self):
+        return "agents"
+
+    def desctiption(self):
+        return "show the agent hosts of the coordinator"
+
+    def run(self, args):
+        coordinator = self.mgr.coordinator
+        if coordinator == None:
+            print "not running in coordinator mode (use --agents=...)"
+            return
+
+        print "%-12s %-28s %5s %6s %9s %7s  %s" % ("agent", "url", "cpus", "load",
+                "mem free", "images", "seats")
+        for name in sorted(coordinator.agents):
+            agent = coordinator.agents[name]
+            seats = ", ".join(coordinator.get_seats(agent))
+            try:
+                info = agent.host_info()
+            except (socket.error, xmlrpclib.Error), err:
+                print "%-12s %-28s unreachable: %s" % (name, agent.url, err)
+                continue
+            mem_free = 0.0
+            if info["mem_total"]:
+                mem_free = 100.0 * info["mem_available"] / info["mem_total"]
+            print "%-12s %-28s %5d %6.2f %8.0f%% %7d  %s" % (name, agent.url,
+                    info["cpus"], info["load"], mem_free, len(info["images"]),
+                    seats)
@@ -0,0 +1,443 @@
+#!/usr/bin/env python2.7
+
+import os
+import time
+import socket
+import logging
+import xmlrpclib
+import threading
+import collections
+
+from basic_commands import ExecCommand
+import resources
+import metrics
+
+
+# display backends of the editor container
+DISPLAY_BACKENDS = ["x11", "xpra"]
+DEFAULT_BACKEND = "x11"
+
+# headless X server with the xpra HTML5 client, runs next to the editor
+# container and shares its X socket through a volume
+XPRA_IMAGE = "experiment-xpra:xenial"
+XPRA_PORT = 14500
+XPRA_DISPLAY = ":100"
+
+# host address the xpra port is published on, the participant's browser
+# connects to it (use 0.0.0.0 for remote seats)
+XPRA_BIND = os.environ.get("EXPCTR_XPRA_BIND", "127.0.0.1")
+
+# the sidecar names must not match the exp_ seat filters
+SIDECAR_PREFIX = "expdisp_"
+X11_VOLUME_PREFIX = "expctr_x11_"
+
+# buffer size of the relay
+RELAY_CHUNK = 16384
+
+# input-to-update latencies kept for the relay statistics
+RELAY_WINDOW = 1000
+
+
+class X11Backend(ExecCommand):
+    """
+    the editor draws on the X server of the seat: the X11 socket is bind
+    mounted and .Xauthority copied into the container. Remote seats stream
+    raw X11 over ssh forwarding.
+    """
+    name = "x11"
+
+    def __init__(self, mgr):
+        self.set_mgr(mgr)
+
+    def get_keyword(self):
+        return None
+
+    def create_opts(self, seat, display, xauth_file):
+        """
+        docker create options of the editor container
+        """
+        # volume mount for X11 socket, if local X-display is used
+        opts = " -v /tmp/.X11-unix:/tmp/.X11-unix"
+
+        # ssh forwarded connection require the xauth mechanism
+        if xauth_file:
+            opts += " -v %s:/tmp/.xauth" % xauth_file
+
+        opts += " -e DISPLAY=%s" % display
+        # if we use a X11 display over network (ssh)
+        opts += " --net=\"host\""
+        return opts
+
+    def prepare(self, seat, agent):
+        """
+        called before the editor container of seat is created or resumed,
+        returns False if the display can't be provided
+        """
+        # ensure we have access to the local display
+        if agent != None:
+            try:
+                agent.allow_local_display()
+            except (socket.error, xmlrpclib.Error), err:
+                logging.error("xhost on agent %s failed: %s", agent.name, err)
+        else:
+            # the X server may have been restarted or its access control
+            # reset since the last experiment, run xhost again
+            self.mgr.probes.invalidate("xhost")
+            r = self.mgr.probes.get("xhost")
+            if not r.ok:
+                print "warning: %s" % r.detail
+        return True
+
+    def setup(self, cnt_id, xauth_file, agent):
+        """
+        called after the editor container has been created
+        """
+        # on CentOS, the xauth file has selinux label attached, thus the
+        # container is not able to read it, therefore, try to copy it into
+        # the container directly
+        # Note: this work only for docker > 1.8
+        if xauth_file:
+            self.exec_cmd("docker cp %s %s:/home/user/.Xauthority" % (xauth_file, cnt_id),
+                    silent=True, agent=agent)
+
+    def images(self):
+        """
+        images needed besides the editor and task images
+        """
+        return []
+
+    def address(self, seat, agent):
+        """
+        where the participant sees the editor, None for the seat's display
+        """
+        return None
+
+    def stop(self, seat, agent):
+        pass
+
+
+class XpraBackend(X11Backend):
+    """
+    the editor runs headless: a sidecar container runs Xvfb with an xpra
+    server, the editor connects to its X socket through a per seat volume.
+    The participant opens the editor in a browser (xpra HTML5 client), xpra
+    sends compressed screen updates instead of X11 requests.
+    """
+    name = "xpra"
+
+    def sidecar(self, seat):
+        return SIDECAR_PREFIX + seat
+
+    def volume(self, seat):
+        return X11_VOLUME_PREFIX + seat
+
+    def create_opts(self, seat, display, xauth_file):
+        opts = " -v %s:/tmp/.X11-unix" % self.volume(seat)
+        # no host network needed, the X socket is in the volume
+        opts += " -e DISPLAY=%s" % XPRA_DISPLAY
+        return opts
+
+    def prepare(self, seat, agent):
+        name = self.sidecar(seat)
+        out, ret = self.exec_cmd("docker inspect --format '{{.State.Running}}' %s" % name,
+                silent=True, agent=agent)
+        if ret == 0 and out.strip() == "true":
+            # resumed seat, the display is still there
+            return True
+        if ret == 0:
+            self.exec_cmd("docker rm -f %s" % name, silent=True, agent=agent)
+
+        out, ret = self.exec_cmd("docker volume create %s" % self.volume(seat),
+                silent=True, agent=agent)
+        if ret != 0:
+            return False
+        cmd = "docker run -d --rm --name %s" % name
+        cmd += " -v %s:/tmp/.X11-unix" % self.volume(seat)
+        cmd += " -p %s::%d" % (XPRA_BIND, XPRA_PORT)
+        cmd += " %s xpra start %s --daemon=no --bind-tcp=0.0.0.0:%d --html=on" % (
+                XPRA_IMAGE, XPRA_DISPLAY, XPRA_PORT)
+        # the editor container connects to the socket without a cookie
+        cmd += " --mdns=no --pulseaudio=no --start='xhost +local:'"
+        out, ret = self.exec_cmd(cmd, agent=agent)
+        if ret != 0:
+            logging.error("could not start the xpra display of %s", seat)
+            return False
+
+        # the X socket has to exist before the editor starts
+        socket_path = "/tmp/.X11-unix/X%s" % XPRA_DISPLAY.lstrip(":")
+        for i in range(50):
+            out, ret = self.exec_cmd("docker exec %s test -S %s" % (name, socket_path),
+                    silent=True, agent=agent)
+            if ret == 0:
+                return True
+            time.sleep(0.2)
+        logging.error("xpra display of %s did not come up", seat)
+        return False
+
+    def setup(self, cnt_id, xauth_file, agent):
+        pass
+
+    def images(self):
+        return [XPRA_IMAGE]
+
+    def address(self, seat, agent):
+        out, ret = self.exec_cmd("docker port %s %d/tcp" % (self.sidecar(seat), XPRA_PORT),
+                silent=True, agent=agent)
+        if ret != 0 or not out.strip():
+            return None
+        host, port = out.split()[0].rsplit(":", 1)
+        if host in ("0.0.0.0", "") and agent != None:
+            host = agent.name
+        elif host in ("0.0.0.0", ""):
+            host = socket.gethostname()
+        return "http://%s:%s/" % (host, port)
+
+    def stop(self, seat, agent):
+        self.exec_cmd("docker rm -f %s" % self.sidecar(seat), silent=True, agent=agent)
+        self.exec_cmd("docker volume rm %s" % self.volume(seat), silent=True, agent=agent)
+
+
+BACKENDS = {
+    "x11": X11Backend,
+    "xpra": XpraBackend,
+    }
+
+
+class RelayDirection(object):
+    """
+    one direction of a relayed connection: data is forwarded after delay
+    seconds at no more than rate bytes/s (token bucket)
+    """
+
+    def __init__(self, relay, src, dst, name):
+        self.relay = relay
+        self.src = src
+        self.dst = dst
+        self.name = name
+        self.queue = collections.deque()
+        self.cond = threading.Condition()
+        self.closed = False
+
+    def start(self):
+        for target in (self.receive, self.send):
+            t = threading.Thread(target=target, name="relay-%s" % self.name)
+            t.daemon = True
+            t.start()
+
+    def receive(self):
+        try:
+            while True:
+                data = self.src.recv(RELAY_CHUNK)
+                if not data:
+                    break
+                self.relay.received(self.name, time.time())
+                with self.cond:
+                    self.queue.append((time.time(), data))
+                    self.cond.notify()
+        except socket.error:
+            pass
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+
+    def send(self):
+        tokens = 0.0
+        last = time.time()
+        try:
+            while True:
+                with self.cond:
+                    while not self.queue and not self.closed:
+                        self.cond.wait(1)
+                    if not self.queue:
+                        break
+                    received, data = self.queue.popleft()
+                wait = received + self.relay.delay - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+                if self.relay.rate:
+                    now = time.time()
+                    # bursts of at most one chunk
+                    tokens = min(RELAY_CHUNK, tokens + (now - last) * self.relay.rate)
+                    last = now
+                    tokens -= len(data)
+                    if tokens < 0:
+                        time.sleep(-tokens / self.relay.rate)
+                self.dst.sendall(data)
+                self.relay.sent(self.name, len(data), time.time())
+        except socket.error:
+            pass
+        for s in (self.src, self.dst):
+            try:
+                s.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+
+class ThrottledRelay(object):
+    """
+    TCP relay simulating a slow link between a participant and a display
+    backend, e.g. xpra's port or a TCP X11 display (port 6000 + n).
+    Measures the bytes per direction and the input latency: the time from
+    client data (input) arriving at the relay until the next server data
+    (screen update) is delivered to the client.
+    """
+
+    def __init__(self, listen_port, target, rate_kbit=0, delay_ms=0):
+        self.target = target
+        self.rate = rate_kbit * 1000 / 8.0
+        self.delay = delay_ms / 1000.0
+        self.bytes = {"up": 0, "down": 0}
+        self.connections = 0
+        self.latencies = collections.deque(maxlen=RELAY_WINDOW)
+        self.pending_input = None
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(("127.0.0.1", listen_port))
+        self.server.listen(5)
+        self.listen_port = self.server.getsockname()[1]
+        self.running = True
+
+    def start(self):
+        t = threading.Thread(target=self.accept, name="relay")
+        t.daemon = True
+        t.start()
+
+    def accept(self):
+        while self.running:
+            try:
+                client, addr = self.server.accept()
+            except socket.error:
+                break
+            try:
+                upstream = socket.create_connection(self.target)
+            except socket.error, err:
+                logging.error("relay: can't connect to %s:%d: %s", self.target[0],
+                        self.target[1], err)
+                client.close()
+                continue
+            for s in (client, upstream):
+                s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self.lock:
+                self.connections += 1
+            RelayDirection(self, client, upstream, "up").start()
+            RelayDirection(self, upstream, client, "down").start()
+
+    def stop(self):
+        self.running = False
+        self.server.close()
+
+    def received(self, direction, now):
+        if direction == "up":
+            with self.lock:
+                if self.pending_input == None:
+                    self.pending_input = now
+
+    def sent(self, direction, size, now):
+        metrics.DISPLAY_BYTES.inc(size, direction=direction)
+        with self.lock:
+            self.bytes[direction] += size
+            if direction == "down" and self.pending_input != None:
+                latency = now - self.pending_input
+                self.latencies.append(latency)
+                self.pending_input = None
+                metrics.DISPLAY_INPUT_LATENCY.observe(latency)
+
+    def stats(self):
+        """
+        (seconds running, {direction: bytes}, connections, sorted latencies)
+        """
+        with self.lock:
+            return (time.time() - self.start_time, dict(self.bytes),
+                    self.connections, sorted(self.latencies))
+
+
+class Display(ExecCommand):
+    def __init__(self, mgr):
+        self.set_mgr(mgr)
+        self.relay = None
+
+    def get_keyword(self):
+        return "display"
+
+    def desctiption(self):
+        return "show the display of the experiment, measure it through a throttled relay"
+
+    def help_msg(self):
+        return "%s: [relay <port> <host:port> [--rate=<kbit/s>] [--delay=<ms>] | relay stop]\n" \
+               "    relay: forward <port> to <host:port> over a throttled link, without\n" \
+               "    arguments show its bandwidth and input latency" % self.get_keyword()
+
+    def complete_cmd(self, args):
+        if len(args) == 1:
+            return ["relay"]
+        return []
+
+    def show(self):
+        backend = self.mgr.display
+        print "display backend: %s" % backend.name
+        exp = self.mgr.get_experiment()
+        if exp != None and exp.cnt_id != None:
+            address = backend.address(resources.seat_name(exp.group_name,
+                exp.user_name), self.mgr.get_agent())
+            print "editor: %s" % (address or os.environ.get("DISPLAY", "-"))
+
+    def show_relay(self):
+        if self.relay == None:
+            print "no relay running"
+            return
+        elapsed, sizes, conns, latencies = self.relay.stats()
+        print "relay 127.0.0.1:%d -> %s:%d, %.0f kbit/s, %.0f ms delay" % (
+                self.relay.listen_port, self.relay.target[0], self.relay.target[1],
+                self.relay.rate * 8 / 1000.0, self.relay.delay * 1000)
+        print "%d connection(s) in %.0fs" % (conns, elapsed)
+        for d in ["up", "down"]:
+            print "  %-4s %10d bytes %8.1f kbit/s" % (d, sizes[d],
+                    sizes[d] * 8 / 1000.0 / max(elapsed, 1e-3))
+        if latencies:
+            print "  input latency: median %.0f ms, p95 %.0f ms (%d samples)" % (
+                    latencies[len(latencies) // 2] * 1000,
+                    latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000,
+                    len(latencies))
+
+    def start_relay(self, args):
+        rate = 0
+        delay = 0
+        positional = []
+        for a in args:
+            if a.startswith("--rate="):
+                rate = float(a[len("--rate="):])
+            elif a.startswith("--delay="):
+                delay = float(a[len("--delay="):])
+            else:
+                positional.append(a)
+        if len(positional) != 2 or not ":" in positional[1]:
+            print self.help_msg()
+            return False
+        host, port = positional[1].rsplit(":", 1)
+        if self.relay != None:
+            self.relay.stop()
+        self.relay = ThrottledRelay(int(positional[0]), (host, int(port)), rate, delay)
+        self.relay.start()
+        print "relaying 127.0.0.1:%d to %s" % (self.relay.listen_port, positional[1])
+        return True
+
+    def run(self, args):
+        if not args:
+            self.show()
+        elif args == ["relay"]:
+            self.show_relay()
+        elif args == ["relay", "stop"]:
+            if self.relay != None:
+                self.relay.stop()
+                self.show_relay()
+                self.relay = None
+        elif args[0] == "relay":
+            try:
+                return self.start_relay(args[1:])
+            except (ValueError, socket.error), err:
+                print "could not start the relay: %s" % err
+                return False
+        else:
+            print self.help_msg()
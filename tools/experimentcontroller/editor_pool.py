@@ -0,0 +1,194 @@
+#!/usr/bin/env python2.7
+
+import os
+import logging
+import binascii
+import threading
+
+from basic_commands import ExecCommand, EDITOR_CNT_IMAGE, editor_create_cmd
+from display import X11Backend
+import resources
+import scheduler
+import eventloop
+
+
+# pre-started editor containers kept per host and display, the pool is
+# off unless enabled with --pool=<n>: pool editors show up on the display
+# before a participant sits down
+DEFAULT_POOL_SIZE = 0
+
+# names of the pool containers, not matched by the exp_ seat filters
+POOL_PREFIX = "expctr_pool_"
+
+# label of pool containers (value: the DISPLAY they are started for)
+POOL_LABEL = "expctr.pool.display"
+
+
+class EditorPool(ExecCommand):
+    """
+    Keeps a number of editor containers created and started in the
+    background. new_experiment claims one by renaming it to exp_<seat>,
+    docker rename is atomic so controllers sharing the host never claim the
+    same container.
+    """
+
+    def __init__(self, mgr, size=DEFAULT_POOL_SIZE):
+        self.set_mgr(mgr)
+        self.size = size
+        self.display = os.environ.get('DISPLAY')
+        self.xauth_file = mgr.probes.value("xauth")
+        self.fill_lock = threading.Lock()
+        self.filler = None
+        # fill coroutine on the event loop (async command line)
+        self.fill_job = None
+
+    def get_keyword(self):
+        return "pool"
+
+    def desctiption(self):
+        return "show or refill the pool of pre-started editor containers"
+
+    def help_msg(self):
+        return "%s: [fill|drain]" % self.get_keyword()
+
+    def complete_cmd(self, args):
+        if len(args) == 1:
+            return ["fill", "drain"]
+        return None
+
+    def list_cmd(self):
+        return "docker ps --no-trunc --filter label=%s=%s --filter ancestor=%s --format '{{.ID}} {{.Names}}'" % (
+                POOL_LABEL, self.display, EDITOR_CNT_IMAGE)
+
+    def parse_list(self, out, ret):
+        if ret != 0:
+            return []
+        return [tuple(l.split()) for l in (out or "").splitlines()
+                if len(l.split()) == 2]
+
+    def list_pool(self):
+        """
+        return [(container id, name)] of running pool containers for our display
+        """
+        return self.parse_list(*self.exec_cmd(self.list_cmd(), silent=True))
+
+    def create(self):
+        """
+        coroutine creating and starting one pool container, results in
+        True on success
+        """
+        name = POOL_PREFIX + binascii.hexlify(os.urandom(4))
+        opts = resources.docker_opts(self.mgr.resource_profile, resources.POOL_SEAT)
+        opts += " --label %s=%s" % (POOL_LABEL, self.display)
+        src_volume = None
+        if self.mgr.storage != None:
+            src_volume = self.mgr.storage.create_volume(name)
+        # pool containers are bound to our X display
+        cmd = editor_create_cmd(name,
+                X11Backend(self.mgr).create_opts(name, self.display, self.xauth_file),
+                opts, src_volume=src_volume)
+        out, ret = yield self.exec_cmd_async(cmd, silent=True,
+                priority=scheduler.PRIO_BACKGROUND)
+        if ret != 0:
+            raise eventloop.Return(False)
+        cnt_id = out.strip()
+        if self.xauth_file:
+            yield self.exec_cmd_async("docker cp %s %s:/home/user/.Xauthority" % (
+                self.xauth_file, cnt_id), silent=True, priority=scheduler.PRIO_BACKGROUND)
+        out, ret = yield self.exec_cmd_async("docker start %s" % cnt_id, silent=True,
+                priority=scheduler.PRIO_BACKGROUND)
+        if ret != 0:
+            yield self.exec_cmd_async("docker rm -f -v %s" % cnt_id, silent=True)
+            raise eventloop.Return(False)
+        logging.info("pool: started editor container %s", name)
+        raise eventloop.Return(True)
+
+    def fill_async(self):
+        """
+        coroutine creating the missing containers concurrently, admission
+        control limits how many are created at the same time
+        """
+        loop = eventloop.get_loop()
+        out, ret = yield self.exec_cmd_async(self.list_cmd(), silent=True)
+        missing = self.size - len(self.parse_list(out, ret))
+        jobs = [loop.spawn(self.create(), "pool-create") for i in range(missing)]
+        for job in jobs:
+            ok = yield job
+            if not ok:
+                logging.error("pool: could not create editor container")
+
+    def fill(self):
+        with self.fill_lock:
+            eventloop.run(self.fill_async())
+
+    def refill(self):
+        """
+        fill the pool in the background, on the event loop if there is one
+        or in a thread
+        """
+        if self.mgr.loop != None:
+            if self.fill_job == None or self.fill_job.done():
+                self.mgr.loop.call_soon(self.start_fill_job)
+            return
+        if self.filler != None and self.filler.is_alive():
+            return
+        self.filler = threading.Thread(target=self.fill, name="editor-pool")
+        self.filler.daemon = True
+        self.filler.start()
+
+    def start_fill_job(self):
+        if self.fill_job == None or self.fill_job.done():
+            self.fill_job = self.mgr.loop.spawn(self.fill_async(), "pool-fill")
+
+    def claim(self, seat, display):
+        """
+        rename a pool container to exp_<seat>, returns its id or None if the
+        pool is empty
+        """
+        cnt_id = None
+        if display == self.display:
+            for c_id, name in self.list_pool():
+                out, ret = self.exec_cmd("docker rename %s exp_%s" % (name, seat),
+                        silent=True)
+                if ret == 0:
+                    cnt_id = c_id
+                    break
+                # claimed by another controller in the meantime
+        if cnt_id != None:
+            logging.info("pool: claimed %s for seat %s", cnt_id, seat)
+        else:
+            logging.info("pool: no editor container available for seat %s", seat)
+        self.refill()
+        return cnt_id
+
+    def drain(self):
+        ids = [c_id for c_id, name in self.list_pool()]
+        if ids:
+            self.exec_cmd("docker rm -f -v %s" % " ".join(ids))
+        return len(ids)
+
+    def run_async(self, args):
+        if args != ["fill"] or self.mgr.loop == None:
+            return None
+        return self.fill_and_report()
+
+    def fill_and_report(self):
+        self.start_fill_job()
+        yield self.fill_job
+        self.mgr.cmdline.notify("%d of %d editor container(s) ready for display %s" % (
+            len(self.list_pool()), self.size, self.display))
+
+    def run(self, args):
+        if args == ["fill"]:
+            self.fill()
+        elif args == ["drain"]:
+            print "removed %d pool container(s)" % self.drain()
+            return
+        elif args:
+            print self.help_msg()
+            return
+        pool = self.list_pool()
+        print "%d of %d editor container(s) ready for display %s" % (len(pool),
+                self.size, self.display)
+        for c_id, name in pool:
+            print "  %s %s" % (c_id[:12], name)
@@ -0,0 +1,406 @@
+#!/usr/bin/env python2.7
+
+import os
+import sys
+import time
+import heapq
+import fcntl
+import errno
+import select
+import logging
+import threading
+import traceback
+import subprocess
+import types
+
+
+# waiting for the exit of a process whose pipes are closed (seconds)
+EXIT_POLL_MIN = 0.005
+EXIT_POLL_MAX = 0.2
+
+
+class Return(Exception):
+    """
+    raise Return(value) to end a coroutine with a result (generators can't
+    return values in python 2)
+    """
+
+    def __init__(self, value=None):
+        Exception.__init__(self, value)
+        self.value = value
+
+
+class Future(object):
+    """
+    result of an operation that completes later, coroutines wait for it by
+    yielding it. Callbacks run in the loop thread.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.finished = False
+        self.value = None
+        self.exc_info = None
+        self.callbacks = []
+
+    def done(self):
+        return self.finished
+
+    def result(self):
+        if not self.finished:
+            raise RuntimeError("future not done yet")
+        if self.exc_info != None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+    def add_done_callback(self, cb):
+        if self.finished:
+            self.loop.call_soon(cb, self)
+        else:
+            self.callbacks.append(cb)
+
+    def set_result(self, value):
+        self.value = value
+        self.complete()
+
+    def set_exception(self, exc_info):
+        self.exc_info = exc_info
+        self.complete()
+
+    def complete(self):
+        if self.finished:
+            return
+        self.finished = True
+        for cb in self.callbacks:
+            self.loop.call_soon(cb, self)
+        self.callbacks = []
+
+
+class Coroutine(Future):
+    """
+    drives a generator: every yielded Future suspends it until the future
+    is done, its result (or exception) is sent back into the generator.
+    A yielded generator runs as nested coroutine, yielding None just lets
+    other callbacks run.
+    """
+
+    def __init__(self, loop, gen, name=None):
+        Future.__init__(self, loop)
+        self.gen = gen
+        self.name = name or getattr(gen, "__name__", "coroutine")
+        loop.call_soon(self.step)
+
+    def step(self, value=None, exc_info=None):
+        try:
+            if exc_info != None:
+                yielded = self.gen.throw(*exc_info)
+            else:
+                yielded = self.gen.send(value)
+        except StopIteration:
+            self.set_result(None)
+            return
+        except Return, r:
+            self.set_result(r.value)
+            return
+        except:
+            self.set_exception(sys.exc_info())
+            return
+
+        if isinstance(yielded, types.GeneratorType):
+            yielded = Coroutine(self.loop, yielded)
+        if yielded == None:
+            self.loop.call_soon(self.step)
+        elif isinstance(yielded, Future):
+            yielded.add_done_callback(self.wakeup)
+        else:
+            self.loop.call_soon(self.step, None, (TypeError,
+                TypeError("coroutine %s yielded %r" % (self.name, yielded)), None))
+
+    def wakeup(self, future):
+        try:
+            value = future.result()
+        except:
+            self.step(None, sys.exc_info())
+        else:
+            self.step(value)
+
+
+class Handle(object):
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def __lt__(self, other):
+        return self.when < other.when
+
+
+_current = threading.local()
+
+
+def get_loop():
+    """
+    the loop running in this thread, None outside of a loop
+    """
+    return getattr(_current, "loop", None)
+
+
+class EventLoop(object):
+    """
+    Single threaded event loop: file descriptor readiness via select(),
+    timers and callbacks. call_soon, call_later and run_sync may be called
+    from any thread, everything else only from the loop thread.
+    """
+
+    def __init__(self):
+        self.ready = []
+        self.timers = []
+        self.readers = {}
+        self.writers = {}
+        self.lock = threading.Lock()
+        self.running = False
+        self.thread = None
+        # wakes select() up when other threads add callbacks
+        self.wake_r, self.wake_w = os.pipe()
+        for fd in (self.wake_r, self.wake_w):
+            set_nonblocking(fd)
+
+    def in_loop_thread(self):
+        return self.thread == threading.current_thread()
+
+    def wake(self):
+        if self.in_loop_thread():
+            return
+        try:
+            os.write(self.wake_w, "x")
+        except OSError, err:
+            if err.errno != errno.EAGAIN:
+                raise
+
+    def call_soon(self, callback, *args):
+        handle = Handle(None, callback, args)
+        with self.lock:
+            self.ready.append(handle)
+        self.wake()
+        return handle
+
+    def call_later(self, delay, callback, *args):
+        handle = Handle(time.time() + delay, callback, args)
+        with self.lock:
+            heapq.heappush(self.timers, handle)
+        self.wake()
+        return handle
+
+    def add_reader(self, fd, callback, *args):
+        self.readers[fd] = (callback, args)
+
+    def remove_reader(self, fd):
+        self.readers.pop(fd, None)
+
+    def add_writer(self, fd, callback, *args):
+        self.writers[fd] = (callback, args)
+
+    def remove_writer(self, fd):
+        self.writers.pop(fd, None)
+
+    def spawn(self, gen, name=None):
+        """
+        run a generator as coroutine, returns its Coroutine (a Future)
+        """
+        return Coroutine(self, gen, name)
+
+    def sleep(self, seconds):
+        f = Future(self)
+        self.call_later(seconds, f.set_result, None)
+        return f
+
+    def run_in_thread(self, func, *args):
+        """
+        run a blocking function in a thread, returns a Future of its result
+        """
+        f = Future(self)
+
+        def run():
+            try:
+                value = func(*args)
+            except:
+                self.call_soon(f.set_exception, sys.exc_info())
+            else:
+                self.call_soon(f.set_result, value)
+
+        t = threading.Thread(target=run, name="loop-%s" % getattr(func, "__name__", "call"))
+        t.daemon = True
+        t.start()
+        return f
+
+    def run_sync(self, gen):
+        """
+        run a coroutine from another thread and wait for its result
+        """
+        done = threading.Event()
+        box = []
+
+        def start():
+            c = self.spawn(gen)
+            c.add_done_callback(lambda f: (box.append(f), done.set()))
+
+        self.call_soon(start)
+        done.wait()
+        return box[0].result()
+
+    def close(self):
+        os.close(self.wake_r)
+        os.close(self.wake_w)
+
+    def stop(self):
+        self.running = False
+        self.wake()
+
+    def run_until_complete(self, gen):
+        c = self.spawn(gen)
+        c.add_done_callback(lambda f: self.stop())
+        self.run_forever()
+        return c.result()
+
+    def run_forever(self):
+        self.thread = threading.current_thread()
+        outer = get_loop()
+        _current.loop = self
+        self.running = True
+        self.add_reader(self.wake_r, self.drain_wake)
+        try:
+            while self.running:
+                self.run_once()
+        finally:
+            self.remove_reader(self.wake_r)
+            _current.loop = outer
+            self.thread = None
+
+    def drain_wake(self):
+        try:
+            while os.read(self.wake_r, 4096):
+                pass
+        except OSError, err:
+            if err.errno != errno.EAGAIN:
+                raise
+
+    def run_once(self):
+        with self.lock:
+            if self.ready:
+                timeout = 0
+            elif self.timers:
+                timeout = max(0, self.timers[0].when - time.time())
+            else:
+                timeout = None
+        try:
+            r, w, x = select.select(self.readers.keys(), self.writers.keys(), [],
+                    timeout)
+        except select.error, err:
+            if err.args[0] != errno.EINTR:
+                raise
+            r, w = [], []
+        for fd in r:
+            if fd in self.readers:
+                self.ready.append(Handle(None, *self.readers[fd]))
+        for fd in w:
+            if fd in self.writers:
+                self.ready.append(Handle(None, *self.writers[fd]))
+
+        now = time.time()
+        with self.lock:
+            while self.timers and self.timers[0].when <= now:
+                self.ready.append(heapq.heappop(self.timers))
+            ready, self.ready = self.ready, []
+
+        for handle in ready:
+            if handle.cancelled:
+                continue
+            try:
+                handle.callback(*handle.args)
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except:
+                logging.error("error in event loop callback %r:\n%s",
+                        handle.callback, traceback.format_exc())
+
+
+def set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+def read_pipe(loop, fileobj):
+    """
+    Future of everything read from a pipe until EOF
+    """
+    f = Future(loop)
+    fd = fileobj.fileno()
+    set_nonblocking(fd)
+    chunks = []
+
+    def readable():
+        try:
+            data = os.read(fd, 65536)
+        except OSError, err:
+            if err.errno == errno.EAGAIN:
+                return
+            data = ""
+        if data:
+            chunks.append(data)
+            return
+        loop.remove_reader(fd)
+        fileobj.close()
+        f.set_result("".join(chunks))
+
+    loop.add_reader(fd, readable)
+    return f
+
+
+def wait_process(loop, p):
+    """
+    Future of the return code of a process, polled with back off once its
+    output is read
+    """
+    f = Future(loop)
+
+    def check(delay):
+        if p.poll() != None:
+            f.set_result(p.returncode)
+        else:
+            loop.call_later(delay, check, min(delay * 2, EXIT_POLL_MAX))
+
+    check(EXIT_POLL_MIN)
+    return f
+
+
+def run_process(loop, cmd):
+    """
+    coroutine running cmd (argument list) without blocking the loop,
+    results in (stdout, stderr, returncode)
+    """
+    with open(os.devnull) as null:
+        p = subprocess.Popen(cmd, stdin=null, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE, close_fds=True)
+    # both pipes are read at the same time, either one may fill up first
+    out_f = read_pipe(loop, p.stdout)
+    err_f = read_pipe(loop, p.stderr)
+    out = yield out_f
+    err = yield err_f
+    ret = yield wait_process(loop, p)
+    raise Return((out, err, ret))
+
+
+def run(gen):
+    """
+    run a coroutine to completion on a private loop in the calling thread,
+    for blocking callers of coroutine code
+    """
+    loop = EventLoop()
+    try:
+        return loop.run_until_complete(gen)
+    finally:
+        loop.close()
@@ -1,22 +1,74 @@
 #!/usr/bin/env python2.7
 
 
+# status of a slot of an experiment's plan
+SLOT_PENDING = "pending"
+SLOT_RUNNING = "running"
+SLOT_DONE = "done"
+
+
+class Plan(object):
+    """
+    The tasks of a group compiled into slots. A task id may appear in several
+    slots (e.g. the questionnaires), such slots are labeled <id>@<n> with n
+    counting the occurrences of the id. A plan never changes once compiled,
+    experiments of the same group share it.
+    """
+
+    def __init__(self, tasks):
+        self.tasks = tuple(tasks)
+
+        positions = {}
+        for i, t in enumerate(self.tasks):
+            positions.setdefault(t.id, []).append(i)
+        self.positions = dict([(k, tuple(v)) for k, v in positions.items()])
+
+        labels = []
+        seen = {}
+        for t in self.tasks:
+            seen[t.id] = seen.get(t.id, 0) + 1
+            if len(self.positions[t.id]) > 1:
+                labels.append("%s@%d" % (t.id, seen[t.id]))
+            else:
+                labels.append(t.id)
+        self.labels = tuple(labels)
+        self.label_positions = dict([(l, i) for i, l in enumerate(self.labels)])
+
+        # expected remaining time from each slot on, in minutes
+        remaining = [0] * (len(self.tasks) + 1)
+        for i in range(len(self.tasks) - 1, -1, -1):
+            remaining[i] = remaining[i + 1] + (self.tasks[i].duration or 0)
+        self.remaining = tuple(remaining)
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def get_positions(self, task_id):
+        return self.positions.get(task_id, ())
+
+
 class Experiment(object):
 
-    def __init__(self, group_name, user_name, tasks):
+    def __init__(self, group_name, user_name, plan):
         self.group_name = group_name
         self.user_name = user_name
-        self.tasks = tasks
+        if not isinstance(plan, Plan):
+            plan = Plan(plan)
+        self.plan = plan
+        self.tasks = plan.tasks
+        self.status = [SLOT_PENDING] * len(plan)
 
         self.cnt_id = None
+        # agent hosting the containers in coordinator mode
+        self.agent = None
         self.current_task = None
         self.current_task_index = None
 
     def get_task_ids(self):
-        ids = []
-        for i in self.tasks:
-            ids.append(i.id)
-        return ids
+        """
+        slot labels of the plan, <id>@<n> for repeated task ids
+        """
+        return self.plan.labels
 
     def get_current_task(self):
         return self.current_task
@@ -24,49 +76,65 @@ class Experiment(object):
     def get_current_task_index(self):
         return self.current_task_index
 
+    def get_current_task_status(self):
+        if self.current_task_index == None:
+            return None
+        return self.status[self.current_task_index]
+
     def get_number_of_tasks(self):
-        return len(self.tasks)
+        return len(self.plan)
 
     def get_expected_remaining_time(self):
-        t = 0
-        for i in range(self.current_task_index, len(self.tasks)):
-            if self.tasks[i].duration != None:
-                t += self.tasks[i].duration
-        return t
-
-    def set_current_task_id(self, task_id):
-        i = 0
-        new_task = None
-        for t in self.tasks:
-            if t.id == task_id:
-                new_task = t
-                break
-            i += 1
+        return self.plan.remaining[self.current_task_index or 0]
+
+    def resolve(self, label):
+        """
+        return the slot of a label. A bare repeated task id selects its first
+        slot which is not done yet
+        """
+        pos = self.plan.label_positions.get(label)
+        if pos != None:
+            return pos
+        positions = self.plan.get_positions(label)
+        if not positions:
+            raise NameError("task %s not found" % label)
+        for pos in positions:
+            if self.status[pos] != SLOT_DONE:
+                return pos
+        return positions[0]
+
+    def seek(self, pos):
+        if pos < 0 or pos >= len(self.plan):
+            raise IndexError("slot %d not in plan" % pos)
+        self.current_task_index = pos
+        self.current_task = self.plan.tasks[pos]
+        self.status[pos] = SLOT_RUNNING
+        return self.current_task
 
-        if new_task == None:
-            raise NameError("task %s not found" % task_id)
+    def set_current_task_id(self, label):
+        self.seek(self.resolve(label))
 
-        self.current_task = new_task
-        self.current_task_index = i
+    def finish_current(self):
+        if self.current_task_index != None:
+            self.status[self.current_task_index] = SLOT_DONE
 
+    def redo(self):
+        """
+        run the current slot again
+        """
+        if self.current_task_index == None:
+            return None
+        return self.seek(self.current_task_index)
 
     def next_task(self):
-        try:
-            if self.current_task == None:
-                self.current_task_index = 0
-                self.current_task = self.tasks[self.current_task_index]
+        if self.current_task_index == None:
+            pos = 0
+        else:
+            self.finish_current()
+            pos = self.current_task_index + 1
 
-            else:
-                self.current_task_index += 1
-                if self.current_task_index >= len(self.tasks):
-                    self.current_task_index = None
-                    self.current_task = None
-                else:
-                    self.current_task = self.tasks[self.current_task_index]
-        except ValueError:
+        if pos >= len(self.plan):
             self.current_task_index = None
             self.current_task = None
-
-        return self.current_task
-
-
+            return None
+        return self.seek(pos)
@@ -0,0 +1,186 @@
+#!/usr/bin/env python2.7
+
+import os
+import time
+import logging
+import subprocess
+
+from basic_commands import ExecCommand, get_required_images
+from pgzip import ParallelGzipWriter
+import metrics
+
+
+DEFAULT_BUNDLE = "experiment-images.tar.gz"
+
+READ_SIZE = 1 << 20
+
+
+def format_transfer(size, elapsed):
+    return "%.1f MiB in %.1fs (%.1f MiB/s)" % (size / 1048576.0, elapsed,
+            size / 1048576.0 / max(elapsed, 0.001))
+
+
+class ExportImages(ExecCommand):
+    def __init__(self, mgr):
+        self.set_mgr(mgr)
+
+    def get_keyword(self):
+        return "export_images"
+
+    def desctiption(self):
+        return "write all experiment images into a single bundle file"
+
+    def help_msg(self):
+        return "%s: [bundle file] [compression threads]\n" \
+               "    default file: '%s'" % (self.get_keyword(), DEFAULT_BUNDLE)
+
+    def run(self, args):
+        if len(args) > 2:
+            print self.help_msg()
+            return False
+
+        bundle = args[0] if args else DEFAULT_BUNDLE
+        threads = None
+        if len(args) == 2:
+            try:
+                threads = int(args[1])
+            except ValueError:
+                print self.help_msg()
+                return False
+
+        images = get_required_images(self.mgr)
+        missing = []
+        for image in images:
+            out, ret = self.exec_cmd("docker inspect --format '{{.Id}}' %s" % image,
+                    silent=True)
+            if ret != 0:
+                missing.append(image)
+        if missing:
+            print "the following images are missing, use 'pull_images' first:"
+            for image in missing:
+                print "  %s" % image
+            return False
+
+        # a single 'docker save' writes layers shared by several images once
+        docker_cmd = ["docker", "save"] + images
+        logging.info("exporting images to %s: %s", bundle, images)
+        print "exporting %d images to %s ..." % (len(images), bundle)
+
+        start = time.time()
+        tmp = bundle + ".tmp"
+        ret = None
+        try:
+            with self.mgr.admission.admit(docker_cmd):
+                p = subprocess.Popen(docker_cmd, stdout=subprocess.PIPE)
+                try:
+                    with open(tmp, "wb") as f:
+                        gz = ParallelGzipWriter(f, threads)
+                        try:
+                            for data in iter(lambda: p.stdout.read(READ_SIZE), b""):
+                                gz.write(data)
+                        finally:
+                            gz.close()
+                    ret = p.wait()
+                finally:
+                    if ret == None:
+                        # write error (e.g. disk full) or interrupt
+                        p.kill()
+                        p.wait()
+                    p.stdout.close()
+        except (OSError, IOError), err:
+            logging.error("error exporting images: %s", err)
+            print "error exporting images: %s" % err
+            return False
+        finally:
+            if ret != 0 and os.path.exists(tmp):
+                os.unlink(tmp)
+
+        if ret != 0:
+            logging.error("docker save failed with %s", ret)
+            print "error running docker save"
+            return False
+
+        os.rename(tmp, bundle)
+        elapsed = time.time() - start
+        metrics.observe_transfer("export_images", gz.bytes_in, elapsed)
+        logging.info("exported images: %d bytes -> %d bytes in %.1fs",
+                gz.bytes_in, gz.bytes_out, elapsed)
+        print "exported %s, bundle size %.1f MiB" % (
+                format_transfer(gz.bytes_in, elapsed), gz.bytes_out / 1048576.0)
+        return True
+
+
+class LoadImages(ExecCommand):
+    def __init__(self, mgr):
+        self.set_mgr(mgr)
+
+    def get_keyword(self):
+        return "load_images"
+
+    def desctiption(self):
+        return "load all experiment images from a bundle file"
+
+    def help_msg(self):
+        return "%s: [bundle file]\n" \
+               "    default file: '%s'" % (self.get_keyword(), DEFAULT_BUNDLE)
+
+    def run(self, args):
+        if len(args) > 1:
+            print self.help_msg()
+            return False
+
+        bundle = args[0] if args else DEFAULT_BUNDLE
+        if not os.path.isfile(bundle):
+            print "bundle %s not found" % bundle
+            return False
+
+        # the bundle is streamed into docker load, which decompresses it and
+        # tags the images in the same pass
+        docker_cmd = ["docker", "load"]
+        logging.info("loading images from %s", bundle)
+        print "loading images from %s ..." % bundle
+
+        start = time.time()
+        size = 0
+        ret = None
+        try:
+            with self.mgr.admission.admit(docker_cmd):
+                p = subprocess.Popen(docker_cmd, stdin=subprocess.PIPE,
+                        stdout=subprocess.PIPE)
+                try:
+                    with open(bundle, "rb") as f:
+                        for data in iter(lambda: f.read(READ_SIZE), b""):
+                            p.stdin.write(data)
+                            size += len(data)
+                    p.stdin.close()
+                    out = p.stdout.read()
+                    ret = p.wait()
+                finally:
+                    if ret == None:
+                        # read error, docker load gone (EPIPE) or interrupt
+                        p.kill()
+                        p.wait()
+                    p.stdin.close()
+                    p.stdout.close()
+        except (OSError, IOError), err:
+            logging.error("error loading images: %s", err)
+            print "error loading images: %s" % err
+            return False
+
+        elapsed = time.time() - start
+        logging.debug("docker load: returncode: %s, stdout: '%s'", ret, out)
+        if ret != 0:
+            print "error running docker load"
+            return False
+
+        print out.strip()
+        loaded = [l.split(":", 1)[1].strip() for l in out.splitlines()
+                if l.startswith("Loaded image:")]
+        missing = [i for i in get_required_images(self.mgr) if not i in loaded]
+        if missing:
+            print "warning: bundle does not contain: %s" % ", ".join(missing)
+
+        metrics.observe_transfer("load_images", size, elapsed)
+        logging.info("loaded %d bytes in %.1fs", size, elapsed)
+        print "loaded %s" % format_transfer(size, elapsed)
+        return True
@@ -0,0 +1,230 @@
+#!/usr/bin/env python2.7
+
+import os
+import sys
+import time
+import logging
+import threading
+import traceback
+
+from basic_commands import PullImages, EDITOR_CNT_IMAGE, DEFAULT_IMAGE_PREFIX, \
+        REGISTRY_MIRROR_ENV, get_required_images
+
+
+# assumed time of a pull (seconds) until the first one of this run finished
+DEFAULT_PULL_SECONDS = 60
+
+# a failed image is tried again after this many seconds
+RETRY_DELAY = 60
+
+
+def format_duration(seconds):
+    if seconds >= 90:
+        return "~%dm" % int(round(seconds / 60.0))
+    return "~%ds" % int(seconds)
+
+
+class ImageScheduler(object):
+    """
+    Fetches the missing images in the background in the order they are
+    first needed: the editor first, then the images of the running
+    experiment's remaining slots, then by the earliest slot using them in
+    any group plan. Experiments can start as soon as the editor image is
+    there, Task.start only waits if its own image is still missing.
+    """
+
+    def __init__(self, mgr, prefix=DEFAULT_IMAGE_PREFIX, mirror=None):
+        self.mgr = mgr
+        self.prefix = prefix
+        if mirror == None:
+            mirror = os.environ.get(REGISTRY_MIRROR_ENV)
+        self.mirror = mirror
+        self.puller = PullImages(mgr, quiet=True)
+        self.cond = threading.Condition()
+        # images still to fetch, None until the local images are listed
+        self.missing = None
+        # image -> time of the last failed pull
+        self.failed = {}
+        # (image, start time) of the running pull
+        self.current = None
+        # durations of the finished pulls
+        self.durations = []
+        # an image Task.start waits for goes first
+        self.urgent = None
+        # why the scheduler stopped, None while it works
+        self.error = None
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.work, name="image-scheduler")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def first_needs(self):
+        """
+        {image: rank}, images with lower ranks are needed earlier
+        """
+        ranks = {}
+
+        def need(image, rank):
+            if not image in ranks or rank < ranks[image]:
+                ranks[image] = rank
+
+        for image in [EDITOR_CNT_IMAGE] + self.mgr.display.images():
+            need(image, (0, -1))
+        exp = self.mgr.get_experiment()
+        if exp != None:
+            start = exp.get_current_task_index() or 0
+            for i, t in enumerate(exp.tasks[start:]):
+                if hasattr(t, 'cnt_image'):
+                    need(t.cnt_image, (0, i))
+        for name in sorted(self.mgr.get_group_names()):
+            for i, t in enumerate(self.mgr.get_plan(name).tasks):
+                if hasattr(t, 'cnt_image'):
+                    need(t.cnt_image, (1, i))
+        return ranks
+
+    def next_image(self):
+        """
+        the missing image to fetch next, None if all remaining ones failed
+        recently (call with self.cond held)
+        """
+        now = time.time()
+        ranks = self.first_needs()
+        candidates = [i for i in self.missing if i == self.urgent or
+                now - self.failed.get(i, 0) >= RETRY_DELAY]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda i: (i != self.urgent,
+            ranks.get(i, (2, 0)), i))
+
+    def list_missing(self):
+        self.mgr.probes.invalidate("images")
+        r = self.mgr.probes.get("images")
+        if r.value == None:
+            # can't list the images, try to fetch all of them
+            return get_required_images(self.mgr)
+        return r.value
+
+    def work(self):
+        try:
+            self.fetch_all()
+        except:
+            logging.error("image scheduler failed:\n%s", traceback.format_exc())
+            with self.cond:
+                self.error = str(sys.exc_info()[1]) or sys.exc_info()[0].__name__
+                self.current = None
+                self.cond.notify_all()
+
+    def fetch_all(self):
+        missing = self.list_missing()
+        with self.cond:
+            self.missing = set(missing)
+            self.cond.notify_all()
+        logging.info("image scheduler: %d image(s) to fetch", len(missing))
+
+        while True:
+            with self.cond:
+                if not self.missing:
+                    break
+                image = self.next_image()
+                if image == None:
+                    self.cond.wait(RETRY_DELAY / 4.0)
+                    continue
+                self.current = (image, time.time())
+            logging.info("image scheduler: fetching %s", image)
+
+            # pull_images may have pinned images meanwhile
+            loaded = self.puller.load_pins()
+            pins = dict(loaded)
+            ok = self.puller.pull_image(image, self.prefix, self.mirror, pins)
+            with self.cond:
+                duration = time.time() - self.current[1]
+                self.current = None
+                if ok:
+                    self.missing.discard(image)
+                    self.durations.append(duration)
+                    self.failed.pop(image, None)
+                else:
+                    self.failed[image] = time.time()
+                self.cond.notify_all()
+            if ok:
+                self.puller.update_pins(pins, loaded)
+                logging.info("image scheduler: %s available after %.0fs", image, duration)
+            else:
+                logging.error("image scheduler: fetching %s failed, retry in %ds",
+                        image, RETRY_DELAY)
+
+        self.mgr.probes.invalidate("images")
+        logging.info("image scheduler: all images available")
+
+    def remaining(self):
+        """
+        (number of missing images, estimated seconds until all are fetched)
+        """
+        with self.cond:
+            if self.missing == None:
+                return (None, None)
+            if self.durations:
+                per_image = sum(self.durations) / len(self.durations)
+            else:
+                per_image = DEFAULT_PULL_SECONDS
+            seconds = per_image * len(self.missing)
+            if self.current != None:
+                seconds -= min(per_image, time.time() - self.current[1])
+            return (len(self.missing), max(0, seconds))
+
+    def status(self):
+        """
+        short state for the prompt, None once all images are there
+        """
+        if self.error != None:
+            return "images: scheduler failed"
+        count, seconds = self.remaining()
+        if count == None:
+            return "images: listing"
+        if count == 0:
+            return None
+        return "images: %d left %s" % (count, format_duration(seconds))
+
+    def wait_for(self, image):
+        """
+        block until image is available, returns False if fetching it failed
+        """
+        with self.cond:
+            while self.missing == None and self.error == None:
+                self.cond.wait(1)
+            failed = self.error != None
+            if not failed and not image in self.missing:
+                return True
+            self.urgent = image
+            self.cond.notify_all()
+        if failed:
+            return self.check_after_error(image)
+        print "waiting for image %s (%s) ..." % (image, self.status())
+        start = time.time()
+        with self.cond:
+            while image in self.missing and self.failed.get(image, 0) < start and \
+                    self.error == None:
+                self.cond.wait(1)
+            if self.urgent == image:
+                self.urgent = None
+            failed = self.error != None
+            if not failed and image in self.missing:
+                print "error: could not fetch image %s" % image
+                return False
+        if failed:
+            return self.check_after_error(image)
+        logging.info("waited %.0fs for image %s", time.time() - start, image)
+        return True
+
+    def check_after_error(self, image):
+        """
+        wait_for() once the scheduler failed: the image may have been pulled
+        with pull_images since
+        """
+        if not image in self.list_missing():
+            return True
+        print "error: fetching images in the background failed (%s), use 'pull_images'" % (
+                self.error)
+        return False
@@ -4,8 +4,15 @@ import os
 import sys
 import subprocess
 import logging
+import time
 
 import commandline
+import scheduler
+import resources
+import metrics
+import probes
+import display
+from experiment import Plan
 
 
 class Manager(object):
@@ -13,11 +20,18 @@ class Manager(object):
     def __init__(self):
         self.editor_cnt_id = None
         self.devmode = False
+        self.resource_profile = resources.DEFAULT_PROFILE
         self.cmdline = commandline.CommandLine()
+        self.admission = scheduler.AdmissionControl()
+        self.probes = probes.Probes(self)
+        # how the participant sees the editor, see display.py
+        self.display = display.X11Backend(self)
 
         self.task_list = []
         self.groups = {}
         self.tasks = {}
+        # compiled plans per group
+        self.plans = {}
 
         self.current_group = None
         self.current_task = None
@@ -25,6 +39,28 @@ class Manager(object):
 
         self.current_experiment = None
 
+        # set in coordinator mode, seats are placed on agent hosts
+        self.coordinator = None
+
+        # pre-started editor containers, None if disabled
+        self.editor_pool = None
+
+        # shared skeleton with per seat overlays, None in copy mode
+        self.storage = None
+
+        # background uploads to the collection server, None if not configured
+        self.uploader = None
+
+        # event loop of the async command line (--async), None if blocking
+        self.loop = None
+
+        # background fetching of missing images, None if disabled
+        self.image_scheduler = None
+
+        # background checkpoints of the running seat, None if disabled
+        self.checkpointer = None
+        self.task_start_time = None
+
     #def set_editor_container_id(self, _id):
     #    self.editor_cnt_id = _id
 
@@ -33,6 +69,23 @@ class Manager(object):
             return self.current_experiment.cnt_id
         return None
 
+    def get_agent(self):
+        """
+        agent of the current experiment, None if containers run locally
+        """
+        if self.current_experiment != None:
+            return self.current_experiment.agent
+        return None
+
+    def get_docker_cli(self):
+        """
+        docker client command line for the current experiment's containers
+        """
+        agent = self.get_agent()
+        if agent != None:
+            return agent.docker_cli()
+        return "docker"
+
     def is_started(self):
         # if we have set an experiment and a cnt_id
         return self.get_editor_container_id() != None
@@ -40,6 +93,27 @@ class Manager(object):
     def set_devmode(self, mode):
         self.devmode = mode
 
+    def set_resource_profile(self, name):
+        if not name in resources.RESOURCE_PROFILES:
+            raise NameError("resource profile %s not defined" % name)
+        self.resource_profile = name
+
+    def get_resource_opts(self):
+        """
+        docker options limiting the containers of the current experiment's seat
+        """
+        exp = self.get_experiment()
+        return resources.docker_opts(self.resource_profile,
+                resources.seat_name(exp.group_name, exp.user_name))
+
+    def use_event_loop(self, loop):
+        """
+        switch to the non-blocking command line, call before registering
+        commands
+        """
+        self.loop = loop
+        self.cmdline = commandline.AsyncCommandLine(loop)
+
     def shutdown(self):
         logging.info("shutdown manager")
         self.cmdline.shutdown()
@@ -80,6 +154,7 @@ class Manager(object):
                 raise NameError("task %s does not exist" % i)
 
         self.groups[name] = task_ids
+        self.plans.pop(name, None)
 
     def has_group(self, name):
         return name in self.groups
@@ -93,17 +168,48 @@ class Manager(object):
             ret.append(self.get_task(i))
         return ret
 
+    def get_plan(self, group_name):
+        if not group_name in self.plans:
+            self.plans[group_name] = Plan(self.get_tasks_for_group(group_name))
+        return self.plans[group_name]
+
     def start_experiment(self, experiment):
         logging.info("start experiment: group: %s, user: %s",
                 experiment.group_name, experiment.user_name)
         self.current_experiment = experiment
         self.cmdline.set_prompt("(%s) %s" % (experiment.group_name, experiment.user_name))
+        metrics.SEATS_ACTIVE.set(1)
 
     def get_experiment(self):
         return self.current_experiment
 
     def stop_experiment(self):
         logging.info("stop experiment")
+        exp = self.current_experiment
+        if self.coordinator != None and exp != None:
+            self.coordinator.release("%s_%s" % (exp.group_name, exp.user_name))
         self.current_experiment = None
+        self.current_task = None
         self.cmdline.set_prompt("")
-
+        metrics.SEATS_ACTIVE.set(0)
+        metrics.SEAT_TASK.clear()
+
+    def task_started(self, task):
+        # a restarted task keeps its start time
+        if self.current_task is task:
+            return
+        self.current_task = task
+        self.task_start_time = time.time()
+        exp = self.current_experiment
+        metrics.SEAT_TASK.clear()
+        metrics.SEAT_TASK.set(self.task_start_time,
+                seat=resources.seat_name(exp.group_name, exp.user_name),
+                task=task.id)
+
+    def task_finished(self, task):
+        # a restarted task reports its end once per restart
+        if not self.current_task is task:
+            return
+        self.current_task = None
+        metrics.SEAT_TASK.clear()
+        metrics.TASKS_FINISHED.inc(task=task.id)
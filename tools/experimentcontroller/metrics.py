@@ -0,0 +1,258 @@
+#!/usr/bin/env python2.7
+
+import os
+import json
+import time
+import logging
+import threading
+import SocketServer
+import BaseHTTPServer
+
+
+# buckets of the latency histograms (seconds)
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+
+# buckets of the display input latency (seconds)
+INPUT_LATENCY_BUCKETS = [0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0]
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    return "{%s}" % ",".join(['%s="%s"' % (n, str(v).replace('"', '\\"'))
+        for n, v in zip(names, values)])
+
+
+class Metric(object):
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        return tuple([labels.get(n, "") for n in self.labels])
+
+    def header(self):
+        return ["# HELP %s %s" % (self.name, self.help),
+                "# TYPE %s %s" % (self.name, self.type)]
+
+    def expose(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        lines = self.header()
+        for key, value in items:
+            lines.append("%s%s %s" % (self.name, format_labels(self.labels, key),
+                repr(float(value))))
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        k = self.key(labels)
+        with self.lock:
+            self.values[k] = self.values.get(k, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def remove(self, **labels):
+        with self.lock:
+            self.values.pop(self.key(labels), None)
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        Metric.__init__(self, name, help, labels)
+        self.buckets = list(buckets)
+
+    def observe(self, value, **labels):
+        k = self.key(labels)
+        with self.lock:
+            if not k in self.values:
+                self.values[k] = [[0] * len(self.buckets), 0.0, 0]
+            h = self.values[k]
+            # buckets are cumulative
+            for i, b in enumerate(self.buckets):
+                if value <= b:
+                    h[0][i] += 1
+            h[1] += value
+            h[2] += 1
+
+    def expose(self):
+        with self.lock:
+            items = sorted([(k, (list(v[0]), v[1], v[2]))
+                for k, v in self.values.items()])
+        lines = self.header()
+        for key, (counts, total, n) in items:
+            le_labels = self.labels + ("le",)
+            for b, c in zip(self.buckets, counts):
+                lines.append("%s_bucket%s %d" % (self.name,
+                    format_labels(le_labels, key + (repr(b),)), c))
+            lines.append("%s_bucket%s %d" % (self.name,
+                format_labels(le_labels, key + ("+Inf",)), n))
+            lines.append("%s_sum%s %s" % (self.name,
+                format_labels(self.labels, key), repr(total)))
+            lines.append("%s_count%s %d" % (self.name,
+                format_labels(self.labels, key), n))
+        return lines
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def expose(self):
+        lines = []
+        for m in self.metrics:
+            lines.extend(m.expose())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+SEATS_ACTIVE = REGISTRY.register(Gauge("expctr_seats_active",
+    "number of active seats of this controller"))
+SEAT_TASK = REGISTRY.register(Gauge("expctr_seat_task_start_time_seconds",
+    "start time of the current task per seat", ("seat", "task")))
+TASKS_FINISHED = REGISTRY.register(Counter("expctr_tasks_finished_total",
+    "finished tasks", ("task",)))
+TIMEOUTS = REGISTRY.register(Counter("expctr_timeouts_total",
+    "help requests sent because of task timeouts", ("task",)))
+CONTAINER_OPS = REGISTRY.register(Histogram("expctr_container_op_seconds",
+    "latency of docker operations", ("op",)))
+TRANSFER_BYTES = REGISTRY.register(Counter("expctr_transfer_bytes_total",
+    "bytes pulled, exported or archived", ("kind",)))
+TRANSFER_SECONDS = REGISTRY.register(Counter("expctr_transfer_seconds_total",
+    "time spent pulling, exporting or archiving", ("kind",)))
+DISPLAY_BYTES = REGISTRY.register(Counter("expctr_display_relay_bytes_total",
+    "bytes forwarded by the display relay", ("direction",)))
+DISPLAY_INPUT_LATENCY = REGISTRY.register(Histogram("expctr_display_input_latency_seconds",
+    "time from input to the next screen update seen by the display relay",
+    buckets=INPUT_LATENCY_BUCKETS))
+
+
+def observe_transfer(kind, size, seconds):
+    TRANSFER_BYTES.inc(size, kind=kind)
+    TRANSFER_SECONDS.inc(seconds, kind=kind)
+
+
+def process_stats():
+    """
+    (resident memory in bytes, number of threads) of this process
+    """
+    rss = 0
+    threads = threading.active_count()
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    rss = int(line.split()[1]) * 1024
+                elif line.startswith("Threads:"):
+                    threads = int(line.split()[1])
+    except (IOError, ValueError):
+        pass
+    return (rss, threads)
+
+
+def expose_all():
+    rss, threads = process_stats()
+    text = REGISTRY.expose()
+    text += "# HELP process_resident_memory_bytes resident memory size\n"
+    text += "# TYPE process_resident_memory_bytes gauge\n"
+    text += "process_resident_memory_bytes %d\n" % rss
+    text += "# HELP process_threads number of OS threads\n"
+    text += "# TYPE process_threads gauge\n"
+    text += "process_threads %d\n" % threads
+    return text
+
+
+def status_snapshot():
+    now = time.time()
+    seats = []
+    with SEAT_TASK.lock:
+        items = sorted(SEAT_TASK.values.items())
+    for (seat, task), started in items:
+        seats.append({"seat": seat, "task": task,
+            "time_on_task": int(now - started)})
+    rss, threads = process_stats()
+    with TIMEOUTS.lock:
+        timeouts = sum(TIMEOUTS.values.values())
+    return {"time": int(now), "seats": seats, "timeouts": timeouts,
+            "rss": rss, "threads": threads}
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/metrics":
+            body = expose_all()
+            ctype = "text/plain; version=0.0.4"
+        elif self.path == "/status":
+            body = json.dumps(status_snapshot(), indent=1) + "\n"
+            ctype = "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # clients of the unix socket have no address
+        return "local"
+
+    def log_message(self, format, *args):
+        logging.debug("metrics: " + format, *args)
+
+
+class ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class ThreadedUnixHTTPServer(SocketServer.ThreadingMixIn,
+        SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = self.socket.accept()
+        return (request, ("local", 0))
+
+
+def start_server(address):
+    """
+    serve /metrics and /status in a background thread. address is a local
+    TCP port or 'unix:<path>'
+    """
+    if address.startswith("unix:"):
+        path = address[len("unix:"):]
+        if os.path.exists(path):
+            os.unlink(path)
+        server = ThreadedUnixHTTPServer(path, MetricsHandler)
+    else:
+        server = ThreadedHTTPServer(("127.0.0.1", int(address)), MetricsHandler)
+
+    t = threading.Thread(target=server.serve_forever, name="metrics")
+    t.daemon = True
+    t.start()
+    logging.info("metrics endpoint listening on %s", address)
+    return server
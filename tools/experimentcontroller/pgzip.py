@@ -0,0 +1,87 @@
+#!/usr/bin/env python2.7
+
+import zlib
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+
+# uncompressed size of a gzip member
+BLOCK_SIZE = 4 << 20
+
+# compression level
+GZIP_LEVEL = 6
+
+
+def compress_block(args):
+    data, level = args
+    # zlib releases the GIL while compressing, so threads scale
+    c = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return c.compress(data) + c.flush()
+
+
+class ParallelGzipWriter(object):
+    """
+    File like object writing a gzip file to fileobj. The data is split into
+    blocks which are compressed concurrently into separate gzip members.
+    Multi member gzip files are read by gzip, docker load and Python's gzip
+    module like a single stream.
+
+    At most 2 * threads blocks are held in memory.
+    """
+
+    def __init__(self, fileobj, threads=None, level=GZIP_LEVEL,
+            block_size=BLOCK_SIZE):
+        self.fileobj = fileobj
+        self.threads = threads or multiprocessing.cpu_count()
+        self.level = level
+        self.block_size = block_size
+        self.pool = ThreadPool(self.threads)
+        self.pending = collections.deque()
+        self.buf = []
+        self.buf_len = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def write(self, data):
+        self.bytes_in += len(data)
+        self.buf.append(data)
+        self.buf_len += len(data)
+        if self.buf_len >= self.block_size:
+            data = b"".join(self.buf)
+            # only full blocks, so the output does not depend on the sizes
+            # of the writes
+            end = len(data) - len(data) % self.block_size
+            for i in range(0, end, self.block_size):
+                self.submit(data[i:i + self.block_size])
+            self.buf = [data[end:]] if end < len(data) else []
+            self.buf_len = len(data) - end
+
+    def submit(self, block):
+        self.pending.append(self.pool.apply_async(compress_block,
+            ((block, self.level),)))
+        while len(self.pending) > 2 * self.threads:
+            self.write_next()
+
+    def write_next(self):
+        out = self.pending.popleft().get()
+        self.fileobj.write(out)
+        self.bytes_out += len(out)
+
+    def close(self):
+        try:
+            if self.buf_len or not self.bytes_in:
+                self.submit(b"".join(self.buf))
+                self.buf = []
+                self.buf_len = 0
+            while self.pending:
+                self.write_next()
+        finally:
+            self.pool.close()
+            self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,253 @@
+#!/usr/bin/env python2.7
+
+import os
+import re
+import time
+import shlex
+import logging
+import threading
+import subprocess
+
+from commandline import Command
+from basic_commands import get_required_images
+
+
+# probe results are reused for this long (seconds)
+PROBE_TTL = 300
+
+# SELinux types of files containers are allowed to read
+CONTAINER_FILE_TYPES = ["container_file_t", "svirt_sandbox_file_t"]
+
+SELINUX_POLICY = "tools/atom-allow-x0-access.pp"
+
+
+class ProbeResult(object):
+    def __init__(self, name, ok, value, detail=""):
+        self.name = name
+        self.ok = ok
+        self.value = value
+        self.detail = detail
+        self.time = time.time()
+        self.duration = 0.0
+
+
+def run(command):
+    """
+    run a probe command, returns (stdout, returncode), (None, -1) if it
+    could not be executed
+    """
+    try:
+        p = subprocess.Popen(shlex.split(command), stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE)
+        out, err = p.communicate()
+        return (out, p.returncode)
+    except OSError, err:
+        logging.debug("probe command %s failed: %s", command, err)
+        return (None, -1)
+
+
+def probe_display(mgr):
+    display = os.environ.get("DISPLAY", "")
+    if not display:
+        return ProbeResult("display", False, None,
+                "no DISPLAY variable set, a graphical interface is required")
+    return ProbeResult("display", True, display)
+
+
+def probe_x_socket(mgr):
+    display = os.environ.get("DISPLAY", "")
+    m = re.match(r"^(?P<host>[^:]*):(?P<n>\d+)", display)
+    if not m:
+        return ProbeResult("x_socket", False, None, "can't parse DISPLAY '%s'" % display)
+    if m.group("host") not in ("", "unix"):
+        # ssh forwarded (localhost:10) or remote displays use TCP and xauth
+        return ProbeResult("x_socket", True, None, "TCP display %s" % display)
+    path = "/tmp/.X11-unix/X%s" % m.group("n")
+    if not os.path.exists(path):
+        return ProbeResult("x_socket", False, None, "%s does not exist" % path)
+    return ProbeResult("x_socket", True, path)
+
+
+def probe_xauth(mgr):
+    path = "%s/.Xauthority" % os.environ.get("HOME", "/")
+    if not os.path.isfile(path):
+        return ProbeResult("xauth", True, None, "no %s, using xhost only" % path)
+    return ProbeResult("xauth", True, path)
+
+
+def probe_xhost(mgr):
+    # ensure we have access to the local display
+    out, ret = run("xhost +local:")
+    if ret != 0:
+        return ProbeResult("xhost", False, False, "'xhost +local:' failed")
+    return ProbeResult("xhost", True, True, "local connections allowed")
+
+
+def probe_selinux(mgr):
+    try:
+        with open("/sys/fs/selinux/enforce") as f:
+            enforcing = f.read().strip() == "1"
+    except IOError:
+        return ProbeResult("selinux", True, None, "not enabled")
+    if not enforcing:
+        return ProbeResult("selinux", True, "permissive")
+
+    problems = []
+    for path in ["/tmp/.X11-unix", "%s/.Xauthority" % os.environ.get("HOME", "/")]:
+        if not os.path.exists(path):
+            continue
+        out, ret = run("stat -c %%C %s" % path)
+        if ret == 0 and not [t for t in CONTAINER_FILE_TYPES if t in out]:
+            problems.append("%s (%s)" % (path, out.strip()))
+    if problems:
+        return ProbeResult("selinux", False, "enforcing",
+                "containers can't read %s, install %s" % (", ".join(problems),
+                    SELINUX_POLICY))
+    return ProbeResult("selinux", True, "enforcing")
+
+
+def probe_docker_api(mgr):
+    out, ret = run("docker version --format '{{.Server.APIVersion}}'")
+    if ret != 0:
+        return ProbeResult("docker_api", False, None, "docker daemon not reachable")
+    return ProbeResult("docker_api", True, out.strip())
+
+
+def probe_tag_force(mgr):
+    # docker < 1.10 requires 'tag --force' to move an existing tag
+    out, ret = run("docker help tag")
+    if ret != 0:
+        return ProbeResult("tag_force", False, "",
+                "error running docker help tag, using 'tag' without '--force' flag")
+    return ProbeResult("tag_force", True, "--force" if "--force" in out else "")
+
+
+def probe_images(mgr):
+    out, ret = run("docker images --format '{{.Repository}}:{{.Tag}}'")
+    if ret != 0:
+        return ProbeResult("images", False, None, "can't list images")
+    present = set(out.split())
+    missing = [i for i in get_required_images(mgr) if not i in present]
+    if missing:
+        return ProbeResult("images", False, missing,
+                "missing %s, run 'pull_images'" % ", ".join(missing))
+    return ProbeResult("images", True, [])
+
+
+PROBES = [
+    ("display", probe_display),
+    ("x_socket", probe_x_socket),
+    ("xauth", probe_xauth),
+    ("xhost", probe_xhost),
+    ("selinux", probe_selinux),
+    ("docker_api", probe_docker_api),
+    ("tag_force", probe_tag_force),
+    ("images", probe_images),
+    ]
+
+
+class Probes(object):
+    """
+    cached results of the host capability probes, all probes run in
+    parallel at startup and again once PROBE_TTL is over
+    """
+
+    def __init__(self, mgr, ttl=PROBE_TTL):
+        self.mgr = mgr
+        self.ttl = ttl
+        self.probes = dict(PROBES)
+        self.results = {}
+        self.locks = dict([(name, threading.Lock()) for name in self.probes])
+
+    def run_probe(self, name):
+        with self.locks[name]:
+            r = self.results.get(name)
+            if r != None and time.time() - r.time < self.ttl:
+                # another thread probed in the meantime
+                return r
+            start = time.time()
+            try:
+                r = self.probes[name](self.mgr)
+            except Exception, err:
+                r = ProbeResult(name, False, None, "probe failed: %s" % err)
+            r.duration = time.time() - start
+            self.results[name] = r
+            logging.debug("probe %s: ok: %s, value: %s, %s (%.3fs)", name, r.ok,
+                    r.value, r.detail, r.duration)
+            return r
+
+    def run_all(self, names=None):
+        """
+        run the given (default: all) probes in parallel and wait for them
+        """
+        if names == None:
+            names = self.probes.keys()
+        threads = []
+        for name in names:
+            t = threading.Thread(target=self.run_probe, args=(name,),
+                    name="probe-%s" % name)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+
+    def start(self):
+        t = threading.Thread(target=self.run_all, name="probes")
+        t.daemon = True
+        t.start()
+
+    def get(self, name):
+        r = self.results.get(name)
+        if r == None or time.time() - r.time >= self.ttl:
+            r = self.run_probe(name)
+        return r
+
+    def value(self, name):
+        return self.get(name).value
+
+    def invalidate(self, name):
+        with self.locks[name]:
+            self.results.pop(name, None)
+
+    def stale(self):
+        now = time.time()
+        return [n for n in self.probes if not n in self.results or
+                now - self.results[n].time >= self.ttl]
+
+
+class Doctor(Command):
+    def __init__(self, mgr):
+        self.set_mgr(mgr)
+
+    def get_keyword(self):
+        return "doctor"
+
+    def desctiption(self):
+        return "check docker, the display and the images of this host"
+
+    def help_msg(self):
+        return "%s: [--refresh]" % self.get_keyword()
+
+    def run(self, args):
+        probes = self.mgr.probes
+        if "--refresh" in args:
+            for name in probes.probes:
+                probes.invalidate(name)
+        probes.run_all(probes.stale())
+
+        failed = 0
+        for name, f in PROBES:
+            r = probes.get(name)
+            value = r.value
+            if isinstance(value, list):
+                value = ", ".join(value) or "-"
+            elif value in (None, ""):
+                value = "-"
+            print "%-4s %-11s %-24s %s" % ("ok" if r.ok else "FAIL", name, value,
+                    r.detail)
+            if not r.ok:
+                failed += 1
+        if failed:
+            print "%d problem(s) found" % failed
+        return failed == 0
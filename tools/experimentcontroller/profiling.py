@@ -0,0 +1,91 @@
+#!/usr/bin/env python2.7
+
+import os
+import time
+import pstats
+import logging
+import cProfile
+import StringIO
+
+
+# directory the per command profiles are written to
+PROFILE_DIR = "profiles"
+
+# number of functions shown after a profiled command
+TOP_FUNCTIONS = 15
+
+
+class ProfileResult(object):
+    def __init__(self, command, wall, cpu, children, path):
+        self.command = command
+        self.wall = wall
+        self.cpu = cpu
+        self.children = children
+        self.path = path
+
+    def other(self):
+        # neither our CPU nor our children's: waiting for the docker daemon,
+        # the network, the disk or the user
+        return max(0.0, self.wall - self.cpu - self.children)
+
+
+class CommandProfiler(object):
+    """
+    runs Command.run() under cProfile and attributes its wall time to our
+    own CPU time, the CPU time of child processes (docker client, curl, ...)
+    and the remaining waiting time
+    """
+
+    def __init__(self, path=PROFILE_DIR):
+        self.path = path
+        self.results = []
+
+    def run(self, keyword, command, args):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        profiler = cProfile.Profile()
+        t0 = os.times()
+        wall0 = time.time()
+        try:
+            return profiler.runcall(command.run, args)
+        finally:
+            wall = time.time() - wall0
+            t1 = os.times()
+            cpu = (t1[0] - t0[0]) + (t1[1] - t0[1])
+            children = (t1[2] - t0[2]) + (t1[3] - t0[3])
+
+            prof_file = os.path.join(self.path, "%s_%s.prof" % (keyword,
+                time.strftime("%Y%m%d_%H%M%S")))
+            profiler.dump_stats(prof_file)
+
+            result = ProfileResult(keyword, wall, cpu, children, prof_file)
+            self.results.append(result)
+            logging.info("profile of '%s': wall %.3fs, cpu %.3fs, children %.3fs, written to %s",
+                    keyword, wall, cpu, children, prof_file)
+            self.print_result(profiler, result)
+
+    def print_result(self, profiler, result):
+        out = StringIO.StringIO()
+        stats = pstats.Stats(profiler, stream=out)
+        stats.sort_stats("cumulative").print_stats(TOP_FUNCTIONS)
+        print
+        print "profile of '%s' written to %s" % (result.command, result.path)
+        print "  wall: %.3fs  cpu: %.3fs  children: %.3fs  waiting: %.3fs" % (
+                result.wall, result.cpu, result.children, result.other())
+        # skip the pstats header, the file name is already printed above
+        lines = out.getvalue().splitlines()
+        for i, line in enumerate(lines):
+            if line.strip().startswith("ncalls"):
+                print "\n".join(lines[i:])
+                break
+
+    def print_summary(self):
+        if not self.results:
+            print "no commands profiled yet"
+            return
+        print "%-20s %9s %9s %9s %9s  %s" % ("command", "wall[s]", "cpu[s]",
+                "child[s]", "wait[s]", "profile")
+        for r in self.results:
+            print "%-20s %9.3f %9.3f %9.3f %9.3f  %s" % (r.command, r.wall, r.cpu,
+                    r.children, r.other(), r.path)
@@ -0,0 +1,166 @@
+#!/usr/bin/env python2.7
+
+import re
+import json
+import time
+import fcntl
+import logging
+
+
+# answers of all participants, one JSON record per line
+QUESTIONNAIRE_RESULTS = "questionnaires.jsonl"
+
+# '1.', '2)', 'Q3:', '4.1.' ... at the beginning of a line starts a question
+QUESTION = re.compile(r"^\s*(?:Q\s*)?(?P<id>\d+(?:\.\d+)*)[.):]\s+(?P<text>\S.*)$",
+        re.IGNORECASE)
+
+# '[x] option' or '[ ] option'
+CHOICE = re.compile(r"^\s*\[(?P<mark>[ xX*])\]\s*(?P<option>.*)$")
+
+# optional answer prefixes: 'answer: ...' or '> ...', any other text below
+# a question which is not part of the template counts as answer too
+ANSWER = re.compile(r"^\s*(?:answer\s*:|>)\s?(?P<value>.*)$", re.IGNORECASE)
+
+# rating scales: a bracketed range ending the question text, '... (1-5)',
+# '... [1..7]?', or a line of labels below it, '1 = bad ... 5 = good'
+SCALE = re.compile(r"[\[(]\s*(?P<low>\d+)\s*(?:-|\.\.|to)\s*(?P<high>\d+)\s*[\])]\s*[?:.]?\s*$")
+SCALE_LABELS = re.compile(r"^\s*(?P<low>\d+)\s*=.*?(?P<high>\d+)\s*=")
+
+# the rating at the beginning of a scale answer, '4' or '4 (quite hard)'
+RATING = re.compile(r"^(?P<value>\d+)\b")
+
+
+class Item(object):
+    """
+    a single question with its typed answer
+    """
+
+    def __init__(self, id, text):
+        self.id = id
+        self.text = text
+        self.type = "text"
+        self.options = []
+        self.selected = []
+        self.lines = []
+        self.scale = None
+        self.value = None
+
+    def finish(self):
+        """
+        derive type and value from the collected lines
+        """
+        m = SCALE.search(self.text)
+        if m and self.scale == None and int(m.group("low")) < int(m.group("high")):
+            self.scale = (int(m.group("low")), int(m.group("high")))
+
+        if self.options:
+            self.type = "choice"
+            self.value = self.selected or None
+            return
+
+        text = " ".join([l for l in self.lines if l]).strip()
+        if self.scale != None:
+            self.type = "scale"
+            m = RATING.match(text)
+            if m and self.scale[0] <= int(m.group("value")) <= self.scale[1]:
+                self.value = int(m.group("value"))
+            return
+
+        self.value = text or None
+
+    def is_answered(self):
+        return self.value != None
+
+    def to_dict(self):
+        return {"id": self.id, "type": self.type, "value": self.value}
+
+
+def template_lines(template):
+    """
+    {question id: set of lines} below each question of the unanswered
+    questionnaire, e.g. hints like 'please explain why'
+    """
+    lines = {}
+    current = None
+    for line in template.splitlines():
+        m = QUESTION.match(line)
+        if m:
+            current = lines.setdefault(m.group("id"), set())
+        elif current != None and line.strip():
+            current.add(line.strip())
+    return lines
+
+
+def parse(content, template=None):
+    """
+    parse a questionnaire file into a list of Items. Lines starting with '#'
+    are comments. Lines of the template (the unanswered questionnaire) are
+    not taken as answers.
+    """
+    known = template_lines(template) if template else {}
+    items = []
+    current = None
+    for line in content.splitlines():
+        if line.strip().startswith("#"):
+            continue
+        m = QUESTION.match(line)
+        # numbered lists in answers are not questions of the template
+        if m and (not known or (m.group("id") in known and
+                not m.group("id") in [i.id for i in items])):
+            current = Item(m.group("id"), m.group("text").strip())
+            items.append(current)
+            continue
+        if current == None or not line.strip():
+            continue
+
+        m = CHOICE.match(line)
+        if m:
+            current.options.append(m.group("option").strip())
+            if m.group("mark") != " ":
+                current.selected.append(m.group("option").strip())
+            continue
+
+        m = SCALE_LABELS.match(line)
+        if m and not current.lines:
+            if int(m.group("low")) < int(m.group("high")):
+                current.scale = (int(m.group("low")), int(m.group("high")))
+            continue
+
+        if line.strip() in known.get(current.id, ()):
+            continue
+        m = ANSWER.match(line)
+        if m:
+            current.lines.append(m.group("value").strip())
+        else:
+            current.lines.append(line.strip())
+
+    for i in items:
+        i.finish()
+    return items
+
+
+def append_results(record, path=QUESTIONNAIRE_RESULTS):
+    """
+    append a record to the per study results file, several controllers may
+    share the file
+    """
+    line = json.dumps(record, sort_keys=True, separators=(",", ":")) + "\n"
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.write(line)
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+    logging.info("questionnaire results of %s/%s appended to %s",
+            record["user"], record["task"], path)
+
+
+def make_record(exp, task, items):
+    return {
+        "time": int(time.time()),
+        "group": exp.group_name,
+        "user": exp.user_name,
+        "task": task.id,
+        "slot": exp.get_current_task_index(),
+        "answers": [i.to_dict() for i in items],
+        }
@@ -0,0 +1,200 @@
+#!/usr/bin/env python2.7
+
+import os
+import pty
+import tty
+import sys
+import gzip
+import json
+import time
+import errno
+import fcntl
+import codecs
+import select
+import signal
+import struct
+import logging
+import termios
+import threading
+
+
+# asciicast v2 recordings of the task containers, one per attempt
+RECORDING_DIR = "recordings"
+
+# bytes read from the terminal or the container per syscall
+READ_SIZE = 4096
+
+# at most this many characters of the current input line are kept to
+# detect test runs
+LINE_LIMIT = 256
+
+TEST_COMMANDS = ["run_test"]
+
+
+def get_winsize(fd):
+    """
+    return (rows, cols) of a terminal, None if fd is no terminal
+    """
+    try:
+        s = fcntl.ioctl(fd, termios.TIOCGWINSZ, struct.pack("HHHH", 0, 0, 0, 0))
+    except IOError:
+        return None
+    rows, cols = struct.unpack("HHHH", s)[:2]
+    return (rows, cols)
+
+
+def set_winsize(fd, size):
+    fcntl.ioctl(fd, termios.TIOCSWINSZ, struct.pack("HHHH", size[0], size[1], 0, 0))
+
+
+def write_all(fd, data):
+    while data:
+        n = os.write(fd, data)
+        data = data[n:]
+
+
+def recording_path(seat, task_id, attempt):
+    return os.path.join(RECORDING_DIR, seat, "%s_%d_%s.cast.gz" % (task_id,
+        attempt, time.strftime("%Y%m%d_%H%M%S")))
+
+
+class Recorder(object):
+    """
+    Runs a command on its own pty and passes the terminal through, input
+    and output are written as they arrive to a gzip compressed asciicast v2
+    stream. Nothing but the current input line is buffered.
+    """
+
+    def __init__(self, path, title=None):
+        self.path = path
+        self.title = title
+        self.start = None
+        self.last_activity = None
+        self.test_runs = 0
+        self.last_test = None
+        self.line = ""
+        self.out = None
+        self.decoders = {}
+        self.master = None
+
+    def event(self, kind, data):
+        now = time.time()
+        text = self.decoders[kind].decode(data)
+        if text:
+            self.out.write(json.dumps([round(now - self.start, 6), kind, text]) + "\n")
+        if kind == "i":
+            self.last_activity = now
+            self.track_input(text)
+
+    def track_input(self, text):
+        for c in text:
+            if c in "\r\n":
+                words = self.line.split()
+                if words and words[0] in TEST_COMMANDS:
+                    self.test_runs += 1
+                    self.last_test = time.time()
+                    logging.debug("test run %d detected", self.test_runs)
+                self.line = ""
+            elif c in "\x7f\b":
+                self.line = self.line[:-1]
+            elif c == "\x03" or c == "\x15":
+                # ^C and ^U discard the line
+                self.line = ""
+            elif len(self.line) < LINE_LIMIT:
+                self.line += c
+
+    def on_resize(self, signum, frame):
+        size = get_winsize(sys.stdin.fileno())
+        if size != None and self.master != None:
+            set_winsize(self.master, size)
+
+    def header(self, size):
+        h = {"version": 2, "width": size[1], "height": size[0],
+                "timestamp": int(self.start),
+                "env": {"TERM": os.environ.get("TERM", ""),
+                    "SHELL": os.environ.get("SHELL", "")}}
+        if self.title:
+            h["title"] = self.title
+        return json.dumps(h) + "\n"
+
+    def run(self, argv):
+        """
+        run argv on a pty and record it, returns the exit status like
+        os.system()
+        """
+        d = os.path.dirname(self.path)
+        if d and not os.path.isdir(d):
+            os.makedirs(d)
+
+        stdin = sys.stdin.fileno()
+        stdout = sys.stdout.fileno()
+        size = get_winsize(stdin) or (24, 80)
+
+        sys.stdout.flush()
+        pid, self.master = pty.fork()
+        if pid == 0:
+            try:
+                os.execvp(argv[0], argv)
+            finally:
+                os._exit(127)
+
+        old_mode = None
+        old_handler = None
+        resize_handler = False
+        fds = [self.master, stdin]
+        try:
+            set_winsize(self.master, size)
+            self.start = self.last_activity = time.time()
+            self.decoders = {"i": codecs.getincrementaldecoder("utf-8")("replace"),
+                    "o": codecs.getincrementaldecoder("utf-8")("replace")}
+            self.out = gzip.open(self.path, "wb")
+            self.out.write(self.header(size))
+
+            if os.isatty(stdin):
+                old_mode = termios.tcgetattr(stdin)
+                tty.setraw(stdin)
+            # signal handlers only work in the main thread, elsewhere the
+            # container keeps its initial window size
+            if isinstance(threading.current_thread(), threading._MainThread):
+                old_handler = signal.signal(signal.SIGWINCH, self.on_resize)
+                resize_handler = True
+            while True:
+                try:
+                    ready = select.select(fds, [], [])[0]
+                except select.error, err:
+                    if err.args[0] == errno.EINTR:
+                        continue
+                    raise
+                if self.master in ready:
+                    try:
+                        data = os.read(self.master, READ_SIZE)
+                    except OSError, err:
+                        # EIO: the container's terminal was closed
+                        data = ""
+                    if not data:
+                        break
+                    write_all(stdout, data)
+                    self.event("o", data)
+                if stdin in ready:
+                    data = os.read(stdin, READ_SIZE)
+                    if not data:
+                        fds.remove(stdin)
+                        continue
+                    write_all(self.master, data)
+                    self.event("i", data)
+        finally:
+            if resize_handler:
+                # None: the handler was not set from python
+                signal.signal(signal.SIGWINCH, old_handler or signal.SIG_DFL)
+            if old_mode != None:
+                termios.tcsetattr(stdin, termios.TCSAFLUSH, old_mode)
+            # closing the pty hangs up the command if it is still running
+            os.close(self.master)
+            self.master = None
+            if self.out != None:
+                self.out.close()
+            status = os.waitpid(pid, 0)[1]
+
+        logging.info("recorded %s in %s (%.0fs, %d test runs)", " ".join(argv[:2]),
+                self.path, time.time() - self.start, self.test_runs)
+        return status
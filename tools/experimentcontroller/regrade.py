@@ -0,0 +1,313 @@
+#!/usr/bin/env python2.7
+
+import os
+import re
+import csv
+import json
+import glob
+import time
+import shutil
+import hashlib
+import tarfile
+import logging
+import tempfile
+import subprocess
+import shlex
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+from basic_commands import ExecCommand
+from task import classify
+import storage
+
+
+# directory where extracted submissions and the result index are kept
+REGRADE_CACHE_DIR = "regrade_cache"
+
+# combined result table of all regrade runs
+REGRADE_RESULTS = "regrade_results.csv"
+
+RESULT_FIELDS = ["submission", "group", "user", "task", "method", "image",
+        "image_id", "returncode", "puppet", "passed", "result", "duration", "timestamp"]
+
+# part of the result keys: results of earlier runners (the tests without
+# init script and puppet) are not comparable and run again
+RUNNER_VERSION = 2
+
+
+def file_sha1(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class Submission(object):
+    """
+    a single exp_<group>_<user>_<ts>.tar.gz result tarball
+    """
+
+    def __init__(self, path, group_name, user_name):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.group_name = group_name
+        self.user_name = user_name
+        self.sha1 = file_sha1(path)
+        self.src_root = None
+
+    def extract(self, cache_dir):
+        """
+        extract the tarball once into the shared cache and locate the source
+        root, i.e. the directory which corresponds to /home/user/src
+        """
+        target = os.path.join(cache_dir, self.sha1)
+        marker = os.path.join(target, ".complete")
+        if not os.path.isfile(marker):
+            logging.debug("extracting %s to %s", self.path, target)
+            # overlay tarballs of earlier versions hold only the changes
+            if not storage.materialize(self.path, target):
+                tar = tarfile.open(self.path)
+                try:
+                    tar.extractall(target)
+                finally:
+                    tar.close()
+            open(marker, "w").close()
+        else:
+            logging.debug("using cached extraction of %s", self.path)
+
+        self.src_root = target
+        return target
+
+    def find_src_root(self, rel_src_dir):
+        """
+        the tarball layout depends on the build script, so search for the
+        first directory containing the task's relative source directory
+        """
+        for dirpath, dirnames, filenames in os.walk(self.src_root):
+            if os.path.isdir(os.path.join(dirpath, rel_src_dir)):
+                return os.path.abspath(dirpath)
+        return None
+
+
+class Regrade(ExecCommand):
+    def __init__(self, mgr):
+        self.set_mgr(mgr)
+        self.image_ids = {}
+
+    def get_keyword(self):
+        return "regrade"
+
+    def desctiption(self):
+        return "re-run all task tests of collected result tarballs"
+
+    def help_msg(self):
+        return "%s: [-j <workers>] <tarball or directory> ..." % self.get_keyword()
+
+    def complete_cmd(self, args):
+        return glob.glob("exp_*.tar.gz")
+
+    def parse_submission(self, path):
+        """
+        group names are matched against the defined groups, as user names may
+        contain '_' as well
+        """
+        name = os.path.basename(path)
+        for group in sorted(self.mgr.get_group_names(), key=len, reverse=True):
+            prefix = "exp_%s_" % group
+            if not name.startswith(prefix):
+                continue
+            m = re.match(r"^(?P<user>[a-zA-Z0-9_]+)_\d{8}_\d{6}\.tar\.gz$",
+                    name[len(prefix):])
+            if m:
+                return Submission(path, group, m.group("user"))
+        return None
+
+    def collect(self, paths):
+        files = []
+        for p in paths:
+            if os.path.isdir(p):
+                files.extend(sorted(glob.glob(os.path.join(p, "exp_*.tar.gz"))))
+            else:
+                files.append(p)
+
+        submissions = []
+        for f in files:
+            sub = self.parse_submission(f)
+            if sub == None:
+                logging.error("regrade: unknown submission file %s", f)
+                print "skipping '%s': not a result tarball of a known group" % f
+            else:
+                submissions.append(sub)
+        return submissions
+
+    def get_image_id(self, image):
+        if not image in self.image_ids:
+            # the test containers run on this host, also in coordinator mode
+            # (exec_cmd would ask the agent of the running experiment)
+            cmd = "docker inspect --format '{{.Id}}' %s" % image
+            try:
+                p = subprocess.Popen(shlex.split(cmd), stdout=subprocess.PIPE,
+                        stderr=subprocess.PIPE)
+                out, err = p.communicate()
+                ret = p.returncode
+            except OSError, err:
+                logging.error("regrade: error running %s: %s", cmd, err)
+                ret = -1
+            if ret == 0:
+                self.image_ids[image] = out.strip()
+            else:
+                self.image_ids[image] = None
+        return self.image_ids[image]
+
+    def load_index(self, path):
+        if os.path.isfile(path):
+            with open(path) as f:
+                return json.load(f)
+        return {}
+
+    def save_index(self, path, index):
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(index, f, indent=1, sort_keys=True)
+        os.rename(tmp, path)
+
+    def run_test(self, job):
+        sub, task, src_root, image_id, log_file = job
+        # puppet and the tests write below /home/user/src, every run gets a
+        # writable copy so the cached extraction stays untouched
+        scratch = tempfile.mkdtemp(prefix="scratch_", dir=REGRADE_CACHE_DIR)
+        start = time.time()
+        steps = {}
+        try:
+            try:
+                shutil.copytree(src_root, os.path.join(scratch, "src"), symlinks=True)
+                # like the participant's container: init script, puppet, tests
+                steps = task.run_headless("--rm -v %s:/home/user/src" % os.path.abspath(
+                    os.path.join(scratch, "src")), log_file)
+            except (OSError, IOError, shutil.Error), err:
+                logging.error("regrade: error testing %s %s: %s", sub.name,
+                        task.id, err)
+            duration = time.time() - start
+        finally:
+            # files created by the container may belong to root
+            shutil.rmtree(scratch, True)
+            if os.path.isdir(scratch):
+                logging.warning("regrade: could not remove %s", scratch)
+
+        result, ok = classify(steps)
+        ret = steps.get("test", -1)
+        logging.info("regrade: %s %s: %s (%.1fs)", sub.name, task.id, result, duration)
+        return {
+            "submission": sub.name,
+            "group": sub.group_name,
+            "user": sub.user_name,
+            "task": task.id,
+            "method": task.method,
+            "image": task.cnt_image,
+            "image_id": image_id,
+            "returncode": ret,
+            "puppet": steps.get("puppet", ""),
+            "passed": ok and ret == 0,
+            "result": result,
+            "duration": "%.1f" % duration,
+            "timestamp": time.strftime("%Y%m%d_%H%M%S"),
+            }
+
+    def write_results(self, index):
+        rows = sorted(index.values(),
+                key=lambda r: (r["group"], r["user"], r["submission"], r["task"]))
+        with open(REGRADE_RESULTS, "wb") as f:
+            writer = csv.DictWriter(f, RESULT_FIELDS)
+            writer.writeheader()
+            for r in rows:
+                writer.writerow(r)
+        return rows
+
+    def run(self, args):
+        workers = multiprocessing.cpu_count()
+        if len(args) >= 2 and args[0] == "-j":
+            try:
+                workers = max(1, int(args[1]))
+            except ValueError:
+                print self.help_msg()
+                return False
+            args = args[2:]
+
+        if not args:
+            print self.help_msg()
+            return False
+
+        if not os.path.isdir(REGRADE_CACHE_DIR):
+            os.makedirs(REGRADE_CACHE_DIR)
+        index_file = os.path.join(REGRADE_CACHE_DIR, "index.json")
+        index = self.load_index(index_file)
+        # results of earlier runners are run again
+        index = dict([(k, v) for k, v in index.items()
+            if k.endswith(":%d" % RUNNER_VERSION)])
+
+        submissions = self.collect(args)
+        print "regrading %d submission(s) with %d worker(s)..." % (
+                len(submissions), workers)
+
+        jobs = []
+        skipped = 0
+        for sub in submissions:
+            # only tasks with a test container, questionnaires have nothing to test
+            tasks = []
+            for task in self.mgr.get_tasks_for_group(sub.group_name):
+                if getattr(task, 'cnt_image', None) and not task in tasks:
+                    tasks.append(task)
+
+            pending = []
+            for task in tasks:
+                image_id = self.get_image_id(task.cnt_image)
+                if image_id == None:
+                    print "image %s not available, use 'pull_images' first" % task.cnt_image
+                    continue
+                key = "%s:%s:%s:%d" % (sub.sha1, task.id, image_id, RUNNER_VERSION)
+                if key in index:
+                    skipped += 1
+                    continue
+                pending.append((key, task, image_id))
+
+            if not pending:
+                continue
+
+            sub.extract(REGRADE_CACHE_DIR)
+            for key, task, image_id in pending:
+                rel_src_dir = os.path.relpath(task.src_dir, "/home/user/src")
+                src_root = sub.find_src_root(rel_src_dir)
+                if src_root == None:
+                    logging.error("regrade: %s not found in %s", rel_src_dir, sub.name)
+                    print "%s: sources of %s missing" % (sub.name, task.id)
+                    continue
+                log_file = os.path.join(REGRADE_CACHE_DIR, sub.sha1,
+                        "%s.log" % task.id)
+                jobs.append((key, (sub, task, src_root, image_id, log_file)))
+
+        print "%d test run(s) pending, %d unchanged" % (len(jobs), skipped)
+
+        if jobs:
+            pool = ThreadPool(workers)
+            try:
+                results = pool.map(self.run_test, [j[1] for j in jobs])
+            finally:
+                pool.close()
+                pool.join()
+
+            for (key, job), result in zip(jobs, results):
+                index[key] = result
+            self.save_index(index_file, index)
+
+        rows = self.write_results(index)
+        names = set([s.name for s in submissions])
+        print
+        print "%-40s %-10s %-6s %8s  %s" % ("submission", "task", "passed", "time", "result")
+        for r in rows:
+            if r["submission"] in names:
+                print "%-40s %-10s %-6s %8s  %s" % (r["submission"], r["task"],
+                        "yes" if r["passed"] else "no", r["duration"], r.get("result", ""))
+        print
+        print "results written to %s" % REGRADE_RESULTS
+        return True
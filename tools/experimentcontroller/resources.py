@@ -0,0 +1,186 @@
+#!/usr/bin/env python2.7
+
+import os
+import time
+import shlex
+import logging
+import subprocess
+
+from commandline import Command
+
+
+# label attached to all containers of a seat (value: <group>_<user>)
+SEAT_LABEL = "expctr.seat"
+
+# seat label value of unclaimed editor containers of the pool
+POOL_SEAT = "pool"
+
+# resource limits applied to the editor and to each task container of a seat
+RESOURCE_PROFILES = {
+    "small": {"cpu_shares": 256, "memory": "1g", "blkio_weight": 250},
+    "medium": {"cpu_shares": 512, "memory": "2g", "blkio_weight": 500},
+    "large": {"cpu_shares": 1024, "memory": "4g", "blkio_weight": 1000},
+    "unlimited": {},
+    }
+
+# containers are not limited unless a profile is chosen with --resources=,
+# only the seat label is added
+DEFAULT_PROFILE = "unlimited"
+
+# interval between the two samples used to calculate the CPU usage
+SAMPLE_INTERVAL = 0.5
+
+# cgroup locations of a docker container (cgroup v2 with systemd or
+# cgroupfs driver, cgroup v1)
+CGROUP_V2_DIRS = [
+    "/sys/fs/cgroup/system.slice/docker-{id}.scope",
+    "/sys/fs/cgroup/docker/{id}",
+    ]
+CGROUP_V1_CPU = [
+    "/sys/fs/cgroup/cpuacct/docker/{id}/cpuacct.usage",
+    "/sys/fs/cgroup/cpu,cpuacct/docker/{id}/cpuacct.usage",
+    "/sys/fs/cgroup/cpuacct/system.slice/docker-{id}.scope/cpuacct.usage",
+    ]
+CGROUP_V1_MEM = [
+    "/sys/fs/cgroup/memory/docker/{id}/memory.usage_in_bytes",
+    "/sys/fs/cgroup/memory/system.slice/docker-{id}.scope/memory.usage_in_bytes",
+    ]
+
+
+def seat_name(group_name, user_name):
+    return "%s_%s" % (group_name, user_name)
+
+
+def docker_opts(profile_name, seat):
+    """
+    return the 'docker create/run' options applying the resource profile
+    """
+    profile = RESOURCE_PROFILES.get(profile_name, {})
+    opts = " --label %s=%s" % (SEAT_LABEL, seat)
+    if "cpu_shares" in profile:
+        opts += " --cpu-shares %d" % profile["cpu_shares"]
+    if "memory" in profile:
+        # no additional swap, a swapping seat would stall the whole host
+        opts += " --memory %s --memory-swap %s" % (profile["memory"],
+                profile["memory"])
+    if "blkio_weight" in profile:
+        opts += " --blkio-weight %d" % profile["blkio_weight"]
+    return opts
+
+
+def read_first(paths, cnt_id):
+    for p in paths:
+        try:
+            with open(p.format(id=cnt_id)) as f:
+                return f.read()
+        except IOError:
+            pass
+    return None
+
+
+def sample_cgroup(cnt_id):
+    """
+    read (cpu time in ns, memory in bytes, io bytes) of a container directly
+    from its cgroup, returns None if the cgroup could not be found
+    """
+    for d in CGROUP_V2_DIRS:
+        d = d.format(id=cnt_id)
+        if not os.path.isdir(d):
+            continue
+        cpu = mem = io = 0
+        try:
+            with open(os.path.join(d, "cpu.stat")) as f:
+                for line in f:
+                    if line.startswith("usage_usec "):
+                        cpu = int(line.split()[1]) * 1000
+            with open(os.path.join(d, "memory.current")) as f:
+                mem = int(f.read())
+            with open(os.path.join(d, "io.stat")) as f:
+                for line in f:
+                    for field in line.split()[1:]:
+                        key, value = field.split("=")
+                        if key in ("rbytes", "wbytes"):
+                            io += int(value)
+        except (IOError, ValueError):
+            pass
+        return (cpu, mem, io)
+
+    cpu = read_first(CGROUP_V1_CPU, cnt_id)
+    mem = read_first(CGROUP_V1_MEM, cnt_id)
+    if cpu == None or mem == None:
+        return None
+    return (int(cpu), int(mem), 0)
+
+
+class SeatUsage(Command):
+    def __init__(self, mgr):
+        self.set_mgr(mgr)
+
+    def get_keyword(self):
+        return "seat_usage"
+
+    def desctiption(self):
+        return "show CPU, memory and IO usage of all seats on this host"
+
+    def list_containers(self):
+        """
+        return [(container id, seat)] of all running seat containers
+        """
+        cmd = "docker ps --no-trunc --filter label=%s --format '{{.ID}} {{.Label \"%s\"}} {{.Names}}'" % (
+                SEAT_LABEL, SEAT_LABEL)
+        try:
+            p = subprocess.Popen(shlex.split(cmd), stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE)
+            out, err = p.communicate()
+        except OSError, err:
+            logging.error("error listing seat containers: %s", err)
+            return []
+        if p.returncode != 0:
+            logging.error("error listing seat containers: %s", err)
+            return []
+        containers = []
+        for l in out.splitlines():
+            if len(l.split()) != 3:
+                continue
+            cnt_id, seat, name = l.split()
+            # labels are fixed at creation, claimed pool editors are renamed
+            if seat == POOL_SEAT and name.startswith("exp_"):
+                seat = name[len("exp_"):]
+            containers.append((cnt_id, seat))
+        return containers
+
+    def run(self, args):
+        containers = self.list_containers()
+        if not containers:
+            print "no seat containers running"
+            return
+
+        first = {}
+        for cnt_id, seat in containers:
+            first[cnt_id] = sample_cgroup(cnt_id)
+        start = time.time()
+        time.sleep(SAMPLE_INTERVAL)
+        elapsed = time.time() - start
+
+        seats = {}
+        for cnt_id, seat in containers:
+            s1 = first[cnt_id]
+            s2 = sample_cgroup(cnt_id)
+            usage = seats.setdefault(seat, [0, 0.0, 0, 0, 0])
+            usage[0] += 1
+            if s1 == None or s2 == None:
+                continue
+            usage[1] += (s2[0] - s1[0]) / (elapsed * 1e9) * 100
+            usage[2] += s2[1]
+            usage[3] += s2[2]
+            usage[4] += 1
+
+        print "%-24s %4s %7s %10s %10s" % ("seat", "cnts", "cpu[%]",
+                "mem[MiB]", "io[MiB]")
+        for seat in sorted(seats):
+            n, cpu, mem, io, sampled = seats[seat]
+            if not sampled:
+                print "%-24s %4d %7s %10s %10s" % (seat, n, "?", "?", "?")
+                continue
+            print "%-24s %4d %7.1f %10.1f %10.1f" % (seat, n, cpu,
+                    mem / 1048576.0, io / 1048576.0)
@@ -0,0 +1,411 @@
+#!/usr/bin/env python2.7
+
+import os
+import re
+import glob
+import time
+import sqlite3
+import tarfile
+import logging
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+from commandline import Command
+
+
+# default location of the results database
+RESULTS_DB = "results.sqlite"
+
+LOG_LINE = re.compile(
+        r"^(?P<date>\d{4}-\d\d-\d\d \d\d:\d\d:\d\d),(?P<ms>\d+):(?P<level>[A-Z]+):(?P<msg>.*)$")
+
+# controller log messages we are interested in, see manager.py and task.py
+LOG_EVENTS = [
+    ("experiment_start", re.compile(r"^start experiment: group: (?P<group>\S+), user: (?P<user>\S+)$")),
+    ("experiment_stop", re.compile(r"^stop experiment$")),
+    ("task_start", re.compile(r"^starting task (?P<task>\S+)$")),
+    ("task_finish", re.compile(r"^task (?P<task>\S+) finished$")),
+    ("task_start", re.compile(r"^starting QuestionTask (?P<task>\S+)$")),
+    ("task_finish", re.compile(r"^QuestionTask (?P<task>\S+) finished$")),
+    ("restart", re.compile(r"^restart task$")),
+    ("timeout", re.compile(r"^timeout reached for task ")),
+    ]
+
+ARCHIVE_NAME = re.compile(r"^exp_(?P<rest>.+)_(?P<ts>\d{8}_\d{6})\.tar\.gz$")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    kind TEXT,
+    size INTEGER,
+    mtime REAL,
+    ingested REAL
+);
+CREATE TABLE IF NOT EXISTS events (
+    file TEXT,
+    ts REAL,
+    grp TEXT,
+    user TEXT,
+    task TEXT,
+    method TEXT,
+    event TEXT
+);
+CREATE TABLE IF NOT EXISTS task_times (
+    file TEXT,
+    grp TEXT,
+    user TEXT,
+    task TEXT,
+    method TEXT,
+    start REAL,
+    finish REAL,
+    duration REAL,
+    timeouts INTEGER,
+    restarts INTEGER
+);
+CREATE TABLE IF NOT EXISTS questionnaires (
+    file TEXT,
+    grp TEXT,
+    user TEXT,
+    task TEXT,
+    archived TEXT,
+    content TEXT
+);
+CREATE TABLE IF NOT EXISTS archives (
+    file TEXT,
+    grp TEXT,
+    user TEXT,
+    archived TEXT,
+    members INTEGER,
+    bytes INTEGER
+);
+CREATE INDEX IF NOT EXISTS events_key ON events (grp, user, task, method);
+CREATE INDEX IF NOT EXISTS task_times_key ON task_times (grp, user, task, method);
+CREATE INDEX IF NOT EXISTS task_times_method ON task_times (method, duration);
+CREATE INDEX IF NOT EXISTS questionnaires_key ON questionnaires (grp, user, task);
+CREATE INDEX IF NOT EXISTS archives_key ON archives (grp, user);
+"""
+
+
+def parse_log_time(date, ms):
+    # logging writes local time
+    return time.mktime(time.strptime(date, "%Y-%m-%d %H:%M:%S")) + int(ms) / 1000.0
+
+
+def parse_log(path, methods):
+    """
+    parse a controller log file into events and per task working times.
+    Runs in a worker process, so only plain data is passed in and out.
+    """
+    events = []
+    times = []
+    group = user = None
+    current = None
+
+    def close(ts):
+        if current != None:
+            current["finish"] = ts
+            current["duration"] = ts - current["start"]
+            times.append(current)
+
+    with open(path) as f:
+        for line in f:
+            m = LOG_LINE.match(line.rstrip("\n"))
+            if not m:
+                continue
+            msg = m.group("msg")
+            for event, regex in LOG_EVENTS:
+                em = regex.match(msg)
+                if em:
+                    break
+            else:
+                continue
+
+            ts = parse_log_time(m.group("date"), m.group("ms"))
+            gd = em.groupdict()
+            task = gd.get("task")
+
+            if event == "experiment_start":
+                group, user = gd["group"], gd["user"]
+                current = None
+            elif event == "experiment_stop":
+                group = user = current = None
+            elif event == "task_start":
+                # a restarted task logs another start, keep the first one
+                if current == None or current["task"] != task:
+                    current = {"grp": group, "user": user, "task": task,
+                            "method": methods.get(task), "start": ts,
+                            "timeouts": 0, "restarts": 0}
+            elif event == "task_finish":
+                # a restarted task logs one finish per restart
+                if current != None and current["task"] == task:
+                    close(ts)
+                    current = None
+            elif event == "restart":
+                if current != None:
+                    current["restarts"] += 1
+            elif event == "timeout":
+                if current != None:
+                    current["timeouts"] += 1
+
+            if task == None and current != None:
+                task = current["task"]
+            events.append((path, ts, group, user, task, methods.get(task), event))
+
+    rows = [(path, t["grp"], t["user"], t["task"], t["method"], t["start"],
+        t["finish"], t["duration"], t["timeouts"], t["restarts"]) for t in times]
+    return ("log", path, events, rows)
+
+
+def parse_archive(path, group, user, archived, questionnaires):
+    """
+    scan a result tarball for the questionnaire files (without extracting it)
+    """
+    answers = []
+    members = 0
+    size = 0
+    tar = tarfile.open(path, "r|gz")
+    try:
+        for info in tar:
+            members += 1
+            size += info.size
+            if not info.isfile():
+                continue
+            name = info.name
+            if name.startswith("./"):
+                name = name[2:]
+            for task_id, suffix in questionnaires:
+                if name == suffix or name.endswith("/" + suffix):
+                    content = tar.extractfile(info).read()
+                    answers.append((path, group, user, task_id, archived,
+                        content.decode("utf-8", "replace")))
+    finally:
+        tar.close()
+
+    return ("archive", path, [(path, group, user, archived, members, size)], answers)
+
+
+def parse_file(job):
+    kind = job[0]
+    try:
+        if kind == "log":
+            return parse_log(*job[1:])
+        return parse_archive(*job[1:])
+    except Exception, err:
+        logging.error("error parsing %s: %s", job[1], err)
+        return ("error", job[1], str(err), None)
+
+
+class Median(object):
+    def __init__(self):
+        self.values = []
+
+    def step(self, value):
+        if value != None:
+            self.values.append(value)
+
+    def finalize(self):
+        if not self.values:
+            return None
+        v = sorted(self.values)
+        n = len(v)
+        if n % 2:
+            return v[n // 2]
+        return (v[n // 2 - 1] + v[n // 2]) / 2.0
+
+
+class ResultsStore(object):
+    """
+    indexed SQLite store of controller logs, questionnaires and archives
+    """
+
+    def __init__(self, mgr, path=RESULTS_DB):
+        self.mgr = mgr
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.create_aggregate("median", 1, Median)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def is_ingested(self, path):
+        st = os.stat(path)
+        row = self.db.execute("SELECT size, mtime FROM files WHERE path = ?",
+                (path,)).fetchone()
+        return row != None and row[0] == st.st_size and row[1] == st.st_mtime
+
+    def forget(self, path):
+        for table in ["events", "task_times", "questionnaires", "archives"]:
+            self.db.execute("DELETE FROM %s WHERE file = ?" % table, (path,))
+        self.db.execute("DELETE FROM files WHERE path = ?", (path,))
+
+    def make_job(self, path):
+        name = os.path.basename(path)
+        if name.startswith("experiments_") and name.endswith(".log"):
+            methods = {}
+            for task_id, task in self.mgr.get_tasks().items():
+                methods[task_id] = getattr(task, "method", None)
+            return ("log", path, methods)
+
+        m = ARCHIVE_NAME.match(name)
+        if m:
+            group = user = None
+            for g in sorted(self.mgr.get_group_names(), key=len, reverse=True):
+                if m.group("rest").startswith(g + "_"):
+                    group, user = g, m.group("rest")[len(g) + 1:]
+                    break
+            questionnaires = []
+            for task_id, task in self.mgr.get_tasks().items():
+                if hasattr(task, "task_dir"):
+                    questionnaires.append((task_id,
+                        "%s/%s" % (task.task_dir, task.question_file)))
+            return ("archive", path, group, user, m.group("ts"), questionnaires)
+        return None
+
+    def ingest(self, paths, workers=None):
+        """
+        ingest all not yet (or changed) files of paths in parallel
+        returns (number of ingested files, number of unchanged files)
+        """
+        jobs = []
+        unchanged = 0
+        for path in paths:
+            path = os.path.abspath(path)
+            job = self.make_job(path)
+            if job == None:
+                continue
+            if self.is_ingested(path):
+                unchanged += 1
+                continue
+            jobs.append(job)
+
+        if not jobs:
+            return (0, unchanged)
+
+        if workers == None:
+            workers = multiprocessing.cpu_count()
+        # threads: a forked pool would copy the manager (and its docker and
+        # agent connections) into every worker, the inserts stay on this thread
+        pool = ThreadPool(min(workers, len(jobs)))
+        try:
+            ingested = 0
+            for result in pool.imap_unordered(parse_file, jobs):
+                kind, path = result[0], result[1]
+                if kind == "error":
+                    print "error parsing %s: %s" % (path, result[2])
+                    continue
+
+                st = os.stat(path)
+                with self.db:
+                    self.forget(path)
+                    if kind == "log":
+                        self.db.executemany(
+                                "INSERT INTO events VALUES (?,?,?,?,?,?,?)", result[2])
+                        self.db.executemany(
+                                "INSERT INTO task_times VALUES (?,?,?,?,?,?,?,?,?,?)",
+                                result[3])
+                    else:
+                        self.db.executemany(
+                                "INSERT INTO archives VALUES (?,?,?,?,?,?)", result[2])
+                        self.db.executemany(
+                                "INSERT INTO questionnaires VALUES (?,?,?,?,?,?)",
+                                result[3])
+                    self.db.execute("INSERT INTO files VALUES (?,?,?,?,?)",
+                            (path, kind, st.st_size, st.st_mtime, time.time()))
+                ingested += 1
+        finally:
+            pool.close()
+            pool.join()
+
+        return (ingested, unchanged)
+
+    def median_time_per_method(self):
+        return self.db.execute(
+                "SELECT method, median(duration), COUNT(*) FROM task_times"
+                " WHERE method IS NOT NULL GROUP BY method ORDER BY method"
+                ).fetchall()
+
+    def durations(self, task_id):
+        return [r[0] for r in self.db.execute(
+                "SELECT duration FROM task_times WHERE task = ? AND duration IS NOT NULL",
+                (task_id,))]
+
+    def times_per_task(self):
+        return self.db.execute(
+                "SELECT task, method, median(duration), COUNT(*), SUM(timeouts),"
+                " SUM(restarts) FROM task_times GROUP BY task ORDER BY task"
+                ).fetchall()
+
+
+class Ingest(Command):
+    def __init__(self, mgr):
+        self.set_mgr(mgr)
+
+    def get_keyword(self):
+        return "ingest"
+
+    def desctiption(self):
+        return "add controller logs and result tarballs to %s" % RESULTS_DB
+
+    def run(self, args):
+        if not args:
+            args = ["."]
+
+        paths = []
+        for a in args:
+            if os.path.isdir(a):
+                paths.extend(glob.glob(os.path.join(a, "experiments_*.log")))
+                paths.extend(glob.glob(os.path.join(a, "exp_*.tar.gz")))
+            else:
+                paths.append(a)
+
+        start = time.time()
+        store = ResultsStore(self.mgr)
+        try:
+            ingested, unchanged = store.ingest(paths)
+        finally:
+            store.close()
+        logging.info("ingested %d files (%d unchanged) in %.2fs",
+                ingested, unchanged, time.time() - start)
+        print "ingested %d file(s), %d unchanged (%.2fs)" % (
+                ingested, unchanged, time.time() - start)
+
+
+class QueryResults(Command):
+    def __init__(self, mgr):
+        self.set_mgr(mgr)
+
+    def get_keyword(self):
+        return "results"
+
+    def desctiption(self):
+        return "query %s: median_time | tasks" % RESULTS_DB
+
+    def complete_cmd(self, args):
+        if len(args) == 1:
+            return ["median_time", "tasks"]
+        return []
+
+    def run(self, args):
+        if not os.path.isfile(RESULTS_DB):
+            print "no results store found, use 'ingest' first"
+            return
+
+        query = args[0] if args else "median_time"
+        store = ResultsStore(self.mgr)
+        try:
+            if query == "median_time":
+                print "%-16s %10s %6s" % ("method", "median[min]", "n")
+                for method, median, n in store.median_time_per_method():
+                    print "%-16s %10.1f %6d" % (method, median / 60.0, n)
+            elif query == "tasks":
+                print "%-10s %-16s %10s %6s %8s %8s" % ("task", "method",
+                        "median[min]", "n", "timeouts", "restarts")
+                for row in store.times_per_task():
+                    task, method, median, n, timeouts, restarts = row
+                    print "%-10s %-16s %10.1f %6d %8d %8d" % (task, method or "",
+                            median / 60.0, n, timeouts, restarts)
+            else:
+                print "unknown query '%s'" % query
+        finally:
+            store.close()
@@ -0,0 +1,348 @@
+#!/usr/bin/env python2.7
+
+import os
+import time
+import fcntl
+import errno
+import shlex
+import logging
+import threading
+import collections
+from threading import Timer
+
+from commandline import Command
+import eventloop
+
+
+# state shared by all controllers (seats) on this host
+SCHED_DIR = os.environ.get("EXPCTR_SCHED_DIR", "/var/tmp/expctr-sched")
+
+# admission control is off unless enabled with --admission or
+# EXPCTR_ADMISSION=1, without it docker operations run unqueued as before
+SCHED_ENABLED = os.environ.get("EXPCTR_ADMISSION", "0") == "1"
+
+# priorities, lower values are admitted first
+PRIO_INTERACTIVE = 0
+PRIO_NORMAL = 1
+PRIO_BACKGROUND = 2
+
+# concurrent docker operations per type on this host
+OP_LIMITS = {
+    "run": 4,
+    "start": 3,
+    "exec": 6,
+    "create": 2,
+    "cp": 2,
+    "commit": 1,
+    "pull": 2,
+    "other": 6,
+    }
+
+# default priority per operation type
+OP_PRIORITY = {
+    "run": PRIO_INTERACTIVE,
+    "start": PRIO_INTERACTIVE,
+    "exec": PRIO_INTERACTIVE,
+    "create": PRIO_NORMAL,
+    "cp": PRIO_NORMAL,
+    "other": PRIO_NORMAL,
+    "commit": PRIO_BACKGROUND,
+    "pull": PRIO_BACKGROUND,
+    }
+
+# concurrent docker operations of all types on this host
+GLOBAL_LIMIT = 8
+
+# docker run -ti occupies its slot only while the container is booting
+START_HOLD = 2.0
+
+POLL_INTERVAL = 0.02
+
+# number of wait times kept per operation type for statistics
+STATS_WINDOW = 500
+
+
+class Admission(object):
+    """
+    slots held by an admitted container operation
+    """
+
+    def __init__(self, control, op, ticket, slots, wait):
+        self.control = control
+        self.op = op
+        self.ticket = ticket
+        self.slots = slots
+        self.wait = wait
+        self.lock = threading.Lock()
+
+    def release(self):
+        with self.lock:
+            for fd in self.slots:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+                finally:
+                    os.close(fd)
+            self.slots = []
+            if self.ticket != None:
+                self.control.remove_ticket(self.ticket)
+                self.ticket = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class AdmissionControl(object):
+    """
+    Host wide admission control for docker operations. Every controller on
+    this host queues its operations in SCHED_DIR, slots are flock()ed files, so
+    slots of crashed controllers are freed by the kernel.
+
+    An operation is admitted once no ticket of a higher priority (or of the
+    same type and older) is waiting, a slot for its type and a global slot
+    are free.
+    """
+
+    def __init__(self, path=SCHED_DIR, limits=None, global_limit=GLOBAL_LIMIT,
+            enabled=SCHED_ENABLED):
+        self.path = path
+        self.limits = dict(OP_LIMITS)
+        if limits:
+            self.limits.update(limits)
+        self.global_limit = global_limit
+        self.enabled = enabled
+        self.counter = 0
+        self.counter_lock = threading.Lock()
+        self.waits = collections.defaultdict(
+                lambda: collections.deque(maxlen=STATS_WINDOW))
+        self.admitted = collections.defaultdict(int)
+
+        if self.enabled:
+            try:
+                for d in ["queue", "active", "slots"]:
+                    self.make_dir(os.path.join(path, d))
+            except OSError, err:
+                logging.error("admission control disabled, can't use %s: %s",
+                        path, err)
+                self.enabled = False
+
+    def make_dir(self, d):
+        if not os.path.isdir(d):
+            try:
+                os.makedirs(d)
+                # shared between the accounts of all seats
+                os.chmod(d, 01777)
+            except OSError, err:
+                if err.errno != errno.EEXIST:
+                    raise
+
+    def classify(self, command):
+        """
+        return the operation type of a command line or None if it does not
+        need admission
+        """
+        if isinstance(command, basestring):
+            command = shlex.split(command)
+        if len(command) < 2 or os.path.basename(command[0]) != "docker":
+            return None
+        i = 1
+        # skip the daemon address of agent hosts
+        while i < len(command) and command[i].startswith("-"):
+            i += 2 if command[i] in ("-H", "--host") else 1
+        if i < len(command) and command[i] in self.limits:
+            return command[i]
+        return "other"
+
+    def new_ticket(self, op, priority):
+        with self.counter_lock:
+            self.counter += 1
+            n = self.counter
+        name = "%d-%017.6f-%d-%d-%s" % (priority, time.time(), os.getpid(), n, op)
+        open(os.path.join(self.path, "queue", name), "w").close()
+        return name
+
+    def remove_ticket(self, ticket):
+        for d in ["queue", "active"]:
+            try:
+                os.unlink(os.path.join(self.path, d, ticket))
+            except OSError:
+                pass
+
+    def ticket_alive(self, ticket):
+        pid = int(ticket.split("-")[2])
+        try:
+            os.kill(pid, 0)
+        except OSError, err:
+            if err.errno == errno.ESRCH:
+                self.remove_ticket(ticket)
+                return False
+        return True
+
+    def is_blocked(self, ticket, op, priority):
+        for other in sorted(os.listdir(os.path.join(self.path, "queue"))):
+            if other >= ticket:
+                return False
+            o_prio = int(other.split("-")[0])
+            o_op = other.rsplit("-", 1)[1]
+            if (o_prio < priority or o_op == op) and self.ticket_alive(other):
+                return True
+        return False
+
+    def try_slot(self, name, limit):
+        for i in range(limit):
+            path = os.path.join(self.path, "slots", "%s.%d" % (name, i))
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0666)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except IOError:
+                os.close(fd)
+        return None
+
+    def acquire(self, op, priority=None):
+        if priority == None:
+            priority = OP_PRIORITY.get(op, PRIO_NORMAL)
+        if not self.enabled:
+            return Admission(self, op, None, [], 0.0)
+
+        start = time.time()
+        ticket = self.new_ticket(op, priority)
+        try:
+            while True:
+                adm = self.poll(ticket, op, priority, start)
+                if adm != None:
+                    return adm
+                time.sleep(POLL_INTERVAL)
+        except:
+            self.remove_ticket(ticket)
+            raise
+
+    def poll(self, ticket, op, priority, start):
+        """
+        try once to admit a queued ticket, returns the Admission or None if
+        it has to wait. Does not block, the event loop polls with it.
+        """
+        if self.is_blocked(ticket, op, priority):
+            return None
+        op_slot = self.try_slot(op, self.limits.get(op, 1))
+        if op_slot == None:
+            return None
+        g_slot = self.try_slot("global", self.global_limit)
+        if g_slot == None:
+            fcntl.flock(op_slot, fcntl.LOCK_UN)
+            os.close(op_slot)
+            return None
+
+        os.rename(os.path.join(self.path, "queue", ticket),
+                os.path.join(self.path, "active", ticket))
+        wait = time.time() - start
+        self.waits[op].append(wait)
+        self.admitted[op] += 1
+        if wait > 1.0:
+            logging.info("%s operation waited %.2fs for admission", op, wait)
+        return Admission(self, op, ticket, [op_slot, g_slot], wait)
+
+    def admit(self, command, priority=None):
+        """
+        admission for a command line, use as context manager:
+
+            with admission.admit(cmd):
+                subprocess.call(cmd)
+        """
+        op = self.classify(command)
+        if op == None:
+            return Admission(self, None, None, [], 0.0)
+        return self.acquire(op, priority)
+
+    def admit_async(self, command, priority=None):
+        """
+        admit() for coroutines: polls on the event loop instead of sleeping,
+        yield the result to get the Admission
+        """
+        op = self.classify(command)
+        if op == None or not self.enabled:
+            f = eventloop.Future(eventloop.get_loop())
+            f.set_result(self.admit(command, priority))
+            return f
+        if priority == None:
+            priority = OP_PRIORITY.get(op, PRIO_NORMAL)
+        return self.poll_admission(op, priority)
+
+    def poll_admission(self, op, priority):
+        start = time.time()
+        ticket = self.new_ticket(op, priority)
+        try:
+            while True:
+                adm = self.poll(ticket, op, priority, start)
+                if adm != None:
+                    raise eventloop.Return(adm)
+                yield eventloop.get_loop().sleep(POLL_INTERVAL)
+        except eventloop.Return:
+            raise
+        except:
+            self.remove_ticket(ticket)
+            raise
+
+    def admit_start(self, command, priority=None):
+        """
+        admission for a long running interactive command, the slots are
+        released after START_HOLD seconds while the command keeps running
+        """
+        adm = self.admit(command, priority)
+        if adm.slots:
+            t = Timer(START_HOLD, adm.release)
+            t.daemon = True
+            t.start()
+        return adm
+
+    def queue_status(self):
+        """
+        return {op: (waiting, active)} of all controllers on this host
+        """
+        status = dict([(op, [0, 0]) for op in self.limits])
+        if not self.enabled:
+            return status
+        for i, d in enumerate(["queue", "active"]):
+            for ticket in os.listdir(os.path.join(self.path, d)):
+                op = ticket.rsplit("-", 1)[1]
+                if op in status and self.ticket_alive(ticket):
+                    status[op][i] += 1
+        return status
+
+    def wait_stats(self, op):
+        """
+        return (admitted, mean wait, p95 wait, max wait) of this controller
+        """
+        waits = sorted(self.waits[op])
+        if not waits:
+            return (self.admitted[op], 0.0, 0.0, 0.0)
+        p95 = waits[min(len(waits) - 1, int(len(waits) * 0.95))]
+        return (self.admitted[op], sum(waits) / len(waits), p95, waits[-1])
+
+
+class SchedulerStatus(Command):
+    def __init__(self, mgr):
+        self.set_mgr(mgr)
+
+    def get_keyword(self):
+        return "sched_status"
+
+    def desctiption(self):
+        return "show the container operation queues of this host"
+
+    def run(self, args):
+        adm = self.mgr.admission
+        if not adm.enabled:
+            print "admission control disabled"
+            return
+
+        status = adm.queue_status()
+        print "%-8s %5s %7s %6s | %8s %8s %8s %8s" % ("op", "limit", "waiting",
+                "active", "admitted", "mean[s]", "p95[s]", "max[s]")
+        for op in sorted(status):
+            waiting, active = status[op]
+            n, mean, p95, maxw = adm.wait_stats(op)
+            print "%-8s %5d %7d %6d | %8d %8.2f %8.2f %8.2f" % (op,
+                    adm.limits[op], waiting, active, n, mean, p95, maxw)
@@ -0,0 +1,206 @@
+#!/usr/bin/env python2.7
+
+import os
+import json
+import time
+import shlex
+import logging
+import binascii
+import subprocess
+from multiprocessing.pool import ThreadPool
+
+from basic_commands import ExecCommand, EDITOR_CNT_IMAGE
+from task import classify
+
+
+# boot times of all tested image versions
+SELFTEST_HISTORY = "selftest_history.json"
+
+# output of the test entry points
+SELFTEST_LOG_DIR = "selftest_logs"
+
+# task containers running at the same time
+SELFTEST_WORKERS = 4
+
+# boots per image after the first (cold) one
+WARM_RUNS = 3
+
+# a warm boot this much slower than with the previous image version is
+# reported as regression
+REGRESSION_FACTOR = 1.2
+REGRESSION_MIN = 0.2
+
+class SelfTest(ExecCommand):
+    def __init__(self, mgr):
+        self.set_mgr(mgr)
+
+    def get_keyword(self):
+        return "selftest"
+
+    def desctiption(self):
+        return "boot every task image through its init script, run puppet and the tests, report boot times"
+
+    def help_msg(self):
+        return "%s: [--no-boot]" % self.get_keyword()
+
+    def combinations(self):
+        """
+        tasks with distinct (image, manifest, modules) combinations
+        """
+        combos = {}
+        for task_id in sorted(self.mgr.get_tasks().keys()):
+            task = self.mgr.get_task(task_id)
+            if not hasattr(task, 'cnt_image'):
+                continue
+            combos.setdefault((task.cnt_image, task.manifest, task.modules), task)
+        return [combos[k] for k in sorted(combos)]
+
+    def image_id(self, image):
+        out, ret = self.exec_cmd("docker inspect --format '{{.Id}}' %s" % image,
+                silent=True)
+        if ret != 0:
+            return None
+        return out.strip()
+
+    def boot(self, image):
+        """
+        seconds from 'docker run' to the exit of a no-op container
+        """
+        cmd = "docker run --rm --net=none --entrypoint /bin/true %s" % image
+        with self.mgr.admission.admit(cmd):
+            start = time.time()
+            ret = subprocess.call(shlex.split(cmd), stdout=open(os.devnull, "w"),
+                    stderr=subprocess.STDOUT)
+            duration = time.time() - start
+        if ret != 0:
+            return None
+        return duration
+
+    def boot_times(self, image):
+        """
+        (cold, warm) boot time, the first boot of an image is the cold one
+        """
+        cold = self.boot(image)
+        if cold == None:
+            return (None, None)
+        warm = [self.boot(image) for i in range(WARM_RUNS)]
+        warm = sorted([w for w in warm if w != None])
+        if not warm:
+            return (cold, None)
+        return (cold, warm[len(warm) // 2])
+
+    def create_volume(self):
+        """
+        a throwaway volume with a copy of the editor's sources, None on errors
+        """
+        volume = "expctr_selftest_%s" % binascii.hexlify(os.urandom(4))
+        out, ret = self.exec_cmd("docker volume create %s" % volume, silent=True)
+        if ret != 0:
+            return None
+        out, ret = self.exec_cmd("docker run --rm --net=none -v %s:/home/user/src --entrypoint /bin/true %s" % (
+            volume, EDITOR_CNT_IMAGE), silent=True)
+        if ret != 0:
+            self.exec_cmd("docker volume rm %s" % volume, silent=True)
+            return None
+        return volume
+
+    def run_test(self, task):
+        log_file = os.path.join(SELFTEST_LOG_DIR, "%s.log" % task.id)
+        start = time.time()
+        # puppet and the tests write to the sources, every combination
+        # gets its own copy
+        volume = self.create_volume()
+        if volume == None:
+            with open(log_file, "w") as log:
+                log.write("could not copy the sources of %s\n" % EDITOR_CNT_IMAGE)
+            return (task, {}, time.time() - start, log_file)
+        try:
+            steps = task.run_headless("--rm --net=none -v %s:/home/user/src" % volume,
+                    log_file)
+        finally:
+            self.exec_cmd("docker volume rm %s" % volume, silent=True)
+        return (task, steps, time.time() - start, log_file)
+
+    def load_history(self):
+        if os.path.isfile(SELFTEST_HISTORY):
+            with open(SELFTEST_HISTORY) as f:
+                return json.load(f)
+        return {}
+
+    def save_history(self, history):
+        with open(SELFTEST_HISTORY + ".tmp", "w") as f:
+            json.dump(history, f, indent=1, sort_keys=True)
+        os.rename(SELFTEST_HISTORY + ".tmp", SELFTEST_HISTORY)
+
+    def previous(self, runs, image_id):
+        """
+        newest run of another version of the image
+        """
+        others = [r for i, r in runs.items() if i != image_id]
+        if not others:
+            return None
+        return max(others, key=lambda r: r["time"])
+
+    def measure_boot_times(self, images):
+        history = self.load_history()
+        print "%-32s %-14s %8s %8s  %s" % ("image", "id", "cold[s]", "warm[s]", "")
+        for image in images:
+            image_id = self.image_id(image)
+            if image_id == None:
+                print "%-32s %-14s %8s %8s  image not available" % (image, "-", "-", "-")
+                continue
+            cold, warm = self.boot_times(image)
+            if cold == None or warm == None:
+                print "%-32s %-14s %8s %8s  does not boot" % (image, image_id[7:19], "-", "-")
+                continue
+
+            runs = history.setdefault(image, {})
+            prev = self.previous(runs, image_id)
+            note = ""
+            if prev != None and warm > prev["warm"] * REGRESSION_FACTOR + REGRESSION_MIN:
+                note = "REGRESSION (was %.2fs with %s)" % (prev["warm"], prev["id"][7:19])
+            runs[image_id] = {"id": image_id, "time": int(time.time()),
+                    "cold": round(cold, 3), "warm": round(warm, 3)}
+            print "%-32s %-14s %8.2f %8.2f  %s" % (image, image_id[7:19], cold, warm, note)
+        self.save_history(history)
+
+    def run(self, args):
+        if args and args != ["--no-boot"]:
+            print self.help_msg()
+            return False
+
+        combos = self.combinations()
+        if not combos:
+            print "no task containers defined"
+            return False
+
+        if not "--no-boot" in args:
+            # sequentially, parallel boots would measure each other
+            images = []
+            for t in combos:
+                if not t.cnt_image in images:
+                    images.append(t.cnt_image)
+            self.measure_boot_times(images)
+            print
+
+        if not os.path.isdir(SELFTEST_LOG_DIR):
+            os.makedirs(SELFTEST_LOG_DIR)
+        print "testing %d task/method combination(s)..." % len(combos)
+        pool = ThreadPool(SELFTEST_WORKERS)
+        try:
+            results = pool.map(self.run_test, combos)
+        finally:
+            pool.close()
+            pool.join()
+
+        errors = 0
+        print "%-10s %-28s %-30s %6s  %s" % ("task", "image", "manifest", "time", "result")
+        for task, steps, duration, log_file in results:
+            result, ok = classify(steps)
+            if not ok:
+                result += ", see %s" % log_file
+                errors += 1
+            print "%-10s %-28s %-30s %5.1fs  %s" % (task.id, task.cnt_image,
+                    task.manifest, duration, result)
+        logging.info("selftest: %d of %d combinations failed to run", errors, len(results))
+        return errors == 0
@@ -0,0 +1,277 @@
+#!/usr/bin/env python2.7
+
+import os
+import stat
+import time
+import fcntl
+import shutil
+import tarfile
+import logging
+import StringIO
+
+from basic_commands import ExecCommand, EDITOR_CNT_IMAGE
+
+
+# how the editor's /home/user/src is provided: a full copy per seat
+# (anonymous volume) or a shared skeleton with a per seat overlay
+STORAGE_MODES = ["copy", "overlay"]
+DEFAULT_STORAGE = "copy"
+
+# skeletons (one per editor image id) and the overlay dirs of all seats
+SKELETON_DIR = os.environ.get("EXPCTR_SKELETON_DIR", "/var/tmp/expctr-skeleton")
+
+# docker volumes holding the overlay of an editor container
+SRC_VOLUME_PREFIX = "expctr_src_"
+
+SRC_DIR = "/home/user/src"
+
+# members of the overlay tarballs of earlier versions, which held only the
+# changes: the skeleton's image id and deleted files
+SKELETON_MARKER = ".expctr_skeleton"
+WHITEOUTS = ".expctr_whiteouts"
+
+
+def dir_size(path):
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for f in filenames:
+            try:
+                size += os.lstat(os.path.join(dirpath, f)).st_size
+            except OSError:
+                pass
+    return size
+
+
+def is_whiteout(path):
+    """
+    overlayfs marks deleted lower files with a 0/0 character device
+    """
+    st = os.lstat(path)
+    return stat.S_ISCHR(st.st_mode) and st.st_rdev == 0
+
+
+def merged_members(upper, lower, listing):
+    """
+    [(member name, host path)] of the merged overlay: listing holds the
+    paths visible in the mounted overlay (relative to its root), every one
+    is read from the upper dir if it is there, from the lower dir otherwise.
+    Deleted files and the lower contents of replaced (opaque) directories
+    are not in the listing, so whiteouts and opaque markers need no
+    special handling.
+    """
+    members = [("src", upper)]
+    for rel in sorted(listing):
+        path = os.path.join(upper, rel)
+        if not os.path.lexists(path) or is_whiteout(path):
+            path = os.path.join(lower, rel)
+        if not os.path.lexists(path):
+            # removed since it was listed
+            logging.debug("%s vanished during the export", rel)
+            continue
+        members.append((os.path.join("src", rel), path))
+    return members
+
+
+class OverlayStorage(ExecCommand):
+    """
+    All editors on this host share one read-only copy of the image's
+    /home/user/src (the skeleton, extracted once per image id). Every editor
+    gets a local overlay volume on top of it, its upper dir holds only the
+    participant's changes.
+    """
+
+    def __init__(self, mgr, path=SKELETON_DIR):
+        self.set_mgr(mgr)
+        self.path = path
+        for d in ["images", "volumes"]:
+            if not os.path.isdir(os.path.join(path, d)):
+                os.makedirs(os.path.join(path, d))
+
+    def get_keyword(self):
+        return "storage"
+
+    def desctiption(self):
+        return "show the disk usage of the shared skeleton and the seat overlays"
+
+    def image_id(self):
+        out, ret = self.exec_cmd("docker image inspect --format '{{.Id}}' %s" % EDITOR_CNT_IMAGE,
+                silent=True)
+        if ret != 0:
+            return None
+        return out.strip().split(":")[-1][:16]
+
+    def skeleton(self, image_id):
+        """
+        return the skeleton dir of the image, extracted on first use
+        """
+        target = os.path.join(self.path, "images", image_id)
+        lock = open(target + ".lock", "w")
+        try:
+            # other controllers may extract the same image right now
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.isfile(os.path.join(target, ".complete")):
+                return os.path.join(target, "src")
+            if os.path.isdir(target):
+                shutil.rmtree(target)
+            os.makedirs(os.path.join(target, "src"))
+            # the files are writable for everybody, only this controller
+            # may enter the skeleton on the host
+            os.chmod(target, 0700)
+
+            # copied as root within the image, then handed over to the
+            # controller so it can read, export and remove the skeleton. The
+            # participant's user in the editor copies files up on writes.
+            start = time.time()
+            out, ret = self.exec_cmd("docker run --rm --net=none -v %s:/skeleton %s "
+                    "sh -c 'cp -a %s/. /skeleton/ && chown -R %d:%d /skeleton && chmod -R a+rwX /skeleton'" % (
+                    os.path.join(target, "src"), EDITOR_CNT_IMAGE, SRC_DIR,
+                    os.getuid(), os.getgid()))
+            if ret != 0:
+                return None
+            open(os.path.join(target, ".complete"), "w").close()
+            logging.info("extracted skeleton of %s (%s) in %.1fs", EDITOR_CNT_IMAGE,
+                    image_id, time.time() - start)
+            return os.path.join(target, "src")
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+
+    def volume_dirs(self, volume):
+        d = os.path.join(self.path, "volumes", volume)
+        return (os.path.join(d, "upper"), os.path.join(d, "work"))
+
+    def create_volume(self, name):
+        """
+        create the overlay volume <SRC_VOLUME_PREFIX><name>, returns its name
+        or None on errors
+        """
+        image_id = self.image_id()
+        if image_id == None:
+            return None
+        lower = self.skeleton(image_id)
+        if lower == None:
+            return None
+
+        volume = SRC_VOLUME_PREFIX + name
+        upper, work = self.volume_dirs(volume)
+        for d in [upper, work]:
+            if not os.path.isdir(d):
+                os.makedirs(d)
+        with open(os.path.join(os.path.dirname(upper), "image"), "w") as f:
+            f.write(image_id)
+
+        out, ret = self.exec_cmd("docker volume create --driver local --opt type=overlay"
+                " --opt device=overlay --opt o=lowerdir=%s,upperdir=%s,workdir=%s %s" % (
+                    lower, upper, work, volume))
+        if ret != 0:
+            return None
+        return volume
+
+    def container_volume(self, cnt_id):
+        """
+        return the overlay volume mounted at /home/user/src of a container
+        """
+        out, ret = self.exec_cmd("docker inspect --format "
+                "'{{range .Mounts}}{{if eq .Destination \"%s\"}}{{.Name}}{{end}}{{end}}' %s" % (
+                    SRC_DIR, cnt_id), silent=True)
+        name = (out or "").strip()
+        if ret != 0 or not name.startswith(SRC_VOLUME_PREFIX):
+            return None
+        return name
+
+    def export(self, cnt_id, tarball, extra_files={}):
+        """
+        write the complete sources of the container to tarball, like the
+        copy mode exports: the skeleton merged with the participant's
+        changes, read from the overlay's layers on the host. extra_files
+        maps member names to contents. Returns False if the container has
+        no overlay volume or its files can't be listed.
+        """
+        volume = self.container_volume(cnt_id)
+        if volume == None:
+            return False
+        upper, work = self.volume_dirs(volume)
+        with open(os.path.join(os.path.dirname(upper), "image")) as f:
+            image_id = f.read().strip()
+        lower = os.path.join(self.path, "images", image_id, "src")
+
+        # deleted and replaced directories show up only in the merged view
+        out, ret = self.exec_cmd("docker exec %s find %s -mindepth 1 -printf '%%P\\0'" % (
+                cnt_id, SRC_DIR), silent=True)
+        if ret != 0:
+            logging.error("could not list the sources of %s", cnt_id)
+            return False
+        listing = [rel for rel in out.split("\0") if rel]
+
+        tmp = tarball + ".tmp"
+        tar = tarfile.open(tmp, "w:gz", format=tarfile.PAX_FORMAT)
+        try:
+            for member, path in merged_members(upper, lower, listing):
+                tar.add(path, member, recursive=False)
+            for name in sorted(extra_files):
+                info = tarfile.TarInfo(name)
+                info.size = len(extra_files[name])
+                info.mtime = time.time()
+                tar.addfile(info, StringIO.StringIO(extra_files[name]))
+        except:
+            tar.close()
+            os.unlink(tmp)
+            raise
+        tar.close()
+        os.rename(tmp, tarball)
+        return True
+
+    def remove_volume(self, volume):
+        out, ret = self.exec_cmd("docker volume rm %s" % volume, silent=True)
+        if ret == 0:
+            shutil.rmtree(os.path.join(self.path, "volumes", volume), True)
+        return ret == 0
+
+    def prune(self):
+        """
+        remove the overlays of removed editor containers, returns their number
+        """
+        out, ret = self.exec_cmd("docker volume ls -q --filter dangling=true --filter name=%s" % SRC_VOLUME_PREFIX,
+                silent=True)
+        removed = 0
+        for volume in (out or "").split():
+            if volume.startswith(SRC_VOLUME_PREFIX) and self.remove_volume(volume):
+                removed += 1
+        return removed
+
+    def run(self, args):
+        print "%-30s %12s" % ("skeleton / overlay", "size[MiB]")
+        for kind in ["images", "volumes"]:
+            d = os.path.join(self.path, kind)
+            for name in sorted(os.listdir(d)):
+                if os.path.isdir(os.path.join(d, name)):
+                    print "%-30s %12.1f" % (name, dir_size(os.path.join(d, name)) / 1048576.0)
+
+
+def materialize(tarball, target, path=SKELETON_DIR):
+    """
+    extract an overlay tarball of an earlier version on top of a copy of
+    its skeleton. Returns False if tarball is a full tarball.
+    """
+    tar = tarfile.open(tarball)
+    try:
+        names = tar.getnames()
+        if not SKELETON_MARKER in names:
+            return False
+        image_id = tar.extractfile(SKELETON_MARKER).read().strip()
+        skeleton = os.path.join(path, "images", image_id, "src")
+        if not os.path.isdir(skeleton):
+            raise IOError("skeleton %s of %s not available" % (image_id, tarball))
+        if os.path.isdir(os.path.join(target, "src")):
+            shutil.rmtree(os.path.join(target, "src"))
+        shutil.copytree(skeleton, os.path.join(target, "src"), symlinks=True)
+        for w in tar.extractfile(WHITEOUTS).read().splitlines():
+            w = os.path.join(target, w)
+            if os.path.isdir(w) and not os.path.islink(w):
+                shutil.rmtree(w)
+            elif os.path.lexists(w):
+                os.unlink(w)
+        tar.extractall(target)
+    finally:
+        tar.close()
+    return True
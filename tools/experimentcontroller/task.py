@@ -7,15 +7,59 @@ import os
 import re
 import commandline
 import logging
-from threading import Timer
 import socket
 import time
+import metrics
+import questionnaire
+import recording
+import timeout_policy
+from basic_commands import EDITOR_CNT_IMAGE
+
+# entry point of the task containers
+CONTAINER_INIT_CMD = "/bin/container_init.sh"
+
+# headless test run of the task containers: their init script starts a
+# shell which reads these commands from stdin. Every step reports its exit
+# status on a marker line, so init, puppet and test failures are told apart.
+TEST_SCRIPT = """echo EXPCTR_STEP init 0
+run_puppet; echo EXPCTR_STEP puppet $?
+run_test -a; echo EXPCTR_STEP test $?
+exit
+"""
+STEP_MARKER = re.compile(r"^EXPCTR_STEP (?P<step>\w+) (?P<status>\d+)\s*$")
+# puppet's detailed exit codes: no changes, changes applied
+PUPPET_OK = (0, 2)
+
+
+def parse_steps(output):
+    """
+    {step: exit status} of the marker lines in the output of a test run
+    """
+    steps = {}
+    for line in output.splitlines():
+        m = STEP_MARKER.match(line)
+        if m:
+            steps[m.group("step")] = int(m.group("status"))
+    return steps
+
+
+def classify(steps):
+    """
+    (result, ok) of a test run, failing tests of the unsolved skeletons are
+    expected, a broken init script or puppet run are not
+    """
+    if not "init" in steps:
+        return ("ERROR: the init script did not start the shell", False)
+    if not "puppet" in steps:
+        return ("ERROR: run_puppet did not finish", False)
+    if not steps["puppet"] in PUPPET_OK:
+        return ("ERROR: puppet fails (%d), wrong MANIFEST/MODULES?" % steps["puppet"], False)
+    if not "test" in steps:
+        return ("ERROR: run_test did not finish", False)
+    if steps["test"] == 0:
+        return ("tests pass", True)
+    return ("puppet ok, tests fail (%d)" % steps["test"], True)
 
-# limit for task working time (in seconds)
-TASK_TIMEOUT = 4500
-
-# repeated timeout after TASK_TIMEOUT was reached
-TASK_TIMEOUT_REPEAT = 180
 
 
 class Task(object):
@@ -50,9 +94,51 @@ class Task(object):
 
         self.timer = None
 
+        # attempts of this task, each one is recorded separately
+        self.attempt = 0
+        self.recorder = None
+
     def set_manager(self, manager):
         self.mgr = manager
 
+    def get_docker_cmd(self, run_opts, command=None, docker_cli="docker"):
+        """
+        return the 'docker run' command line for this task's container.
+        run_opts are additional options for 'docker run' (e.g. volumes),
+        command defaults to the interactive container init script
+        """
+        if command == None:
+            command = CONTAINER_INIT_CMD
+
+        cnt_hostname = re.sub(r'[^\w\d]', '_', self.method)
+
+        docker_cmd =  "%s run %s" % (docker_cli, run_opts)
+        docker_cmd += " -e MANIFEST=%s -e MODULES=%s" % (self.manifest, self.modules)
+        docker_cmd += " -h %s" % cnt_hostname
+        docker_cmd += " %s" % self.cnt_image
+        docker_cmd += " %s" % command
+        return docker_cmd
+
+    def run_headless(self, run_opts, log_file):
+        """
+        run the container's init script without terminal and display, with
+        TEST_SCRIPT as input. The output goes to log_file, returns
+        {step: exit status} of the steps which finished
+        """
+        cmd = self.get_docker_cmd("-i %s" % run_opts)
+        logging.debug("running %s", cmd)
+        with open(log_file, "w") as log:
+            with self.mgr.admission.admit(cmd):
+                try:
+                    p = subprocess.Popen(shlex.split(cmd), stdin=subprocess.PIPE,
+                            stdout=log, stderr=subprocess.STDOUT)
+                    p.communicate(TEST_SCRIPT)
+                    logging.debug("%s exited with %d", cmd, p.returncode)
+                except OSError, err:
+                    logging.error("error running %s: %s", cmd, err)
+        with open(log_file) as log:
+            return parse_steps(log.read())
+
     def print_progress(self):
         exp = self.mgr.get_experiment()
         cur_task_index = exp.get_current_task_index()
@@ -81,6 +167,8 @@ class Task(object):
             print "error: no editor container running, experiment started?"
             return False
 
+        self.mgr.task_started(self)
+
         print \
 """----------------------------------------------------------------------
 {name} test container
@@ -101,6 +189,11 @@ class Task(object):
         while not c.yes_no_question("if you are ready press 'y' to start"):
             pass
 
+        # the image may still be fetched in the background
+        if self.mgr.image_scheduler != None and self.mgr.get_agent() == None:
+            if not self.mgr.image_scheduler.wait_for(self.cnt_image):
+                return False
+
         print \
 """
 starting {name}
@@ -122,14 +215,17 @@ if you have done the task run
 
         # open the src_dir in editor
         #
-        editor_cmd = "docker exec -ti %s /bin/atom_open_file %s" % (
-                editor_cnt_id, self.src_dir)
+        editor_cmd = "%s exec -ti %s /bin/atom_open_file %s" % (
+                self.mgr.get_docker_cli(), editor_cnt_id, self.src_dir)
 
         logging.debug("running docker cmd: %s", editor_cmd)
 
-        p = subprocess.Popen(shlex.split(editor_cmd),
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        out, err = p.communicate()
+        start = time.time()
+        with self.mgr.admission.admit(editor_cmd):
+            p = subprocess.Popen(shlex.split(editor_cmd),
+                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            out, err = p.communicate()
+        metrics.CONTAINER_OPS.observe(time.time() - start, op="exec")
         logging.debug("got returncode: %s, stdout: '%s', stderr: '%s'",
                 p.returncode, out, err)
         if p.returncode != 0:
@@ -139,13 +235,9 @@ if you have done the task run
             return False
 
 
-        cnt_hostname = re.sub(r'[^\w\d]', '_', self.method)
-
-        docker_cmd =  "docker run -ti --volumes-from %s" % editor_cnt_id
-        docker_cmd += " -e MANIFEST=%s -e MODULES=%s" % (self.manifest, self.modules)
-        docker_cmd += " -h %s" % cnt_hostname
-        docker_cmd += " %s" % self.cnt_image
-        docker_cmd += " /bin/container_init.sh"
+        docker_cmd = self.get_docker_cmd("-ti --volumes-from %s%s" % (
+            editor_cnt_id, self.mgr.get_resource_opts()),
+            docker_cli=self.mgr.get_docker_cli())
 
         logging.debug("running docker command: %s", docker_cmd)
 
@@ -153,12 +245,22 @@ if you have done the task run
             print "running command: %s" % docker_cmd
 
 
+        # a restarted task keeps its watch
         if self.timer == None:
-            logging.debug("starting timeout timer with %s sec", TASK_TIMEOUT)
-            self.timer = Timer(TASK_TIMEOUT, self.timeout)
-            self.timer.start()
+            self.timer = timeout_policy.TaskWatch(self, editor_cnt_id)
 
-        os.system(docker_cmd)
+        # the slot is only held while the container boots, not while the
+        # participant works in it
+        exp = self.mgr.get_experiment()
+        self.attempt += 1
+        self.recorder = recording.Recorder(recording.recording_path(
+            "%s_%s" % (exp.group_name, exp.user_name), self.id, self.attempt),
+            title="%s attempt %d" % (self.name, self.attempt))
+        admission = self.mgr.admission.admit_start(docker_cmd)
+        try:
+            self.recorder.run(shlex.split(docker_cmd))
+        finally:
+            admission.release()
 
         print
         c = commandline.Command()
@@ -167,33 +269,35 @@ if you have done the task run
             print "restarting current task"
             self.start(editor_cnt_id)
 
-        try:
+        if self.timer != None:
             self.timer.cancel()
-        except:
-            pass
+            self.timer = None
 
         logging.info("task %s finished", self.id)
+        self.mgr.task_finished(self)
 
 
+    def help_request(self):
+        """
+        command line asking the supervisors for help with this task
+        """
+        exp = self.mgr.get_experiment()
+        user_str = "{}_{}_{}".format(exp.group_name, exp.user_name, self.name.replace(" ", "_"))
+        logging.info("timeout reached for task %s ('%s')", self.name, user_str)
+        metrics.TIMEOUTS.inc(task=self.id)
+        jabber_req = "http://alekto.inflab.tuwien.ac.at:8080/help?pc={}&user={}&time={}&status=help".format(
+                socket.gethostname(),
+                user_str,
+                int(time.time()))
+        curl_cmd = ["curl", "-m", "5", jabber_req]
+        logging.info("running %s", " ".join(curl_cmd))
+        return curl_cmd
+
     def timeout(self):
         try:
-            exp = self.mgr.get_experiment()
-            user_str = "{}_{}_{}".format(exp.group_name, exp.user_name, self.name.replace(" ", "_"))
-            logging.info("timeout reached for task %s ('%s')", self.name, user_str)
-            jabber_req = "http://alekto.inflab.tuwien.ac.at:8080/help?pc={}&user={}&time={}&status=help".format(
-                    socket.gethostname(),
-                    user_str,
-                    int(time.time()))
-            curl_cmd = ["curl", "-m", "5", jabber_req]
-            logging.info("running %s", " ".join(curl_cmd))
-            p = subprocess.Popen(curl_cmd,
+            p = subprocess.Popen(self.help_request(),
                     stdout=subprocess.PIPE, stderr=subprocess.PIPE)
             p.communicate()
-
-            logging.debug("starting repeated timeout task with %s sec",
-                    TASK_TIMEOUT_REPEAT)
-            self.timer = Timer(TASK_TIMEOUT_REPEAT, self.timeout)
-            self.timer.start()
         except:
             e = sys.exc_info()[0]
             what = sys.exc_info()[1]
@@ -208,6 +312,8 @@ class QuestionTask(Task):
         self.task_dir = task_dir
         self.question_file = question_file
         self.duration = 5
+        # unanswered questionnaire, "" if it could not be read
+        self.template = None
 
     def start(self, editor_cnt_id):
         logging.info("starting QuestionTask %s", self.id)
@@ -216,6 +322,8 @@ class QuestionTask(Task):
             print "error: not editor container running, experiment started?"
             return False
 
+        self.mgr.task_started(self)
+
         self.print_progress()
 
         print """
@@ -224,15 +332,19 @@ class QuestionTask(Task):
 
         # open the questionnaire
         #
-        editor_cmd = "docker exec -ti {cnt_id} /bin/atom_open_file /home/user/src/{taskdir}/{file}".format(
+        editor_cmd = "{docker} exec -ti {cnt_id} /bin/atom_open_file /home/user/src/{taskdir}/{file}".format(
+                docker=self.mgr.get_docker_cli(),
                 cnt_id=editor_cnt_id,
                 taskdir=self.task_dir,
                 file=self.question_file)
         logging.debug("running docker cmd: %s", editor_cmd)
 
-        p = subprocess.Popen(shlex.split(editor_cmd),
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        out, err = p.communicate()
+        start = time.time()
+        with self.mgr.admission.admit(editor_cmd):
+            p = subprocess.Popen(shlex.split(editor_cmd),
+                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            out, err = p.communicate()
+        metrics.CONTAINER_OPS.observe(time.time() - start, op="exec")
         logging.debug("got returncode: %s, stdout: '%s', stderr: '%s'",
                 p.returncode, out, err)
         if p.returncode != 0:
@@ -242,10 +354,68 @@ class QuestionTask(Task):
             return False
 
         c = commandline.Command()
-        while not c.yes_no_question("if you have answered all questions press 'y' to proceed (don't forget to save (CTRL-s))"):
-            pass
+        while True:
+            while not c.yes_no_question("if you have answered all questions press 'y' to proceed (don't forget to save (CTRL-s))"):
+                pass
+
+            items = self.read_answers(editor_cnt_id)
+            if items == None:
+                break
+            missing = [i for i in items if not i.is_answered()]
+            if not missing:
+                break
+            print "\n  the following questions are not answered (yet):"
+            for i in missing:
+                print "    %s. %s" % (i.id, i.text)
+            print
+            if not c.yes_no_question("do you want to answer them now"):
+                break
+
+        if items != None:
+            questionnaire.append_results(
+                    questionnaire.make_record(self.mgr.get_experiment(), self, items))
 
         logging.info("QuestionTask %s finished", self.id)
-
-
-
+        self.mgr.task_finished(self)
+
+    def read_answers(self, editor_cnt_id):
+        """
+        read and parse the saved questionnaire, returns None if it can't be read
+        """
+        cmd = "{docker} exec {cnt_id} cat /home/user/src/{taskdir}/{file}".format(
+                docker=self.mgr.get_docker_cli(),
+                cnt_id=editor_cnt_id,
+                taskdir=self.task_dir,
+                file=self.question_file)
+        logging.debug("running docker cmd: %s", cmd)
+        with self.mgr.admission.admit(cmd):
+            p = subprocess.Popen(shlex.split(cmd),
+                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            out, err = p.communicate()
+        if p.returncode != 0:
+            logging.error("could not read questionnaire %s: %s", self.question_file, err)
+            return None
+        return questionnaire.parse(out, self.read_template())
+
+    def read_template(self):
+        """
+        the unanswered questionnaire as shipped in the editor image, read
+        once. Returns None if it is not available.
+        """
+        if self.template == None:
+            cmd = "{docker} run --rm --net=none --entrypoint cat {image} /home/user/src/{taskdir}/{file}".format(
+                    docker=self.mgr.get_docker_cli(),
+                    image=EDITOR_CNT_IMAGE,
+                    taskdir=self.task_dir,
+                    file=self.question_file)
+            logging.debug("running docker cmd: %s", cmd)
+            with self.mgr.admission.admit(cmd):
+                p = subprocess.Popen(shlex.split(cmd),
+                        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                out, err = p.communicate()
+            if p.returncode != 0:
+                logging.error("could not read the template of %s: %s",
+                        self.question_file, err)
+                out = ""
+            self.template = out
+        return self.template or None
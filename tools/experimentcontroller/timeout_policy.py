@@ -0,0 +1,224 @@
+#!/usr/bin/env python2.7
+
+import os
+import time
+import shlex
+import logging
+import sqlite3
+import threading
+import subprocess
+
+import eventloop
+from results_store import ResultsStore, RESULTS_DB
+
+
+# help is requested once a participant is over time and did neither save a
+# file nor run the tests for this long (seconds)
+IDLE_LIMIT = 600
+
+# the expected time is this quantile of the task's past durations ...
+HISTORY_QUANTILE = 0.9
+# ... if there are at least this many, otherwise Task.duration times
+# OVERTIME_FACTOR is used
+MIN_HISTORY = 5
+OVERTIME_FACTOR = 1.5
+
+# used if neither history nor Task.duration are available (seconds)
+DEFAULT_EXPECTED = 4500
+
+# interval of the activity checks once over time (seconds)
+CHECK_INTERVAL = 60
+
+# minimal time between two help requests for the same participant (seconds)
+HELP_REPEAT = 180
+
+_history = {}
+_history_lock = threading.Lock()
+
+
+def quantile(values, q):
+    v = sorted(values)
+    return v[min(len(v) - 1, int(len(v) * q))]
+
+
+def history(mgr, task_id):
+    """
+    past durations (seconds) of a task from the results store, read once
+    """
+    with _history_lock:
+        if not task_id in _history:
+            durations = []
+            if os.path.isfile(RESULTS_DB):
+                try:
+                    store = ResultsStore(mgr)
+                    try:
+                        durations = store.durations(task_id)
+                    finally:
+                        store.close()
+                except sqlite3.Error, err:
+                    logging.error("could not read task history: %s", err)
+            _history[task_id] = durations
+        return _history[task_id]
+
+
+def expected_time(mgr, task):
+    """
+    time (seconds) after which a participant is considered over time
+    """
+    durations = history(mgr, task.id)
+    if len(durations) >= MIN_HISTORY:
+        return quantile(durations, HISTORY_QUANTILE)
+    if task.duration != None:
+        return task.duration * 60 * OVERTIME_FACTOR
+    return DEFAULT_EXPECTED
+
+
+class TaskWatch(object):
+    """
+    Watches a running task and asks for help (Task.timeout()) only while
+    the participant is over the expected time and inactive. Activity are
+    file saves below the task's sources and run_test invocations seen by the
+    task's recorder. Nothing is checked before the expected time is reached.
+    """
+
+    def __init__(self, task, editor_cnt_id):
+        self.task = task
+        self.mgr = task.mgr
+        self.editor_cnt_id = editor_cnt_id
+        self.start = time.time()
+        self.expected = expected_time(self.mgr, task)
+        self.last_save = self.start
+        self.last_help = None
+        self.timer = None
+        self.lock = threading.Lock()
+        logging.debug("expected time for task %s: %.0fs", task.id, self.expected)
+        self.schedule(self.expected)
+
+    def schedule(self, delay):
+        with self.lock:
+            if self.timer is False:
+                return
+            if self.mgr.loop != None:
+                # a loop timer, the check runs as coroutine
+                self.timer = self.mgr.loop.call_later(delay, self.mgr.loop.spawn,
+                        self.check_async(), "task-watch")
+                return
+            self.timer = threading.Timer(delay, self.check)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def cancel(self):
+        with self.lock:
+            if self.timer:
+                self.timer.cancel()
+            self.timer = False
+
+    def saves_source(self):
+        """
+        (directory, None) with the task's sources if they are in an overlay
+        on this host, otherwise (None, command) listing the mtimes of the
+        files saved since the last known save
+        """
+        if self.mgr.storage != None and self.mgr.get_agent() == None:
+            volume = self.mgr.storage.container_volume(self.editor_cnt_id)
+            if volume != None:
+                # overlay: changed files are in the upper dir on this host
+                upper = self.mgr.storage.volume_dirs(volume)[0]
+                return (os.path.join(upper, os.path.relpath(self.task.src_dir,
+                    "/home/user/src")), None)
+        cmd = "%s exec %s find %s -type f -newermt @%d -printf '%%T@\\n'" % (
+                self.mgr.get_docker_cli(), self.editor_cnt_id, self.task.src_dir,
+                int(self.last_save))
+        return (None, cmd)
+
+    def newest_file(self, src):
+        newest = None
+        for dirpath, dirnames, filenames in os.walk(src):
+            for f in filenames:
+                try:
+                    newest = max(newest, os.lstat(os.path.join(dirpath, f)).st_mtime)
+                except OSError:
+                    pass
+        return newest
+
+    def parse_mtimes(self, out):
+        newest = None
+        for line in out.split():
+            try:
+                newest = max(newest, float(line))
+            except ValueError:
+                pass
+        return newest
+
+    def find_saves(self):
+        """
+        return the newest mtime of the task's files
+        """
+        src, cmd = self.saves_source()
+        if src != None:
+            return self.newest_file(src)
+        with self.mgr.admission.admit(cmd):
+            p = subprocess.Popen(shlex.split(cmd), stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE)
+            out, err = p.communicate()
+        if p.returncode != 0:
+            logging.error("could not check saves of task %s: %s", self.task.id, err)
+        return self.parse_mtimes(out)
+
+    def needs_help(self, saved):
+        """
+        record the newest save, returns True if help is to be requested now
+        """
+        if saved != None and saved > self.last_save:
+            self.last_save = saved
+        last = self.last_save
+        recorder = self.task.recorder
+        if recorder != None and recorder.last_test != None:
+            last = max(last, recorder.last_test)
+
+        now = time.time()
+        idle = now - last
+        if idle >= IDLE_LIMIT and (self.last_help == None or
+                now - self.last_help >= HELP_REPEAT):
+            logging.info("task %s over time (%.0fs of %.0fs) and idle for %.0fs",
+                    self.task.id, now - self.start, self.expected, idle)
+            self.last_help = now
+            return True
+        logging.debug("task %s over time, last activity %.0fs ago",
+                self.task.id, idle)
+        return False
+
+    def check(self):
+        try:
+            if self.needs_help(self.find_saves()):
+                self.task.timeout()
+        except Exception, err:
+            logging.error("error checking task %s: %s", self.task.id, err)
+        self.schedule(CHECK_INTERVAL)
+
+    def check_async(self):
+        """
+        check() on the event loop
+        """
+        loop = eventloop.get_loop()
+        try:
+            # the storage lookups and the walk of the upper dir block
+            src, cmd = yield loop.run_in_thread(self.saves_source)
+            if src != None:
+                saved = yield loop.run_in_thread(self.newest_file, src)
+            else:
+                adm = yield self.mgr.admission.admit_async(cmd)
+                try:
+                    out, err, ret = yield eventloop.run_process(loop, shlex.split(cmd))
+                finally:
+                    adm.release()
+                if ret != 0:
+                    logging.error("could not check saves of task %s: %s", self.task.id, err)
+                saved = self.parse_mtimes(out)
+            if self.needs_help(saved):
+                out, err, ret = yield eventloop.run_process(loop, self.task.help_request())
+                if ret != 0:
+                    logging.error("could not send help request: %s", err.strip())
+        except Exception, err:
+            logging.error("error checking task %s: %s", self.task.id, err)
+        self.schedule(CHECK_INTERVAL)
@@ -0,0 +1,284 @@
+#!/usr/bin/env python2.7
+
+import os
+import json
+import time
+import urllib
+import hashlib
+import httplib
+import logging
+import urlparse
+import threading
+
+from commandline import Command
+
+
+# jobs waiting for upload, survive restarts of the controller
+OUTBOX_DIR = "outbox"
+
+# artifacts the collection server has completed, a JSON object per line
+UPLOADED_LOG = "uploaded.jsonl"
+
+# artifacts are uploaded in chunks of this size, each one can be retried
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+# concurrent uploads
+UPLOAD_WORKERS = 3
+
+# seconds between retries of a failed upload (doubled up to RETRY_MAX)
+RETRY_MIN = 5
+RETRY_MAX = 300
+
+HTTP_TIMEOUT = 30
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(UPLOAD_CHUNK_SIZE)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+
+def uploaded_archives(path=OUTBOX_DIR):
+    """
+    names of the artifacts whose upload has been completed
+    """
+    names = set()
+    try:
+        with open(os.path.join(path, UPLOADED_LOG)) as f:
+            for line in f:
+                try:
+                    names.add(json.loads(line)["name"])
+                except (ValueError, KeyError):
+                    # a line cut short by a crash
+                    continue
+    except IOError:
+        pass
+    return names
+
+
+def pending_seats(path=OUTBOX_DIR):
+    """
+    group_user names of the seats with jobs still in the outbox
+    """
+    seats = set()
+    if not os.path.isdir(path):
+        return seats
+    for name in os.listdir(path):
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(path, name)) as f:
+                meta = json.load(f)["meta"]
+            seats.add("%s_%s" % (meta["group"], meta["user"]))
+        except (IOError, ValueError, KeyError):
+            continue
+    return seats
+
+
+class UploadError(Exception):
+    pass
+
+
+class Uploader(object):
+    """
+    Uploads artifacts to a collection server (see tools/collectsrv.py) in
+    the background. An upload is addressed by the sha256 of the artifact:
+
+        GET  <url>/uploads/<sha256>              -> {"offset": n, "complete": b}
+        PUT  <url>/uploads/<sha256>?offset=<n>   chunk, X-Chunk-Sha256 header
+        POST <url>/uploads/<sha256>?name=<name>  verify and complete
+
+    so an interrupted upload continues at the offset the server has.
+    """
+
+    def __init__(self, url, path=OUTBOX_DIR, workers=UPLOAD_WORKERS):
+        self.url = urlparse.urlsplit(url)
+        self.path = path
+        self.workers = workers
+        self.queue = []
+        self.active = {}
+        self.cond = threading.Condition()
+        self.threads = []
+        # current retry delay of failed jobs
+        self.retries = {}
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def start(self):
+        # jobs left over from earlier runs
+        with self.cond:
+            for name in sorted(os.listdir(self.path)):
+                if name.endswith(".json"):
+                    self.queue.append(name)
+        for i in range(self.workers):
+            t = threading.Thread(target=self.work, name="upload-%d" % i)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+        logging.info("uploading results to %s, %d job(s) in %s",
+                urlparse.urlunsplit(self.url), len(self.queue), self.path)
+
+    def enqueue(self, path, meta={}):
+        """
+        queue an artifact for upload, returns immediately
+        """
+        job_name = "%s_%s.json" % (time.strftime("%Y%m%d_%H%M%S"), os.path.basename(path))
+        # keep the data even if the artifact is removed (gc) before the upload
+        data = os.path.join(self.path, job_name[:-len(".json")])
+        try:
+            os.link(path, data)
+        except OSError:
+            data = os.path.abspath(path)
+        job = {"path": data, "name": os.path.basename(path), "meta": meta,
+                "linked": data != os.path.abspath(path), "sha256": None}
+        tmp = os.path.join(self.path, job_name + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump(job, f)
+        os.rename(tmp, os.path.join(self.path, job_name))
+        with self.cond:
+            self.queue.append(job_name)
+            self.cond.notify()
+        logging.info("queued %s for upload", path)
+
+    def load(self, job_name):
+        with open(os.path.join(self.path, job_name)) as f:
+            return json.load(f)
+
+    def save(self, job_name, job):
+        tmp = os.path.join(self.path, job_name + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump(job, f)
+        os.rename(tmp, os.path.join(self.path, job_name))
+
+    def request(self, method, sha, query=None, body=None, headers={}):
+        if self.url.scheme == "https":
+            conn = httplib.HTTPSConnection(self.url.netloc, timeout=HTTP_TIMEOUT)
+        else:
+            conn = httplib.HTTPConnection(self.url.netloc, timeout=HTTP_TIMEOUT)
+        path = "%s/uploads/%s" % (self.url.path.rstrip("/"), sha)
+        if query:
+            path += "?" + urllib.urlencode(query)
+        try:
+            conn.request(method, path, body, headers)
+            resp = conn.getresponse()
+            return (resp.status, resp.read())
+        finally:
+            conn.close()
+
+    def upload(self, job_name):
+        job = self.load(job_name)
+        if job["sha256"] == None:
+            job["sha256"] = file_sha256(job["path"])
+            job["size"] = os.path.getsize(job["path"])
+            self.save(job_name, job)
+        sha = job["sha256"]
+
+        status, body = self.request("GET", sha)
+        offset = 0
+        if status == 200:
+            state = json.loads(body)
+            if state.get("complete"):
+                return
+            offset = state["offset"]
+        elif status != 404:
+            raise UploadError("GET returned %d" % status)
+
+        with open(job["path"], "rb") as f:
+            f.seek(offset)
+            while offset < job["size"]:
+                chunk = f.read(UPLOAD_CHUNK_SIZE)
+                status, body = self.request("PUT", sha, {"offset": offset}, chunk,
+                        {"X-Chunk-Sha256": hashlib.sha256(chunk).hexdigest(),
+                         "Content-Type": "application/octet-stream"})
+                if status != 200:
+                    raise UploadError("PUT at %d returned %d" % (offset, status))
+                offset = json.loads(body)["offset"]
+                f.seek(offset)
+                with self.cond:
+                    self.active[job_name] = (offset, job["size"])
+
+        query = {"name": job["name"]}
+        query.update(job["meta"])
+        status, body = self.request("POST", sha, query)
+        if status != 200:
+            raise UploadError("POST returned %d: %s" % (status, body))
+
+    def done(self, job_name):
+        job = self.load(job_name)
+        # the artifact may be removed from this host now (gc)
+        record = json.dumps({"name": job["name"], "sha256": job["sha256"],
+            "meta": job["meta"], "time": time.time()})
+        with open(os.path.join(self.path, UPLOADED_LOG), "a") as f:
+            f.write(record + "\n")
+        if job["linked"]:
+            os.unlink(job["path"])
+        os.unlink(os.path.join(self.path, job_name))
+
+    def work(self):
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait(1)
+                job_name = self.queue.pop(0)
+                self.active[job_name] = (0, None)
+            try:
+                start = time.time()
+                self.upload(job_name)
+                self.done(job_name)
+                logging.info("uploaded %s in %.1fs", job_name, time.time() - start)
+                self.retries.pop(job_name, None)
+            except (IOError, OSError, ValueError, KeyError, httplib.HTTPException,
+                    UploadError), err:
+                delay = min(RETRY_MAX, self.retries.get(job_name, RETRY_MIN / 2.0) * 2)
+                self.retries[job_name] = delay
+                logging.error("upload of %s failed, retry in %ds: %s", job_name,
+                        delay, err)
+                t = threading.Timer(delay, self.requeue, (job_name,))
+                t.daemon = True
+                t.start()
+            finally:
+                with self.cond:
+                    self.active.pop(job_name, None)
+
+    def requeue(self, job_name):
+        with self.cond:
+            self.queue.append(job_name)
+            self.cond.notify()
+
+    def status(self):
+        """
+        return ([(job, bytes sent, size)] of running uploads, number of
+        jobs in the outbox)
+        """
+        with self.cond:
+            active = [(j, o, s) for j, (o, s) in sorted(self.active.items())]
+        waiting = len([n for n in os.listdir(self.path) if n.endswith(".json")])
+        return (active, waiting)
+
+
+class UploadStatus(Command):
+    def __init__(self, mgr):
+        self.set_mgr(mgr)
+
+    def get_keyword(self):
+        return "uploads"
+
+    def desctiption(self):
+        return "show the uploads of results to the collection server"
+
+    def run(self, args):
+        if self.mgr.uploader == None:
+            print "no collection server configured (--upload-url=)"
+            return
+        active, waiting = self.mgr.uploader.status()
+        print "%d artifact(s) in %s" % (waiting, self.mgr.uploader.path)
+        for job, offset, size in active:
+            if size:
+                print "  %-50s %5.1f%%" % (job, offset * 100.0 / size)
+            else:
+                print "  %-50s hashing" % job
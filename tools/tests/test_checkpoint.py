@@ -0,0 +1,97 @@
+#!/usr/bin/env python2.7
+
+import os
+import sys
+import shutil
+import tarfile
+import StringIO
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "..", "experimentcontroller")
+    ))
+
+import archiver
+import checkpoint
+
+
+def add(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, StringIO.StringIO(data))
+
+
+class CheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "g1_bob")
+        os.makedirs(self.path)
+        self.index = {"checkpoints": []}
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def delta(self, files, listing):
+        """
+        add a checkpoint with files {name: data} below src/ and the listing
+        of all files in the container
+        """
+        n = len(self.index["checkpoints"]) + 1
+        tar = tarfile.open(checkpoint.delta_path(self.path, n), "w:gz")
+        for name in sorted(files):
+            add(tar, "src/" + name, files[name])
+        add(tar, "meta/files.txt", "".join(f + "\n" for f in listing))
+        tar.close()
+        self.index["checkpoints"].append({"n": n})
+        checkpoint.save_index(self.path, self.index)
+
+    def contents(self, tarball):
+        tar = tarfile.open(tarball, "r:gz")
+        try:
+            return dict((i.name, tar.extractfile(i).read()) for i in tar if i.isreg())
+        finally:
+            tar.close()
+
+    def test_newest_version_wins(self):
+        self.delta({"a": "a1", "b/c": "c1"}, ["a", "b/c"])
+        self.delta({"a": "a2"}, ["a", "b/c"])
+        self.assertEqual(checkpoint.latest_files(self.path), {"src/a": 2, "src/b/c": 1})
+
+    def test_deleted_files_are_left_out(self):
+        self.delta({"a": "a1", "b": "b1"}, ["a", "b"])
+        self.delta({}, ["./a"])
+        self.assertEqual(checkpoint.latest_files(self.path), {"src/a": 1})
+
+    def test_file_missing_from_the_deltas(self):
+        # renamed in the container, but not captured
+        self.delta({"a": "a1"}, ["a"])
+        self.delta({}, ["a", "renamed"])
+        self.assertRaises(IOError, checkpoint.latest_files, self.path)
+
+    def test_no_listing(self):
+        tar = tarfile.open(checkpoint.delta_path(self.path, 1), "w:gz")
+        add(tar, "src/a", "a1")
+        tar.close()
+        checkpoint.save_index(self.path, {"checkpoints": [{"n": 1}]})
+        self.assertRaises(IOError, checkpoint.latest_files, self.path)
+
+    def test_write_tarball(self):
+        self.delta({"a": "a1", "b/c": "c1", "gone": "x"}, ["a", "b/c", "gone"])
+        self.delta({"a": "a2"}, ["a", "b/c"])
+        tarball = os.path.join(self.dir, "exp_g1_bob_20261019_120000.tar.gz")
+        files = checkpoint.write_tarball(self.path, tarball, {"log.txt": "log"})
+        self.assertEqual(files, 2)
+        self.assertEqual(self.contents(tarball),
+                {"src/a": "a2", "src/b/c": "c1", "log.txt": "log"})
+        self.assertEqual(archiver.verify(tarball), [])
+
+    def test_write_incomplete_tarball(self):
+        self.delta({"a": "a1"}, ["a", "b"])
+        tarball = os.path.join(self.dir, "exp_g1_bob_20261019_120000.tar.gz")
+        self.assertRaises(IOError, checkpoint.write_tarball, self.path, tarball)
+        self.assertEqual(sorted(os.listdir(self.dir)), ["g1_bob"])
+
+
+if __name__ == "__main__":
+    unittest.main()
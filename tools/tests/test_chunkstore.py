@@ -0,0 +1,130 @@
+#!/usr/bin/env python2.7
+
+import os
+import sys
+import zlib
+import shutil
+import tarfile
+import StringIO
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "..", "experimentcontroller")
+    ))
+
+import chunkstore
+from chunkstore import ChunkStore
+
+
+def make_archive(path, files):
+    tar = tarfile.open(path, "w:gz")
+    for name in sorted(files):
+        info = tarfile.TarInfo(name)
+        info.size = len(files[name])
+        info.mtime = 1500000000
+        tar.addfile(info, StringIO.StringIO(files[name]))
+    tar.close()
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def contents(path):
+    tar = tarfile.open(path, "r:gz")
+    try:
+        return dict((i.name, tar.extractfile(i).read()) for i in tar if i.isreg())
+    finally:
+        tar.close()
+
+
+class ChunkStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.store = ChunkStore(os.path.join(self.dir, "store"))
+        self.skeleton = "".join("skeleton line %d\n" % i for i in range(5000))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def archive(self, name, files):
+        path = os.path.join(self.dir, name)
+        make_archive(path, files)
+        return path
+
+    def test_round_trip(self):
+        files = {"src/a": self.skeleton, "src/b": "changed", "src/empty": ""}
+        path = self.archive("exp_g1_bob_20261019_120000.tar.gz", files)
+        self.store.store_archive(path)
+        self.assertEqual(contents(path), files)
+
+        restored = os.path.join(self.dir, "restored.tar.gz")
+        manifest = self.store.load_manifest(os.path.basename(path))
+        self.store.write_tarball(manifest, restored)
+        # the stored archive is the deterministic rewrite
+        self.assertEqual(read(restored), read(path))
+
+    def test_identical_files_are_stored_once(self):
+        first = self.archive("exp_g1_bob_20261019_120000.tar.gz",
+                {"src/a": self.skeleton, "src/b": "bob"})
+        second = self.archive("exp_g1_amy_20261019_120000.tar.gz",
+                {"src/a": self.skeleton, "src/b": "amy"})
+        manifest, new_bytes = self.store.store_archive(first)
+        self.assertEqual(new_bytes, len(self.skeleton) + len("bob"))
+        manifest, new_bytes = self.store.store_archive(second)
+        self.assertEqual(new_bytes, len("amy"))
+
+    def test_large_files_are_split(self):
+        data = os.urandom(chunkstore.CHUNK_SIZE + 10)
+        path = self.archive("exp_g1_bob_20261019_120000.tar.gz", {"src/big": data})
+        manifest, new_bytes = self.store.store_archive(path)
+        chunks = [s for s in manifest["segments"] if s[0] == "c"]
+        self.assertEqual([s[2] for s in chunks], [chunkstore.CHUNK_SIZE, 10])
+        self.assertEqual(contents(path), {"src/big": data})
+
+    def test_corrupted_chunk(self):
+        path = self.archive("exp_g1_bob_20261019_120000.tar.gz", {"src/a": "data"})
+        manifest, new_bytes = self.store.store_archive(path)
+        key = [s for s in manifest["segments"] if s[0] == "c"][0][1]
+        with open(self.store.chunk_path(key), "wb") as f:
+            f.write(zlib.compress("other data"))
+        self.assertRaises(IOError, self.store.write_tarball, manifest,
+                os.path.join(self.dir, "restored.tar.gz"))
+
+    def test_export(self):
+        path = self.archive("exp_g1_bob_20261019_120000.tar.gz", {"src/a": self.skeleton})
+        self.store.store_archive(path)
+        target = ChunkStore(os.path.join(self.dir, "target"))
+        name = os.path.basename(path)
+        self.assertEqual(self.store.export(name, target)[0], 1)
+        # nothing left to copy
+        self.assertEqual(self.store.export(name, target)[0], 0)
+        restored = os.path.join(self.dir, "restored.tar.gz")
+        target.write_tarball(target.load_manifest(name), restored)
+        self.assertEqual(read(restored), read(path))
+
+    def test_group_writable(self):
+        umask = os.umask(022)
+        try:
+            store = ChunkStore(os.path.join(self.dir, "shared", "store"))
+            path = self.archive("exp_g1_bob_20261019_120000.tar.gz", {"src/a": "data"})
+            store.store_archive(path)
+            target = ChunkStore(os.path.join(self.dir, "target"))
+            store.export(os.path.basename(path), target)
+        finally:
+            os.umask(umask)
+        mode = lambda p: os.stat(p).st_mode & 07777
+        for s in [store, target]:
+            for dirpath, dirnames, filenames in os.walk(s.path):
+                self.assertEqual(mode(dirpath), chunkstore.STORE_DIR_MODE, dirpath)
+                for f in filenames:
+                    self.assertEqual(mode(os.path.join(dirpath, f)),
+                            chunkstore.STORE_FILE_MODE, f)
+        # the parent is not part of the store
+        self.assertEqual(mode(os.path.join(self.dir, "shared")), 0755)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python2.7
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "..", "experimentcontroller")
+    ))
+
+from cleanup import GarbageCollect, Seat
+from chunkstore import ChunkStore
+import uploader
+
+
+DAY = 86400
+
+
+def make_seats(ages):
+    """
+    {name: Seat} with the given ages in days and 1 MiB each
+    """
+    seats = {}
+    now = time.time()
+    for name, age in ages.items():
+        s = Seat(name)
+        s.add("containers", "cnt_" + name, now - age * DAY, 1 << 20)
+        seats[name] = s
+    return seats
+
+
+def names(seats):
+    return sorted([s.name for s in seats])
+
+
+class SelectTest(unittest.TestCase):
+    def setUp(self):
+        self.gc = GarbageCollect(None)
+        self.seats = make_seats({"g1_a": 1, "g1_b": 3, "g1_c": 10, "g1_d": 20})
+
+    def test_max_age(self):
+        selected = self.gc.select(self.seats, 7, 0, None)
+        self.assertEqual(names(selected), ["g1_c", "g1_d"])
+
+    def test_keep_alone_selects_nothing(self):
+        self.assertEqual(self.gc.select(self.seats, None, 1, None), [])
+
+    def test_keep_protects_old_seats(self):
+        selected = self.gc.select(self.seats, 2, 3, None)
+        self.assertEqual(names(selected), ["g1_d"])
+
+    def test_max_size_removes_oldest_first(self):
+        selected = self.gc.select(self.seats, None, 0, 3.5 * (1 << 20))
+        self.assertEqual(names(selected), ["g1_d"])
+        selected = self.gc.select(self.seats, None, 0, 2.5 * (1 << 20))
+        self.assertEqual(names(selected), ["g1_c", "g1_d"])
+
+    def test_max_size_respects_keep(self):
+        selected = self.gc.select(self.seats, None, 3, 0)
+        self.assertEqual(names(selected), ["g1_d"])
+
+
+class ExportedTest(unittest.TestCase):
+    def setUp(self):
+        self.gc = GarbageCollect(None)
+        self.exported = set(["exp_g1_bob_smith_20260101_120000.tar.gz",
+            "exp_g2_eve_20260102_130000.tar.gz"])
+
+    def test_exact_seat(self):
+        self.assertTrue(self.gc.is_exported(Seat("g2_eve"), self.exported))
+        self.assertTrue(self.gc.is_exported(Seat("g1_bob_smith"), self.exported))
+
+    def test_seat_prefix_does_not_count(self):
+        self.assertFalse(self.gc.is_exported(Seat("g1_bob"), self.exported))
+        self.assertFalse(self.gc.is_exported(Seat("g2"), self.exported))
+
+    def test_tarball(self):
+        self.assertTrue(self.gc.tarball_exported(
+            "./exp_g2_eve_20260102_130000.tar.gz", self.exported))
+        self.assertFalse(self.gc.tarball_exported(
+            "exp_g2_eve_20260103_090000.tar.gz", self.exported))
+
+    def test_pending_upload(self):
+        self.assertFalse(self.gc.is_exported(Seat("g2_eve"), self.exported,
+            set(["g2_eve"])))
+
+
+class ExportLogTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_uploads(self):
+        outbox = os.path.join(self.dir, "outbox")
+        up = uploader.Uploader("http://localhost:1/", outbox)
+        path = os.path.join(self.dir, "exp_g1_bob_20260101_120000.tar.gz")
+        open(path, "w").close()
+        up.enqueue(path, {"group": "g1", "user": "bob"})
+        self.assertEqual(uploader.pending_seats(outbox), set(["g1_bob"]))
+        self.assertEqual(uploader.uploaded_archives(outbox), set())
+
+        job = [n for n in os.listdir(outbox) if n.endswith(".json")][0]
+        up.done(job)
+        self.assertEqual(uploader.pending_seats(outbox), set())
+        self.assertEqual(uploader.uploaded_archives(outbox),
+                set([os.path.basename(path)]))
+
+    def test_store_exports(self):
+        store = ChunkStore(os.path.join(self.dir, "store"))
+        target = ChunkStore(os.path.join(self.dir, "target"))
+        name = "exp_g1_bob_20260101_120000.tar.gz"
+        store.atomic_write(store.manifest_path(name),
+                json.dumps({"archive": name, "segments": []}))
+        self.assertEqual(store.exported_archives(), set())
+        store.export(name, target)
+        self.assertEqual(store.exported_archives(), set([name]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python2.7
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "..", "experimentcontroller")
+    ))
+
+import commandline
+from commandline import CommandLine, Command
+from experiment import Plan
+
+
+class Task(object):
+    def __init__(self, id):
+        self.id = id
+        self.duration = 10
+
+
+class StartTask(Command):
+    def __init__(self, labels):
+        self.labels = labels
+
+    def get_keyword(self):
+        return "start_task"
+
+    def complete_cmd(self, args):
+        if len(args) == 1:
+            return list(self.labels)
+        return []
+
+
+class CompletionTest(unittest.TestCase):
+    def setUp(self):
+        self.cmdline = CommandLine()
+        plan = Plan([Task("q1"), Task("t1"), Task("q1")])
+        self.cmdline.register(StartTask(plan.labels))
+        self.readline = commandline.readline
+        self.saved = (self.readline.get_line_buffer, self.readline.get_begidx,
+                self.readline.get_endidx)
+
+    def tearDown(self):
+        (self.readline.get_line_buffer, self.readline.get_begidx,
+                self.readline.get_endidx) = self.saved
+
+    def complete(self, line):
+        """
+        all completions of the word at the end of line, split into words
+        like readline does with its completer delimiters
+        """
+        delims = self.readline.get_completer_delims()
+        begin = max([line.rfind(d) for d in delims] + [-1]) + 1
+        self.readline.get_line_buffer = lambda: line
+        self.readline.get_begidx = lambda: begin
+        self.readline.get_endidx = lambda: len(line)
+        matches = []
+        while True:
+            m = self.cmdline.tab_complete(line[begin:], len(matches))
+            if m == None:
+                return matches
+            matches.append(m)
+
+    def test_repeated_id(self):
+        self.assertEqual(self.complete("start_task q1@"), ["q1@1", "q1@2"])
+        self.assertEqual(self.complete("start_task q1@2"), ["q1@2"])
+
+    def test_unique_id(self):
+        self.assertEqual(self.complete("start_task t"), ["t1"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python2.7
+
+import os
+import sys
+import errno
+import shutil
+import logging
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "..", "experimentcontroller")
+    ))
+
+import image_bundle
+from scheduler import AdmissionControl
+
+
+# 'docker save' writes endlessly, 'docker load' exits without reading
+FAKE_DOCKER = """#!/bin/sh
+echo $$ > "%s"
+case "$1" in
+    save) exec yes ;;
+    load) exit 1 ;;
+esac
+"""
+
+
+class FullWriter(object):
+    """
+    a ParallelGzipWriter on a full disk
+    """
+
+    def __init__(self, f, threads=None):
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def write(self, data):
+        raise IOError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+
+    def close(self):
+        pass
+
+
+class Manager(object):
+    def __init__(self):
+        self.admission = AdmissionControl(enabled=False)
+
+
+class BundleTest(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.dir = tempfile.mkdtemp()
+        self.pid_file = os.path.join(self.dir, "pid")
+        docker = os.path.join(self.dir, "docker")
+        with open(docker, "w") as f:
+            f.write(FAKE_DOCKER % self.pid_file)
+        os.chmod(docker, 0755)
+        self.path = os.environ["PATH"]
+        os.environ["PATH"] = self.dir + os.pathsep + self.path
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+        self.get_required_images = image_bundle.get_required_images
+        image_bundle.get_required_images = lambda mgr: ["img"]
+        self.writer = image_bundle.ParallelGzipWriter
+        self.bundle = os.path.join(self.dir, "bundle.tar.gz")
+
+    def tearDown(self):
+        image_bundle.get_required_images = self.get_required_images
+        image_bundle.ParallelGzipWriter = self.writer
+        sys.stdout.close()
+        sys.stdout = self.stdout
+        os.environ["PATH"] = self.path
+        shutil.rmtree(self.dir)
+        logging.disable(logging.NOTSET)
+
+    def assertExited(self):
+        with open(self.pid_file) as f:
+            pid = int(f.read())
+        # reaped, not just a zombie
+        self.assertRaises(OSError, os.kill, pid, 0)
+
+    def test_export_disk_full(self):
+        image_bundle.ParallelGzipWriter = FullWriter
+        cmd = image_bundle.ExportImages(Manager())
+        cmd.exec_cmd = lambda line, silent=False: ("sha256:0", 0)
+        self.assertFalse(cmd.run([self.bundle]))
+        self.assertExited()
+        # no partial bundle left
+        self.assertEqual(sorted(os.listdir(self.dir)), ["docker", "pid"])
+
+    def test_load_docker_exits(self):
+        with open(self.bundle, "wb") as f:
+            f.write("x" * (4 * image_bundle.READ_SIZE))
+        cmd = image_bundle.LoadImages(Manager())
+        self.assertFalse(cmd.run([self.bundle]))
+        self.assertExited()
+
+
+if __name__ == "__main__":
+    unittest.main()
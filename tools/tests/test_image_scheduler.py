@@ -0,0 +1,116 @@
+#!/usr/bin/env python2.7
+
+import os
+import sys
+import json
+import logging
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "..", "experimentcontroller")
+    ))
+
+import basic_commands
+from image_scheduler import ImageScheduler
+
+
+class Result(object):
+    def __init__(self, value):
+        self.value = value
+
+
+class Probes(object):
+    """
+    the "images" probe, every get() returns the next of results (an
+    exception is raised)
+    """
+
+    def __init__(self, results):
+        self.results = results
+
+    def invalidate(self, name):
+        pass
+
+    def get(self, name):
+        r = self.results.pop(0)
+        if isinstance(r, Exception):
+            raise r
+        return Result(r)
+
+
+class Manager(object):
+    def __init__(self, probes):
+        self.probes = probes
+
+
+class FailureTest(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def scheduler(self, results):
+        s = ImageScheduler(Manager(Probes(results)), mirror="")
+        s.start()
+        s.thread.join(5)
+        return s
+
+    def test_error_is_recorded(self):
+        s = self.scheduler([RuntimeError("docker hangs")])
+        self.assertEqual(s.error, "docker hangs")
+        self.assertEqual(s.status(), "images: scheduler failed")
+
+    def test_wait_for_returns(self):
+        s = self.scheduler([RuntimeError("docker hangs"), ["task-a"]])
+        self.assertFalse(s.wait_for("task-a"))
+
+    def test_pulled_manually_after_the_failure(self):
+        s = self.scheduler([RuntimeError("docker hangs"), []])
+        self.assertTrue(s.wait_for("task-a"))
+
+
+class PinsTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+        self.puller = basic_commands.PullImages(None, quiet=True)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def pin(self, digest):
+        return {"repo": "prefix/image", "digest": digest}
+
+    def test_pins_saved_meanwhile_are_kept(self):
+        self.puller.save_pins({"a": self.pin("1")})
+        loaded = self.puller.load_pins()
+        pins = dict(loaded)
+        # pull_images pins b while the scheduler pulls c
+        self.puller.save_pins({"a": self.pin("1"), "b": self.pin("2")})
+        pins["c"] = self.pin("3")
+        self.puller.update_pins(pins, loaded)
+        self.assertEqual(sorted(self.puller.load_pins()), ["a", "b", "c"])
+
+    def test_stale_pins_do_not_overwrite(self):
+        self.puller.save_pins({"a": self.pin("1")})
+        loaded = self.puller.load_pins()
+        pins = dict(loaded)
+        self.puller.save_pins({"a": self.pin("new")})
+        self.puller.update_pins(pins, loaded)
+        self.assertEqual(self.puller.load_pins()["a"]["digest"], "new")
+
+    def test_update_replaces_pins(self):
+        self.puller.save_pins({"a": self.pin("1")})
+        # pull_images --update starts without pins
+        self.puller.update_pins({"a": self.pin("2")}, {})
+        with open(basic_commands.IMAGE_PINS) as f:
+            self.assertEqual(json.load(f)["a"]["digest"], "2")
+
+
+if __name__ == "__main__":
+    unittest.main()
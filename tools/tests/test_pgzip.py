@@ -0,0 +1,48 @@
+#!/usr/bin/env python2.7
+
+import os
+import sys
+import gzip
+import StringIO
+import unittest
+
+sys.path.insert(0, os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "..", "experimentcontroller")
+    ))
+
+from pgzip import ParallelGzipWriter
+
+
+def compress(writes, block_size=1000, threads=3):
+    out = StringIO.StringIO()
+    with ParallelGzipWriter(out, threads=threads, block_size=block_size) as gz:
+        for data in writes:
+            gz.write(data)
+    return out.getvalue()
+
+
+def decompress(data):
+    return gzip.GzipFile(fileobj=StringIO.StringIO(data)).read()
+
+
+class ParallelGzipTest(unittest.TestCase):
+    def setUp(self):
+        self.data = "".join("line %d of the test data\n" % i for i in range(2000))
+
+    def test_round_trip(self):
+        self.assertEqual(decompress(compress([self.data])), self.data)
+
+    def test_empty(self):
+        self.assertEqual(decompress(compress([])), "")
+
+    def test_independent_of_the_write_sizes(self):
+        pieces = [self.data[i:i + 77] for i in range(0, len(self.data), 77)]
+        self.assertEqual(compress(pieces), compress([self.data]))
+
+    def test_independent_of_the_threads(self):
+        self.assertEqual(compress([self.data], threads=1),
+                compress([self.data], threads=4))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python2.7
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "..", "experimentcontroller")
+    ))
+
+import questionnaire
+
+
+TEMPLATE = """# task 1 questions
+1. How difficult was the task? (1-5)
+
+2. Which resource types did you use?
+[ ] file
+[ ] augeas
+
+3. What would you change in method 1-2?
+   please explain why
+
+4. How confident are you in your solution?
+   1 = not at all   5 = very
+"""
+
+
+def answers(content, template=TEMPLATE):
+    return dict([(i.id, i) for i in questionnaire.parse(content, template)])
+
+
+class ParseTest(unittest.TestCase):
+    def test_unanswered_template(self):
+        items = answers(TEMPLATE)
+        self.assertEqual(sorted(items), ["1", "2", "3", "4"])
+        for i in items.values():
+            self.assertFalse(i.is_answered(), i.id)
+
+    def test_types(self):
+        items = answers(TEMPLATE)
+        self.assertEqual(items["1"].type, "scale")
+        self.assertEqual(items["1"].scale, (1, 5))
+        self.assertEqual(items["2"].type, "choice")
+        self.assertEqual(items["4"].scale, (1, 5))
+
+    def test_range_in_question_text_is_no_scale(self):
+        self.assertEqual(answers(TEMPLATE)["3"].type, "text")
+
+    def test_plain_free_text(self):
+        content = TEMPLATE.replace("   please explain why\n",
+                "   please explain why\nless typing\nbetter errors\n")
+        self.assertEqual(answers(content)["3"].value, "less typing better errors")
+
+    def test_prefixed_free_text(self):
+        content = TEMPLATE.replace("   please explain why\n",
+                "   please explain why\nanswer: nothing\n")
+        self.assertEqual(answers(content)["3"].value, "nothing")
+
+    def test_numbered_answer_lines(self):
+        content = TEMPLATE.replace("   please explain why\n",
+                "   please explain why\n1. shorter names\n2. more docs\n")
+        items = answers(content)
+        self.assertEqual(sorted(items), ["1", "2", "3", "4"])
+        self.assertEqual(items["3"].value, "1. shorter names 2. more docs")
+
+    def test_scale_and_choice(self):
+        content = TEMPLATE.replace("(1-5)\n", "(1-5)\n4 (rather hard)\n")
+        content = content.replace("[ ] augeas", "[x] augeas")
+        content = content.replace("5 = very\n", "5 = very\n7\n")
+        items = answers(content)
+        self.assertEqual(items["1"].value, 4)
+        self.assertEqual(items["2"].value, ["augeas"])
+        # out of range
+        self.assertFalse(items["4"].is_answered())
+
+    def test_without_template(self):
+        content = TEMPLATE.replace("(1-5)\n", "(1-5)\n> 2\n")
+        items = answers(content, None)
+        self.assertEqual(items["1"].value, 2)
+        # the hint can't be told apart from an answer without the template
+        self.assertEqual(items["3"].value, "please explain why")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python2.7
+
+import os
+import sys
+import shutil
+import tarfile
+import tempfile
+import unittest
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "..", "experimentcontroller")
+    ))
+
+import results_store
+
+
+class ParseArchiveTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "g_u.tar.gz")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def make_tar(self, files):
+        tar = tarfile.open(self.path, "w:gz")
+        for name, content in files:
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, StringIO(content))
+        tar.close()
+
+    def answers(self, suffix):
+        kind, path, archives, answers = results_store.parse_archive(
+                self.path, "g", "u", 0, [("t1", suffix)])
+        return [a[5] for a in answers]
+
+    def test_dot_slash_prefix(self):
+        self.make_tar([("./answers.txt", "a")])
+        self.assertEqual(self.answers("answers.txt"), ["a"])
+
+    def test_leading_dots_kept(self):
+        # only a "./" prefix is removed, not leading dots of the name
+        self.make_tar([("./.answers.txt", "hidden"), ("./answers.txt", "a")])
+        self.assertEqual(self.answers(".answers.txt"), ["hidden"])
+
+
+if __name__ == "__main__":
+    unittest.main()
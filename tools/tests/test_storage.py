@@ -0,0 +1,65 @@
+#!/usr/bin/env python2.7
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "..", "experimentcontroller")
+    ))
+
+import storage
+
+
+def write(path, data):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, "w") as f:
+        f.write(data)
+
+
+class MergedMembersTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.lower = os.path.join(self.dir, "lower")
+        self.upper = os.path.join(self.dir, "upper")
+        for name in ["a/x", "a/y", "d/old", "top"]:
+            write(os.path.join(self.lower, name), "lower " + name)
+        os.makedirs(self.upper)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def members(self, listing):
+        return dict(storage.merged_members(self.upper, self.lower, listing))
+
+    def test_unchanged_files_come_from_the_skeleton(self):
+        m = self.members(["a", "a/x", "a/y", "d", "d/old", "top"])
+        self.assertEqual(sorted(m), ["src", "src/a", "src/a/x", "src/a/y",
+            "src/d", "src/d/old", "src/top"])
+        self.assertEqual(m["src/a/x"], os.path.join(self.lower, "a/x"))
+
+    def test_changed_and_new_files_come_from_the_overlay(self):
+        write(os.path.join(self.upper, "a/x"), "changed")
+        write(os.path.join(self.upper, "a/new"), "new")
+        m = self.members(["a", "a/new", "a/x", "a/y", "d", "d/old", "top"])
+        self.assertEqual(m["src/a/x"], os.path.join(self.upper, "a/x"))
+        self.assertEqual(m["src/a/new"], os.path.join(self.upper, "a/new"))
+        self.assertEqual(m["src/a/y"], os.path.join(self.lower, "a/y"))
+
+    def test_replaced_directory(self):
+        # d was removed and created again (opaque in the upper dir)
+        write(os.path.join(self.upper, "d/fresh"), "fresh")
+        m = self.members(["a", "a/x", "a/y", "d", "d/fresh", "top"])
+        self.assertFalse("src/d/old" in m)
+        self.assertEqual(m["src/d"], os.path.join(self.upper, "d"))
+
+    def test_vanished_file_is_skipped(self):
+        m = self.members(["a", "a/x", "gone"])
+        self.assertFalse("src/gone" in m)
+
+
+if __name__ == "__main__":
+    unittest.main()
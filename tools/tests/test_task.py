@@ -0,0 +1,54 @@
+#!/usr/bin/env python2.7
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "..", "experimentcontroller")
+    ))
+
+from task import parse_steps, classify
+
+
+def output(*steps):
+    lines = ["Notice: Compiled catalog", "some test output"]
+    lines += ["EXPCTR_STEP %s %d" % s for s in steps]
+    return "\n".join(lines) + "\n"
+
+
+class StepTest(unittest.TestCase):
+
+    def test_parse(self):
+        steps = parse_steps(output(("init", 0), ("puppet", 2), ("test", 1)))
+        self.assertEqual(steps, {"init": 0, "puppet": 2, "test": 1})
+
+    def test_ignores_echoed_commands(self):
+        steps = parse_steps("run_puppet; echo EXPCTR_STEP puppet $?\n")
+        self.assertEqual(steps, {})
+
+    def test_init_fails(self):
+        result, ok = classify(parse_steps(output()))
+        self.assertFalse(ok)
+
+    def test_puppet_fails(self):
+        result, ok = classify({"init": 0, "puppet": 4, "test": 1})
+        self.assertFalse(ok)
+        self.assertIn("puppet fails (4)", result)
+
+    def test_puppet_unfinished(self):
+        result, ok = classify({"init": 0})
+        self.assertFalse(ok)
+
+    def test_failing_tests_are_expected(self):
+        result, ok = classify({"init": 0, "puppet": 0, "test": 3})
+        self.assertTrue(ok)
+        self.assertEqual(result, "puppet ok, tests fail (3)")
+
+    def test_tests_pass(self):
+        self.assertEqual(classify({"init": 0, "puppet": 2, "test": 0}),
+                ("tests pass", True))
+
+
+if __name__ == "__main__":
+    unittest.main()